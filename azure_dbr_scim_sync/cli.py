@@ -6,6 +6,8 @@ import click
 from databricks.labs.blueprint.logger import install_logger
 
 from .graph import GraphAPIClient
+from .graph_group_names import GroupNameCache
+from .graph_snapshot import GroupSnapshotStore
 from .persisted_cache import Cache
 from .scim import get_account_client, sync
 
@@ -35,6 +37,34 @@ from .scim import get_account_client, sync
               default=10,
               show_default=True,
               help="number of concurent web requests to perform against SCIM")
+@click.option('--member-worker-threads',
+              default=None,
+              type=int,
+              help="number of groups which members are synced concurently, defaults to --worker-threads")
+@click.option(
+    '--scim-prefetch-principals',
+    default=False,
+    is_flag=True,
+    show_default=True,
+    help="download all users, groups and service principals of the account at once, instead of looking them up "
+    "one by one, faster when syncing large number of principals")
+@click.option(
+    '--scim-cache-trust-ttl',
+    default=0,
+    show_default=True,
+    help="seconds for which cached principals, that were last synced with the same attributes and members, are "
+    "trusted without looking them up again, 0 disables the trust")
+@click.option(
+    '--scim-skip-unchanged-members',
+    default=False,
+    is_flag=True,
+    show_default=True,
+    help="users and service principals, that did not change since they were last synced, are not looked up, "
+    "their ids are taken from the cache")
+@click.option('--graph-worker-threads',
+              default=10,
+              show_default=True,
+              help="number of groups downloaded concurently from graph api at each group search depth")
 @click.option('--save-graph-response-json', required=False, help="saves graph response into json file")
 @click.option('--query-graph-only',
               required=False,
@@ -47,11 +77,24 @@ from .scim import get_account_client, sync
     default=1,
     show_default=True,
     help="defines nested group recursion search depth, default is to search only groups provided as input")
+@click.option(
+    '--graph-transitive-members',
+    default=False,
+    is_flag=True,
+    show_default=True,
+    help="discover nested groups using graph api transitive members, instead of searching group names depth by depth")
 @click.option(
     '--graph-change-feed-grace-time',
     default=30,
     show_default=True,
     help="time in seconds to wait before checking membership of groups detected in incremental mode")
+@click.option(
+    '--graph-change-feed-verify',
+    default=False,
+    is_flag=True,
+    show_default=True,
+    help="instead of waiting for the grace time, check membership of changed groups until it matches the change feed, "
+    "waiting at most `graph-change-feed-grace-time` seconds")
 @click.option(
     '--full-sync',
     default=False,
@@ -71,8 +114,10 @@ from .scim import get_account_client, sync
     show_default=True,
     help="include mail-enabled Entra groups in the sync")
 def sync_cli(groups_json_file, verbose, debug, dry_run_security_principals, dry_run_members, worker_threads,
-             save_graph_response_json, query_graph_only, group_search_depth, full_sync,
-             graph_change_feed_grace_time, include_non_security_groups, include_mail_enabled_groups):
+             member_worker_threads, scim_prefetch_principals, scim_cache_trust_ttl,
+             scim_skip_unchanged_members, graph_worker_threads, save_graph_response_json, query_graph_only,
+             group_search_depth, graph_transitive_members, full_sync, graph_change_feed_grace_time,
+             graph_change_feed_verify, include_non_security_groups, include_mail_enabled_groups):
     install_logger()
 
     logger = logging.getLogger('sync')
@@ -83,10 +128,18 @@ def sync_cli(groups_json_file, verbose, debug, dry_run_security_principals, dry_
     if verbose:
         logger.setLevel(logging.DEBUG)
 
+    group_name_cache = GroupNameCache(path="graph_group_names.json")
+    if full_sync:
+        # names are resolved again, as change feed is not used to invalidate them
+        group_name_cache.clear()
+
     graph_client = GraphAPIClient(
         include_mail_enabled_groups=include_mail_enabled_groups,
-        include_non_security_groups=include_non_security_groups
-    )
+        include_non_security_groups=include_non_security_groups,
+        worker_threads=graph_worker_threads,
+        transitive_members=graph_transitive_members,
+        group_snapshot=GroupSnapshotStore(path="graph_group_snapshot.json.gz"),
+        group_name_cache=group_name_cache)
     account_client = get_account_client()
 
     if groups_json_file:
@@ -108,12 +161,25 @@ def sync_cli(groups_json_file, verbose, debug, dry_run_security_principals, dry_
     else:
         logger.info("Entering incremental graph query mode...")
         incremental_token_cache = Cache(path="graph_incremental_token.json")
-        delta_link = incremental_token_cache.get('delta_link')
+        # shards of groups change feed, or delta link of the change feed of all groups (from older versions)
+        delta_link = incremental_token_cache.get('group_delta_shards') or incremental_token_cache.get('delta_link')
+
+        # users changes first, so that snapshot of group members has up to date users
+        users_delta_link, changed_users = graph_client.get_changed_users(
+            delta_link=incremental_token_cache.get('users_delta_link'))
+
         delta_link, stuff_to_sync = graph_client.get_objects_for_sync_incremental(
             delta_link=delta_link,
             group_names=aad_groups,
             group_search_depth=group_search_depth,
-            graph_change_feed_grace_time=graph_change_feed_grace_time)
+            graph_change_feed_grace_time=graph_change_feed_grace_time,
+            graph_change_feed_verify=graph_change_feed_verify)
+
+        # changed users are synced, even when they are not members of any changed group
+        for u in changed_users:
+            stuff_to_sync.users.setdefault(u.id, u)
+
+    logger.info(f"Graph requests: {graph_client.rate_limiter.stats()}")
 
     if save_graph_response_json:
         stuff_to_sync.save_to_json_file(save_graph_response_json)
@@ -130,11 +196,22 @@ def sync_cli(groups_json_file, verbose, debug, dry_run_security_principals, dry_
         deep_sync_group_names=list(stuff_to_sync.deep_sync_group_names),
         dry_run_security_principals=dry_run_security_principals,
         dry_run_members=dry_run_members,
-        worker_threads=worker_threads)
+        worker_threads=worker_threads,
+        member_worker_threads=member_worker_threads,
+        prefetch_principals=scim_prefetch_principals,
+        cache_trust_ttl=scim_cache_trust_ttl,
+        skip_unchanged_members=scim_skip_unchanged_members)
 
     if not full_sync:
-        logger.info(f"Saving graph delta token: ..{delta_link[-32:]}")
-        incremental_token_cache['delta_link'] = delta_link
+        if isinstance(delta_link, list):
+            logger.info(f"Saving graph delta tokens: shards={len(delta_link)}")
+            incremental_token_cache['group_delta_shards'] = delta_link
+            incremental_token_cache.invalidate('delta_link')
+        else:
+            logger.info(f"Saving graph delta token: ..{delta_link[-32:]}")
+            incremental_token_cache['delta_link'] = delta_link
+            incremental_token_cache.invalidate('group_delta_shards')
+        incremental_token_cache['users_delta_link'] = users_delta_link
         incremental_token_cache.flush()
 
     logger.info("Sync finished!")
@@ -1,26 +1,115 @@
+import itertools
 import logging
-import os
 import time
-from copy import deepcopy
-from typing import Any, Dict, List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Full, Queue
+from threading import Event, RLock
+from typing import (Any, ClassVar, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple, Union)
+from urllib.parse import quote
 
 import requests
-from azure.identity import DefaultAzureCredential, DeviceCodeCredential
+from databricks.labs.blueprint.parallel import ManyError, Threads
 from databricks.sdk.service import iam
 from pydantic import AliasChoices, BaseModel, Field
-from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from .graph_group_names import GroupNameCache
+from .graph_snapshot import GroupSnapshotStore
+from .graph_token import GraphTokenProvider
 from .persisted_cache import Cache
+from .rate_limit import RateLimitedAdapter, RateLimiter, parse_retry_after
 
 logger = logging.getLogger('sync.graph')
 
+# shared by all graph clients in the process, throttling is per tenant, not per client
+graph_rate_limiter = RateLimiter('graph')
+
+GROUP_MEMBERS_SELECT = "id,displayName,mail,mailNickname,appId,accountEnabled,mailEnabled,securityEnabled,userPrincipalName,userType"
+
+
+# https://stackoverflow.com/questions/312443/how-do-i-split-a-list-into-equally-sized-chunks/22045226#22045226
+def _chunks(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield list(lst[i:i + n])
+
+
+_REQUIRED = object()
+
+# setters of `BaseModel` slots, faster than `object.__setattr__` by name
+_set_dict = BaseModel.__dict__['__dict__'].__set__
+_set_fields_set = BaseModel.__dict__['__pydantic_fields_set__'].__set__
+_set_extra = BaseModel.__dict__['__pydantic_extra__'].__set__
+_set_private = BaseModel.__dict__['__pydantic_private__'].__set__
+
 
 class GraphBase(BaseModel):
     id: str
     display_name: str = Field(validation_alias=AliasChoices('displayName'))
     extra_data: Dict[str, Any] = Field(default_factory=lambda: {})
 
+    # (field name, graph attribute, fallback graph attribute as in `AliasChoices`, accepted type, default)
+    _graph_fields: ClassVar[List[tuple]] = [
+        ('id', 'id', None, str, _REQUIRED),
+        ('display_name', 'displayName', None, str, _REQUIRED),
+    ]
+    # (all fields in order of declaration with their defaults, fields with default factories, `_graph_fields`),
+    # kept in one attribute, as lookups of model class attributes are not cheap
+    _graph_spec: ClassVar[tuple] = None
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        cls._graph_spec = ({name: field.get_default()
+                            for name, field in cls.model_fields.items()},
+                           [(name, field.default_factory)
+                            for name, field in cls.model_fields.items() if field.default_factory],
+                           cls._graph_fields)
+
+    @classmethod
+    def from_graph(cls, data: dict):
+        """
+        Creates model from graph API payload, skipping validation when all the known attributes
+        have expected types. `None` values are treated as not set. Any other payload is validated
+        using `model_validate`, hence malformed payloads raise the same errors.
+        """
+        template, factories, graph_fields = cls._graph_spec
+        values = template.copy()
+        for name, factory in factories:
+            values[name] = factory()
+        fields_set = set()
+        get = data.get
+
+        for name, key, fallback_key, type_, default in graph_fields:
+            value = get(key)
+            if value is None and fallback_key:
+                value = get(fallback_key)
+
+            if value is None:
+                if default is _REQUIRED:
+                    return cls._validate_graph(data)
+            elif value.__class__ is type_:
+                values[name] = value
+                fields_set.add(name)
+            else:
+                return cls._validate_graph(data)
+
+        # same as `model_construct`, without per field checks of defaults
+        obj = object.__new__(cls)
+        _set_dict(obj, values)
+        _set_fields_set(obj, fields_set)
+        _set_extra(obj, None)
+        _set_private(obj, None)
+
+        return obj
+
+    @classmethod
+    def _validate_graph(cls, data: dict):
+        # remove any None values, without that aliases dont work well
+        return cls.model_validate({k: v for k, v in data.items() if v is not None})
+
 
 class GraphUser(GraphBase):
     mail: Optional[str] = Field(validation_alias=AliasChoices('mail', 'mailNickname'), default=None)
@@ -28,6 +117,13 @@ class GraphUser(GraphBase):
     user_principal_name: str = Field(validation_alias=AliasChoices('userPrincipalName'))
     user_type: Optional[str] = Field(validation_alias=AliasChoices('userType'), default=None)
 
+    _graph_fields: ClassVar[List[tuple]] = GraphBase._graph_fields + [
+        ('mail', 'mail', 'mailNickname', str, None),
+        ('active', 'accountEnabled', None, bool, True),
+        ('user_principal_name', 'userPrincipalName', None, str, _REQUIRED),
+        ('user_type', 'userType', None, str, None),
+    ]
+
     def to_sdk_user(self):
         user_name = self.mail if self.mail and self.user_type == 'Guest' else self.user_principal_name
         assert user_name
@@ -42,6 +138,11 @@ class GraphServicePrincipal(GraphBase):
     application_id: str = Field(validation_alias=AliasChoices('appId'))
     active: bool = Field(validation_alias=AliasChoices('accountEnabled'), default=True)
 
+    _graph_fields: ClassVar[List[tuple]] = GraphBase._graph_fields + [
+        ('application_id', 'appId', None, str, _REQUIRED),
+        ('active', 'accountEnabled', None, bool, True),
+    ]
+
     def to_sdk_service_principal(self):
         return iam.ServicePrincipal(application_id=self.application_id,
                                     display_name=self.display_name,
@@ -73,111 +174,669 @@ class GraphSyncObject(BaseModel):
 
 
 class GraphAPIClient:
+    # max number of requests in single JSON batch
+    _BATCH_SIZE = 20
+    _BATCH_MAX_ATTEMPTS = 6
+    # largest page size allowed by graph for members listing
+    _MEMBERS_PAGE_SIZE = 999
+    # groups with more members are downloaded as concurrent streams of users, service principals and groups
+    _TYPED_STREAMS_MIN_MEMBERS = 3 * _MEMBERS_PAGE_SIZE
+    _TYPED_STREAMS_TYPES = ['user', 'servicePrincipal', 'group']
+    # pages downloaded by typed streams ahead of the consumer, streams wait when it is slower
+    _TYPED_STREAMS_MAX_PAGES = 6
+    # max number of group ids in `$filter` of groups change feed
+    _DELTA_SHARD_SIZE = 50
+    # seconds between checks of membership of changed groups, in change feed verification mode
+    _CONSISTENCY_POLL_INTERVAL = 2
 
     def __init__(self,
                  include_mail_enabled_groups: bool = False,
-                 include_non_security_groups: bool = False):
+                 include_non_security_groups: bool = False,
+                 worker_threads: int = 10,
+                 base_url: str = "https://graph.microsoft.com/",
+                 batch_requests: bool = True,
+                 transitive_members: bool = False,
+                 group_snapshot: GroupSnapshotStore = None,
+                 token_provider: GraphTokenProvider = None,
+                 rate_limiter: RateLimiter = None,
+                 group_name_cache: GroupNameCache = None):
         self._tenant_id = None
+        # members of deep synced groups, used by incremental mode to apply membership changes,
+        # instead of downloading all members again
+        self._group_snapshot = group_snapshot
+        # groups resolved by name, so that names are not looked up on every run
+        self._group_name_cache = group_name_cache
+        self._batch_requests = batch_requests
+        self._transitive_members = transitive_members
 
         self._include_mail_enabled_groups = include_mail_enabled_groups
         self._include_non_security_groups = include_non_security_groups
 
+        # number of groups resolved concurrently at each search depth,
+        # keep it below pool_maxsize, otherwise workers just wait for free connection
+        self._worker_threads = max(1, int(worker_threads))
+
+        # throttling is handled by the rate limiter, shared by all the workers (and by default all clients),
+        # so that once graph says to back off, none of the workers keep on sending requests
+        self._rate_limiter = rate_limiter or graph_rate_limiter
+
         retry_strategy = Retry(
             total=6,
             backoff_factor=1,
-            status_forcelist=[429],
-            respect_retry_after_header=True,
+            status_forcelist=[],
+            respect_retry_after_header=False, # otherwise 429 would be retried by urllib3
             raise_on_status=False, # return original response when retries have been exhausted
         )
 
         self._session = requests.Session()
 
-        http_adapter = HTTPAdapter(max_retries=retry_strategy,
-                                   pool_connections=20,
-                                   pool_maxsize=20,
-                                   pool_block=True)
+        http_adapter = RateLimitedAdapter(self._rate_limiter,
+                                          max_retries=retry_strategy,
+                                          pool_connections=20,
+                                          pool_maxsize=20,
+                                          pool_block=True)
         self._session.mount("https://", http_adapter)
+        self._session.mount("http://", http_adapter)
 
-        # 15 Minutes
-        self._TOKEN_REFRESH_INTERVAL = 15 * 60
-
-        self._token = None
-        self._last_auth_time = None
-        self._base_url = None
+        # shared by all the workers, token is refreshed in the background before it expires
+        self._token_provider = token_provider or GraphTokenProvider()
+        self._base_url = base_url.rstrip('/')
 
         self._authenticate()
 
-    def _authenticate(self):
-        if os.environ.get('AZURE_CLIENT_ID') == 'DeviceCodeAuth' and os.environ.get(
-                'AZURE_CLIENT_SECRET') == 'DeviceCodeAuth':
-            logger.info("Using device authentication auth!")
-            credential = DeviceCodeCredential()
-        else:
-            credential = DefaultAzureCredential()
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._rate_limiter
 
-        self._token = credential.get_token('https://graph.microsoft.com/.default')
-        self._last_auth_time = time.time()
-        self._base_url = "https://graph.microsoft.com/"
+    def _authenticate(self):
+        # fail fast, when no credentials are available
+        self._token_provider.get_token()
 
     def _get_header(self):
-        # Check if 15 minutes have passed
-        elapsed_time = time.time() - self._last_auth_time
-        if elapsed_time >= self._TOKEN_REFRESH_INTERVAL:
-            logger.debug(f"Time since last auth: {elapsed_time}, getting a new token")
-            self._authenticate()
-        return {"Authorization": f"Bearer {self._token.token}"}
+        return {"Authorization": f"Bearer {self._token_provider.get_token()}"}
+
+    def _gather(self, name: str, tasks) -> List:
+        """runs tasks using worker threads, raises if any of them fails"""
+        results, errors = Threads.gather(name, tasks, num_threads=self._worker_threads)
+        if errors:
+            if len(errors) == 1:
+                raise errors[0]
+            raise ManyError(errors)
+
+        return results
+
+    def _batch(self,
+               version: str,
+               urls: List[str],
+               ignore_statuses=(),
+               request_headers: dict = None) -> List[dict]:
+        """
+        Sends GET requests using JSON batching, in envelopes of `_BATCH_SIZE` requests each.
+        Envelopes are sent concurrently, throttled (429) requests are retried individually.
+        https://learn.microsoft.com/en-us/graph/json-batching
+
+        :param version: graph api version, all urls are relative to it
+        :param urls: relative urls, for example `/groups/{id}/members`
+        :param ignore_statuses: error statuses returned as responses, instead of raising
+        :param request_headers: headers of each of the requests
+        :return: list of responses (dicts with `status`, `headers` and `body`), in order of `urls`
+        """
+        chunks = list(_chunks(list(enumerate(urls)), self._BATCH_SIZE))
+        tasks = [
+            partial(self._send_batch_envelope, version, chunk, ignore_statuses, request_headers)
+            for chunk in chunks
+        ]
+
+        responses = {}
+        for r in self._gather("graph_batch", tasks):
+            responses.update(r)
+
+        return [responses[idx] for idx in range(len(urls))]
+
+    def _send_batch_envelope(self,
+                             version: str,
+                             requests_chunk: List,
+                             ignore_statuses=(),
+                             request_headers: dict = None) -> Dict[int, dict]:
+        pending = dict(requests_chunk)
+        responses = {}
+
+        for attempt in range(self._BATCH_MAX_ATTEMPTS):
+            res = self._session.post(
+                f"{self._base_url}/{version}/$batch",
+                json={
+                    'requests': [{
+                        'id': str(idx),
+                        'method': 'GET',
+                        'url': url,
+                        **({
+                            'headers': request_headers
+                        } if request_headers else {})
+                    } for idx, url in pending.items()]
+                },
+                headers=self._get_header())
 
-    def get_group_by_name(self, name: str) -> dict:
-        res = self._session.get(
-            f"https://graph.microsoft.com/v1.0/groups?$filter=displayName eq '{name}'&$select=id,displayName,mailEnabled,securityEnabled",
-            headers=self._get_header())
+            res.raise_for_status()
+
+            retry_after = 0
+            for r in res.json().get('responses', []):
+                idx = int(r['id'])
+                status = int(r['status'])
+
+                if status == 429:
+                    headers = {k.lower(): v for k, v in (r.get('headers') or {}).items()}
+                    retry_after = max(retry_after, parse_retry_after(headers.get('retry-after'), float(2**attempt)))
+                    continue
+
+                if status >= 400 and status not in ignore_statuses:
+                    raise requests.HTTPError(f"{status} Error for batch request: {pending[idx]}: {r.get('body')}")
+
+                responses[idx] = r
+                pending.pop(idx)
+
+            if not pending:
+                return responses
 
+            # next attempt, as any other request, waits for the pause to end
+            logger.warning(f"Batch requests throttled: count={len(pending)}, retrying in {retry_after} second(s)")
+            self._rate_limiter.on_throttled(retry_after)
+
+        raise requests.HTTPError(f"429 Error for batch requests, retries exhausted: {list(pending.values())}")
+
+    def _get_json(self, query: str) -> dict:
+        res = self._session.get(query, headers=self._get_header())
         res.raise_for_status()
+        return res.json()
+
+    def _iter_pages(self, query: str, page: dict = None) -> Iterator[List[dict]]:
+        """
+        yields values of `query` and all pages after it, page by page, if `page` is provided, it's used as first page.
+        Next page is downloaded in the background, while the current one is being processed.
+        """
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='graph_next_page') as executor:
+            next_page = executor.submit(self._get_json, query) if page is None and query else None
+
+            while page is not None or next_page is not None:
+                if page is None:
+                    page = next_page.result()
+
+                query = page.get('@odata.nextLink')
+                next_page = executor.submit(self._get_json, query) if query else None
+
+                yield page.get("value") or []
+                page = None
+
+    def _get_pages(self, query: str, page: dict = None) -> List[dict]:
+        """downloads `query` and all pages after it, if `page` is provided, it's used as first page"""
+        return list(itertools.chain.from_iterable(self._iter_pages(query, page)))
+
+    def _get_pages_batched(self, version: str, urls: List[str]) -> List[List[dict]]:
+        """
+        downloads all pages of many `urls` (relative to `version`), first pages are downloaded using batches,
+        the remaining pages are downloaded concurrently by the workers
+        """
+        if self._batch_requests:
+            first_pages = [r['body'] for r in self._batch(version, urls)]
+        else:
+            first_pages = [None] * len(urls)
+
+        def _get_all(idx):
+            query = None if first_pages[idx] else f"{self._base_url}/{version}{urls[idx]}"
+            return idx, self._get_pages(query, first_pages[idx])
+
+        results = dict(self._gather("graph_pages", [partial(_get_all, idx) for idx in range(len(urls))]))
+
+        return [results[idx] for idx in range(len(urls))]
+
+    def _is_group_included(self, group_info: dict) -> bool:
+        # https://learn.microsoft.com/en-us/graph/api/resources/groups-overview?view=graph-rest-1.0&tabs=http#group-types-in-microsoft-entra-id-and-microsoft-graph
+        return bool((group_info.get('securityEnabled') or self._include_non_security_groups) and
+                    ((not group_info.get('mailEnabled')) or self._include_mail_enabled_groups))
 
-        data = res.json().get("value")
+    def _is_resolved(self, data: List[dict]) -> bool:
+        return bool(data and len(data) == 1 and self._is_group_included(data[0]))
 
+    def _filter_group_info(self, name: str, data: List[dict]) -> dict:
         if data and len(data) == 1:
             group_info = data[0]
-            # https://learn.microsoft.com/en-us/graph/api/resources/groups-overview?view=graph-rest-1.0&tabs=http#group-types-in-microsoft-entra-id-and-microsoft-graph
-            if (
-                (group_info.get('securityEnabled') or self._include_non_security_groups) and
-                ((not group_info.get('mailEnabled')) or self._include_mail_enabled_groups)
-            ):
+            if self._is_group_included(group_info):
                 return group_info
 
             logger.warning(f"Skipping group '{name}': {data}")
 
         return None
 
-    def get_group_members(
+    @staticmethod
+    def _group_by_name_url(name: str) -> str:
+        # single quotes are escaped by doubling them, rest of special characters (&, #, etc.) are url encoded
+        name = quote(name.replace("'", "''"), safe='')
+        return f"/groups?$filter=displayName eq '{name}'&$select=id,displayName,mailEnabled,securityEnabled"
+
+    def _get_cached_groups(self, name: str) -> List[dict]:
+        if self._group_name_cache is None:
+            return None
+
+        return self._group_name_cache.get_groups(name, self._is_resolved)
+
+    def _set_cached_groups(self, name: str, data: List[dict]):
+        if self._group_name_cache is not None:
+            self._group_name_cache.set_groups(name, data or [])
+
+    def get_group_by_name(self, name: str) -> dict:
+        data = self._get_cached_groups(name)
+        if data is None:
+            res = self._session.get(f"{self._base_url}/v1.0{self._group_by_name_url(name)}",
+                                    headers=self._get_header())
+
+            res.raise_for_status()
+
+            data = res.json().get("value")
+            self._set_cached_groups(name, data)
+
+        return self._filter_group_info(name, data)
+
+    def get_groups_by_name(self, names: List[str]) -> Dict[str, dict]:
+        """batched version of `get_group_by_name`, returns dict of name -> group info (or None)"""
+        results = {name: self._get_cached_groups(name) for name in names}
+        missing = [name for name, data in results.items() if data is None]
+        if missing:
+            responses = self._batch("v1.0", [self._group_by_name_url(name) for name in missing])
+            for name, r in zip(missing, responses):
+                results[name] = r['body'].get("value")
+                self._set_cached_groups(name, results[name])
+
+        if self._group_name_cache is not None:
+            logger.debug(f"Group name cache: hits={len(results) - len(missing)}, misses={len(missing)}")
+
+        return {name: self._filter_group_info(name, data) for name, data in results.items()}
+
+    def _group_members_url(self, group_id: str, select: str) -> str:
+        return f"/groups/{group_id}/members?$select={select}&$top={self._MEMBERS_PAGE_SIZE}"
+
+    def get_group_members_count(self, group_id: str) -> int:
+        # https://learn.microsoft.com/en-us/graph/aad-advanced-queries#count-of-directory-objects
+        res = self._session.get(f"{self._base_url}/v1.0/groups/{group_id}/members/$count",
+                                headers={
+                                    **self._get_header(), 'ConsistencyLevel': 'eventual'
+                                })
+        res.raise_for_status()
+        return int(res.text)
+
+    def get_group_members(self,
+                          group_id: str,
+                          select=GROUP_MEMBERS_SELECT,
+                          first_page: dict = None) -> Iterator[dict]:
+        """
+        yields members of a group, page by page as they are downloaded, without keeping all of them in memory
+
+        Groups with more than one page of members, and at least `_TYPED_STREAMS_MIN_MEMBERS` members
+        (according to `$count`), are downloaded as concurrent streams of users, service principals and groups,
+        other types of members (i.e. devices or contacts) are not downloaded then.
+
+        :param first_page: already downloaded first page of members, i.e. from `get_groups_members_first_page`
+        """
+        if first_page is None:
+            first_page = self._get_json(f"{self._base_url}/beta{self._group_members_url(group_id, select)}")
+
+        if first_page.get('@odata.nextLink'):
+            # count of members is downloaded with the first page, when it was batched
+            members_count = first_page.get('@odata.count')
+            if members_count is None:
+                members_count = self.get_group_members_count(group_id)
+        else:
+            members_count = 0
+
+        if members_count >= self._TYPED_STREAMS_MIN_MEMBERS:
+            first_members = first_page.get('value') or []
+            yield from first_members
+            yield from self._iter_typed_group_members(group_id, select, {m['id'] for m in first_members})
+            return
+
+        for values in self._iter_pages(None, first_page):
+            yield from values
+
+    def _iter_typed_group_members(self, group_id: str, select: str, skip_ids: Set[str]) -> Iterator[dict]:
+        """yields members of a group, downloaded using concurrent streams of each type of `_TYPED_STREAMS_TYPES`"""
+        pages = Queue(maxsize=self._TYPED_STREAMS_MAX_PAGES)
+        stop = Event()
+
+        def _put(values) -> bool:
+            """waits for free space in `pages`, :return: False when the consumer stopped"""
+            while not stop.is_set():
+                try:
+                    pages.put(values, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def _stream(member_type: str):
+            try:
+                url = self._group_members_url(group_id, select).replace('/members?',
+                                                                        f"/members/microsoft.graph.{member_type}?")
+                for values in self._iter_pages(f"{self._base_url}/beta{url}"):
+                    for m in values:
+                        # type cast members may not have the type
+                        m.setdefault('@odata.type', f"#microsoft.graph.{member_type}")
+                    if not _put(values):
+                        break
+            finally:
+                _put(None)
+
+        logger.info(f"Downloading members of group id={group_id} using {len(self._TYPED_STREAMS_TYPES)} streams")
+        with ThreadPoolExecutor(max_workers=len(self._TYPED_STREAMS_TYPES),
+                                thread_name_prefix='graph_members_stream') as executor:
+            streams = [executor.submit(_stream, x) for x in self._TYPED_STREAMS_TYPES]
+            try:
+                pending = len(streams)
+                while pending:
+                    values = pages.get()
+                    if values is None:
+                        pending -= 1
+                        continue
+
+                    yield from (m for m in values if m['id'] not in skip_ids)
+            finally:
+                stop.set()
+
+            # errors of the streams are raised, once all of them are done
+            for x in streams:
+                x.result()
+
+    def get_groups_members_first_page(self, group_ids: List[str], select=GROUP_MEMBERS_SELECT) -> Dict[str, dict]:
+        """batch downloads first page of members of each group, returns dict of group id -> page"""
+        group_ids = list(group_ids)
+        responses = self._batch("beta", [self._group_members_url(group_id, select) for group_id in group_ids])
+        pages = {group_id: r['body'] for group_id, r in zip(group_ids, responses)}
+
+        # groups with more pages are downloaded as typed streams, when large enough, see `get_group_members`,
+        # their members count is batched as well, and kept in the first page
+        multi_page_ids = [x for x, page in pages.items() if page.get('@odata.nextLink')]
+        if multi_page_ids:
+            # https://learn.microsoft.com/en-us/graph/aad-advanced-queries#count-of-directory-objects
+            counts = self._batch("v1.0",
+                                 [f"/groups/{x}/members?$count=true&$select=id&$top=1" for x in multi_page_ids],
+                                 request_headers={'ConsistencyLevel': 'eventual'})
+            for group_id, r in zip(multi_page_ids, counts):
+                pages[group_id]['@odata.count'] = r['body']['@odata.count']
+
+        return pages
+
+    def get_transitive_group_members(
             self,
-            group_id: str,
-            select="id,displayName,mail,mailNickname,appId,accountEnabled,mailEnabled,securityEnabled,userPrincipalName,userType"
-    ) -> dict:
-        members = []
-        query = f"{self._base_url}/beta/groups/{group_id}/members?$select={select}"
+            group_names,
+            group_search_depth: int,
+            known_groups: Dict[str, Tuple[dict, List[dict]]] = None) -> Tuple[List[List[dict]], Dict[str, List[dict]]]:
+        """
+        Finds groups to deep sync, using `transitiveMembers` of the requested groups.
+        Instead of resolving every discovered child group by name at each search depth,
+        all nested groups are found with one query per requested group. Members are then downloaded level by
+        level, visiting each group at most once, only of groups within `group_search_depth`.
+
+        :param known_groups: group id -> (group info, members) of requested groups, that are not downloaded
+        :return: group infos of groups to deep sync grouped by search depth, and their members by group id
+        """
+        known_groups = known_groups or {}
+        known_names = {info['displayName'] for info, _ in known_groups.values()}
+        root_names = sorted(set(group_names) - known_names)
+        if self._batch_requests:
+            roots = self.get_groups_by_name(root_names)
+        else:
+            roots = {name: self.get_group_by_name(name) for name in root_names}
+
+        for name, info in roots.items():
+            if not info:
+                logger.warning(f"Group not found, skipping: {name}")
+
+        group_infos = {info['id']: info for info in roots.values() if info}
+        group_infos.update({group_id: info for group_id, (info, _) in known_groups.items()})
+        root_ids = list(group_infos.keys())
+
+        logger.info(f"Downloading transitive group members of {len(root_ids)} group(s)")
+        nested = self._get_pages_batched("v1.0", [
+            f"/groups/{x}/transitiveMembers/microsoft.graph.group?$select=id,displayName,mailEnabled,securityEnabled"
+            for x in root_ids
+        ])
+        for g in itertools.chain.from_iterable(nested):
+            if self._is_group_included(g):
+                group_infos.setdefault(g['id'], g)
+
+        # search depth is applied level by level, members of each level are downloaded at once, and their
+        # members, that are groups, are the next level
+        levels = []
+        group_members = {}
+        visited: Set[str] = set()
+        level_ids = root_ids
+        for _ in range(group_search_depth):
+            level_ids = [x for x in dict.fromkeys(level_ids) if x not in visited]
+            if not level_ids:
+                break
+
+            visited.update(level_ids)
+            levels.append([group_infos[x] for x in level_ids])
+
+            group_ids = [x for x in level_ids if x not in known_groups]
+            logger.info(f"Downloading members of {len(group_ids)} group(s) at search depth {len(levels)}")
+            group_members.update(
+                zip(group_ids,
+                    self._get_pages_batched("beta",
+                                            [self._group_members_url(x, GROUP_MEMBERS_SELECT) for x in group_ids])))
+            group_members.update({x: known_groups[x][1] for x in level_ids if x in known_groups})
+
+            level_ids = [
+                m['id'] for x in level_ids for m in group_members[x]
+                if m.get('@odata.type') == '#microsoft.graph.group' and m['id'] in group_infos
+            ]
+
+        return levels, group_members
+
+    def get_directory_objects(self, ids: List[str], select=GROUP_MEMBERS_SELECT) -> Dict[str, dict]:
+        """downloads users, service principals or groups by their ids, objects that do not exist are skipped"""
+        ids = list(ids)
+        responses = self._get_each("beta", [f"/directoryObjects/{x}?$select={select}" for x in ids])
+
+        return {x: r['body'] for x, r in zip(ids, responses) if r['status'] != 404}
+
+    def _get_each(self, version: str, urls: List[str]) -> List[dict]:
+        """
+        sends GET request of each of `urls` (relative to `version`), using batches when enabled
+
+        :return: list of responses (dicts with `status` and `body`), in order of `urls`, not found (404) included
+        """
+        if self._batch_requests:
+            return self._batch(version, urls, ignore_statuses=(404, ))
+
+        def _get(idx):
+            res = self._session.get(f"{self._base_url}/{version}{urls[idx]}", headers=self._get_header())
+            if res.status_code != 404:
+                res.raise_for_status()
+            return idx, {'status': res.status_code, 'body': res.json()}
+
+        results = dict(self._gather("graph_get_each", [partial(_get, idx) for idx in range(len(urls))]))
+        return [results[idx] for idx in range(len(urls))]
+
+    def _apply_member_deltas(self, group_deltas: Dict[str, dict]) -> Dict[str, Tuple[dict, List[dict]]]:
+        """
+        applies `members@delta` changes to snapshots of groups, only added members are downloaded
+
+        :param group_deltas: group id -> {'added': set of member ids, 'removed': set of member ids}
+        :return: group id -> (group info, members)
+        """
+        snapshots = {group_id: self._group_snapshot.get(group_id) for group_id in group_deltas}
+        added_ids = set()
+        for group_id, delta in group_deltas.items():
+            added_ids.update(delta['added'] - self._group_snapshot.member_ids(group_id))
+
+        logger.info(f"Incremental mode: downloading {len(added_ids)} new group member(s)")
+        added = self.get_directory_objects(sorted(added_ids))
+
+        ret = {}
+        for group_id, delta in group_deltas.items():
+            snapshot = snapshots[group_id]
+            members = {m['id']: m for m in snapshot['members'] if m['id'] not in delta['removed']}
+            for member_id in delta['added']:
+                if member_id not in members and member_id in added:
+                    members[member_id] = added[member_id]
+
+            logger.info(f"Incremental mode: group members change: {snapshot['group']['displayName']}: "
+                        f"added={len(delta['added'])}, removed={len(delta['removed'])}")
+            ret[group_id] = (snapshot['group'], list(members.values()))
+
+        return ret
+
+    def _read_delta(self, query: str, latest_query: str, keep=None) -> Tuple[str, List[dict], bool]:
+        """
+        reads all pages of a change feed, starting at `query`, when delta token expired `latest_query` is used instead
+
+        :param keep: filter of changed entries, by default all of them are kept
+        :return: new delta link, changed entries, and flag telling if delta token has expired
+        """
+        entries = []
+        expired = False
+        delta_link = None
 
         while query:
-            res = self._session.get(query, headers=self._get_header())
+            r = self._session.get(query, headers=self._get_header())
 
-            res.raise_for_status()
+            # https://learn.microsoft.com/en-us/graph/delta-query-overview#synchronization-reset
+            if r.status_code == 410 and query != latest_query:
+                expired = True
+                entries = []
+                query = latest_query
+                continue
+
+            r.raise_for_status()
+            j = r.json()
+            next_link = j.get('@odata.nextLink')
+            delta_link = j.get('@odata.deltaLink')
+
+            query = next_link
 
-            j = res.json()
-            query = j.get('@odata.nextLink')
-            value = j.get("value")
-            if value:
-                members.extend(value)
+            if not next_link and not delta_link:
+                raise RuntimeError("delta_link is empty")
 
-        return members
+            entries.extend(x for x in j.get('value', []) if keep is None or keep(x))
+
+        return delta_link, entries, expired
+
+    def _groups_delta_query(self, group_ids: List[str] = None) -> str:
+        # $deltatoken=latest, is "sync from now mode"
+        # effectively it is imediately giving delta token, without need of paganation of all AAD state
+        # docs: https://learn.microsoft.com/en-us/graph/delta-query-overview#use-delta-query-to-track-changes-in-a-resource-collection
+        query = (f"{self._base_url}/v1.0/groups/delta/?$select=members,id,displayName,mailEnabled,securityEnabled"
+                 "&$deltatoken=latest")
+        if group_ids:
+            # https://learn.microsoft.com/en-us/graph/api/group-delta?view=graph-rest-1.0&tabs=http#optional-query-parameters
+            query += "&$filter=" + quote(" or ".join(f"id eq '{x}'" for x in group_ids), safe="'")
+
+        return query
+
+    def _start_delta_shards(self, group_ids) -> List[dict]:
+        """starts tracking changes of groups, in shards of up to `_DELTA_SHARD_SIZE` groups, each with own delta link"""
+
+        def _start(ids: List[str]):
+            query = self._groups_delta_query(ids)
+            delta_link, _, _ = self._read_delta(query, query)
+            return {'ids': ids, 'delta_link': delta_link}
+
+        chunks = list(_chunks(sorted(group_ids), self._DELTA_SHARD_SIZE))
+        if chunks:
+            logger.info(f"Incremental mode: tracking changes of {len(group_ids)} new group(s)")
+
+        return self._gather("graph_group_delta_start", [partial(_start, ids) for ids in chunks])
+
+    def _read_delta_shards(self, shards: List[dict], keep) -> Tuple[List[dict], List[dict], List[str]]:
+        """
+        reads change feeds of all the shards concurrently
+
+        :return: shards with new delta links, changed entries, and ids of groups in shards with expired delta token
+        """
+
+        def _read(shard: dict):
+            latest_query = self._groups_delta_query(shard['ids'])
+            delta_link, entries, expired = self._read_delta(shard['delta_link'], latest_query, keep)
+            return {'ids': shard['ids'], 'delta_link': delta_link}, entries, expired
+
+        results = self._gather("graph_group_delta", [partial(_read, shard) for shard in shards])
+
+        new_shards, entries, expired_ids = [], [], []
+        for shard, shard_entries, expired in results:
+            new_shards.append(shard)
+            entries.extend(shard_entries)
+            if expired:
+                expired_ids.extend(shard['ids'])
+
+        return new_shards, entries, expired_ids
+
+    def _wait_for_consistency(self, group_deltas: Dict[str, dict], timeout: float) -> bool:
+        """
+        polls members of changed groups, that were added or removed by the change feed, one by one,
+        until members added (removed) by the change feed are (not) there
+
+        :param group_deltas: group id -> {'name': group name, 'added': set of member ids, 'removed': set of member ids}
+        :param timeout: max time in seconds to wait for
+        :return: True if all the groups are consistent with the change feed
+        """
+        deadline = time.monotonic() + timeout
+        pending = dict(group_deltas)
+
+        logger.info(f"Waiting up to {timeout} second(s) for membership of {len(pending)} changed group(s)...")
+        while True:
+            # (group id, member id, member is expected to be there)
+            checks = [(group_id, member_id, expected)
+                      for group_id, delta in pending.items()
+                      for expected in [True, False]
+                      for member_id in sorted(delta['added' if expected else 'removed'])]
+            responses = self._get_each("v1.0",
+                                       [f"/groups/{group_id}/members/{member_id}?$select=id"
+                                        for group_id, member_id, _ in checks])
+            inconsistent = {group_id for (group_id, _, expected), r in zip(checks, responses)
+                            if (r['status'] != 404) != expected}
+            for group_id in list(pending):
+                if group_id not in inconsistent:
+                    pending.pop(group_id)
+
+            time_left = deadline - time.monotonic()
+            if not pending or time_left <= 0:
+                break
+
+            time.sleep(min(self._CONSISTENCY_POLL_INTERVAL, time_left))
+
+        if pending:
+            logger.warning(f"Incremental mode: membership not consistent with change feed after {timeout} second(s): "
+                           f"{sorted(x['name'] for x in pending.values())}")
+            return False
+
+        logger.info("Incremental mode: membership of changed groups is consistent with change feed")
+        return True
 
     def get_objects_for_sync_incremental(self,
-                                         delta_link: str,
+                                         delta_link: Union[str, List[dict]],
                                          group_names,
                                          group_search_depth: int = 1,
-                                         graph_change_feed_grace_time: int = 30):
+                                         graph_change_feed_grace_time: int = 30,
+                                         graph_change_feed_verify: bool = False):
+        """
+        Downloads groups that changed since `delta_link` was issued, and requested groups that were never synced.
+
+        Members endpoints can lag behind the change feed, hence before changed groups are downloaded in full,
+        it waits `graph_change_feed_grace_time` seconds, or in verification mode, at most that long,
+        until members reported by the change feed are visible.
+        Groups with changes applied to the snapshot, and groups downloaded for other reasons, do not wait.
+
+        When group snapshot is available, only changes of the synced groups are read, using `$filter` by group id,
+        ids are sharded across many delta links, of up to `_DELTA_SHARD_SIZE` groups each.
+        Otherwise changes of all groups in the tenant are read, and filtered by name.
+
+        :param delta_link: delta link of the change feed of all groups in the tenant,
+                           or list of shards `{'ids': [group ids], 'delta_link': delta link}`
+        :param graph_change_feed_verify: poll membership of changed groups, instead of waiting for the grace time
+        :return: new delta link (list of shards, when group snapshot is available), and objects to sync
+        """
         cached_group_names = set(Cache(path='cache_group.json').keys())
         group_names = set(group_names or [])
         new_group_names = group_names.difference(cached_group_names)
+        scoped = self._group_snapshot is not None
 
         to_sync_groups: Set[str] = set()
 
@@ -185,147 +844,338 @@ class GraphAPIClient:
         logger.debug(f"Incremental mode: requested groups : {sorted(group_names)}")
         logger.debug(f"Incremental mode: new groups       : {sorted(new_group_names)}")
 
+        def _group_name(g: dict) -> str:
+            snapshot_info = self._group_snapshot.get_group_info(g['id']) if scoped else None
+            return g.get('displayName') or (snapshot_info['displayName'] if snapshot_info else None)
+
+        def _keep(g: dict) -> bool:
+            # renamed or deleted groups are resolved by name again
+            if self._group_name_cache is not None:
+                self._group_name_cache.on_group_change(g)
+
+            return '@removed' not in g and _group_name(g) in cached_group_names
+
+        shards: List[dict] = []
+        entries: List[dict] = []
+        full_download = not delta_link
+
         if not delta_link:
             logger.warning("Incremental mode: initial run detected: downloading all whitelisted groups")
+            if not scoped:
+                delta_link, _, _ = self._read_delta(self._groups_delta_query(), self._groups_delta_query())
+        elif isinstance(delta_link, str):
+            # delta links of not scoped change feeds are still read, so that no changes are lost after an upgrade
+            logger.info(f"Incremental mode: delta token: ..{delta_link[-32:]}")
+            delta_link, entries, full_download = self._read_delta(delta_link, self._groups_delta_query(), _keep)
+            if full_download:
+                logger.warning("Incremental mode: delta token expired: downloading all whitelisted groups")
+        elif not scoped:
+            logger.warning("Incremental mode: group snapshot is not available: downloading all whitelisted groups")
+            full_download = True
+            delta_link, _, _ = self._read_delta(self._groups_delta_query(), self._groups_delta_query())
+        else:
+            logger.info(f"Incremental mode: reading changes of {sum(len(x['ids']) for x in delta_link)} group(s) "
+                        f"in {len(delta_link)} shard(s)")
+            shards, entries, expired_ids = self._read_delta_shards(delta_link, _keep)
+            for group_id in expired_ids:
+                name = _group_name({'id': group_id})
+                if name in cached_group_names:
+                    logger.warning(f"Incremental mode: delta token expired: downloading group: {name}")
+                    to_sync_groups.add(name)
+
+        if full_download:
             to_sync_groups.update(cached_group_names)
             to_sync_groups.update(group_names)
-            # $deltatoken=latest, is "sync from now mode"
-            # effectively it is imediately giving delta token, without need of paganation of all AAD state
-            # docs: https://learn.microsoft.com/en-us/graph/delta-query-overview#use-delta-query-to-track-changes-in-a-resource-collection
-            query = f"{self._base_url}/v1.0/groups/delta/?$select=members,id,displayName&$deltatoken=latest"
         else:
-            logger.info(f"Incremental mode: delta token: ..{delta_link[-32:]}")
-            query = delta_link
-
             for g in new_group_names:
                 logger.info(f"Incremental mode: new group sync: {g}")
                 to_sync_groups.add(g)
 
-        while query:
-            r = self._session.get(query, headers=self._get_header())
-            r.raise_for_status()
-            j = r.json()
-            next_link = j.get('@odata.nextLink')
-            delta_link = j.get('@odata.deltaLink')
+        # group id -> name, and members added or removed since last run
+        group_deltas: Dict[str, dict] = {}
+
+        for g in entries:
+            delta = group_deltas.setdefault(g['id'], {'name': _group_name(g), 'added': set(), 'removed': set()})
+
+            # same group can be reported many times, last change of a member wins
+            for m in g.get('members@delta', []):
+                if '@removed' in m:
+                    delta['added'].discard(m['id'])
+                    delta['removed'].add(m['id'])
+                else:
+                    delta['removed'].discard(m['id'])
+                    delta['added'].add(m['id'])
+
+        # groups that were synced before, have their changes applied to the snapshot,
+        # other groups are downloaded in full, once members endpoint catches up with the change feed
+        changed_groups: Dict[str, dict] = {}
+        for group_id, delta in list(group_deltas.items()):
+            name = delta['name']
+            snapshot_info = self._group_snapshot.get_group_info(group_id) if scoped else None
+            if name in to_sync_groups or not snapshot_info:
+                changed_groups[group_id] = group_deltas.pop(group_id)
+                if name not in to_sync_groups:
+                    logger.info(f"Incremental mode: group change: {name}")
+                    to_sync_groups.add(name)
+            else:
+                logger.info(f"Incremental mode: group change (members delta): {name}")
 
-            query = next_link
+        known_groups = self._apply_member_deltas(group_deltas) if group_deltas else {}
 
-            if not next_link and not delta_link:
-                raise RuntimeError("delta_link is empty")
+        if scoped:
+            self._group_snapshot.evict(cached_group_names | group_names)
 
-            for g in j.get('value', []):
-                name = g.get('displayName')
-                if name and (name not in to_sync_groups) and (name in cached_group_names):
-                    logger.info(f"Incremental mode: group change: {name}")
-                    to_sync_groups.add(name)
+            # changes of all whitelisted groups are tracked from now on, before they are downloaded,
+            # ids of groups missing in the snapshot are resolved by name, shards with none of them are dropped
+            tracked_ids = set(self._group_snapshot.keys())
+            snapshot_names = {self._group_snapshot.get_group_info(x)['displayName'] for x in tracked_ids}
+            unknown_names = sorted((cached_group_names | group_names) - snapshot_names)
+            if unknown_names:
+                tracked_ids.update(info['id'] for info in self.get_groups_by_name(unknown_names).values() if info)
+
+            shards = [x for x in shards if not tracked_ids.isdisjoint(x['ids'])]
+            shards.extend(self._start_delta_shards(tracked_ids - {x for shard in shards for x in shard['ids']}))
+
+        if not changed_groups:
+            logger.info("Incremental mode: no changed groups to download, skipping grace time")
+        elif graph_change_feed_verify:
+            self._wait_for_consistency(changed_groups, graph_change_feed_grace_time)
+        else:
+            logger.info(f"Waiting {graph_change_feed_grace_time} second(s) for graph API to stabilize...")
+            time.sleep(graph_change_feed_grace_time)
 
-        logger.info(f"Waiting {graph_change_feed_grace_time} second(s) for graph API to stabilize...")
-        time.sleep(graph_change_feed_grace_time)
         sync_obj = self.get_objects_for_sync(group_names=to_sync_groups,
-                                             group_search_depth=group_search_depth)
+                                             group_search_depth=group_search_depth,
+                                             known_groups=known_groups)
+
+        if scoped:
+            # nested groups found during the download are tracked from the end of it,
+            # hence their changes made during the download are picked up only with their next change
+            tracked_ids = set(self._group_snapshot.keys())
+            shards.extend(self._start_delta_shards(tracked_ids - {x for shard in shards for x in shard['ids']}))
+            return shards, sync_obj
+
         return delta_link, sync_obj
 
-    def get_objects_for_sync(self, group_names, group_search_depth: int = 1):
+    def get_changed_users(self, delta_link: str) -> Tuple[str, List[GraphUser]]:
+        """
+        Uses users change feed to find users, that are already synced (are in the user cache, or are members of
+        groups in the snapshot), and which changed since `delta_link` was issued.
+        Changed users are downloaded, but not their group membership.
+
+        :return: new delta link, and changed users
+        """
+        cached_user_names = set(Cache(path='cache_user.json').keys())
+
+        # only changes of selected attributes are reported
+        select = "id,displayName,mail,mailNickname,accountEnabled,userPrincipalName,userType"
+        latest_query = f"{self._base_url}/v1.0/users/delta/?$select={select}&$deltatoken=latest"
+
+        if not delta_link:
+            logger.info("Users change feed: initial run detected, changes will be tracked from now on")
+        else:
+            logger.info(f"Users change feed: delta token: ..{delta_link[-32:]}")
+
+        # updated users may have only changed attributes present,
+        # hence users are matched either by name, or by id of members in the snapshot
+        def _keep(u: dict) -> bool:
+            return '@removed' not in u and (
+                (self._group_snapshot is not None and self._group_snapshot.get_principal(u['id']) is not None) or
+                u.get('userPrincipalName') in cached_user_names or u.get('mail') in cached_user_names)
+
+        delta_link, entries, expired = self._read_delta(delta_link or latest_query, latest_query, _keep)
+        if expired:
+            logger.warning("Users change feed: delta token expired, changes will be tracked from now on, "
+                           "run with --full-sync to sync all users")
+
+        changed_ids = {u['id'] for u in entries}
+
+        logger.info(f"Users change feed: downloading {len(changed_ids)} changed user(s)")
+        users = [u for u in self.get_directory_objects(sorted(changed_ids)).values()
+                 if u.get('@odata.type') == '#microsoft.graph.user']
+
+        if self._group_snapshot is not None:
+            self._group_snapshot.update_principals(users)
+            self._group_snapshot.flush()
+
+        changed_users = []
+        for u in users:
+            user = GraphUser.from_graph(u)
+            if user.to_sdk_user().user_name in cached_user_names:
+                logger.info(f"Users change feed: user change: {user.user_principal_name}")
+                changed_users.append(user)
+
+        return delta_link, changed_users
+
+    def get_objects_for_sync(self,
+                             group_names,
+                             group_search_depth: int = 1,
+                             known_groups: Dict[str, Tuple[dict, List[dict]]] = None):
+        """
+        Downloads requested groups, their members, and nested groups (up to `group_search_depth`).
+
+        :param known_groups: group id -> (group info, members) of groups to deep sync without downloading them,
+                             their child groups are searched as if they were downloaded at first search depth
+        """
         sync_data = GraphSyncObject()
         group_search_depth = int(group_search_depth)
 
+        # groups of the same search depth are downloaded by concurrent workers,
+        # registration has to be atomic, so that each object is validated and stored exactly once
+        lock = RLock()
+
         def _register_user(d):
             id = d['id']
-            if id not in sync_data.users:
-                try:
-                    obj = GraphUser.model_validate(d)
-                    sync_data.users[id] = obj
-                    logger.debug(f"Downloaded GraphUser: {obj}")
-                except Exception as e:
-                    logger.error(f"Invalid GraphUser: {d}", exc_info=e)
-                    raise e
-
-            return sync_data.users[id]
+            with lock:
+                if id not in sync_data.users:
+                    try:
+                        obj = GraphUser.from_graph(d)
+                        sync_data.users[id] = obj
+                        logger.debug(f"Downloaded GraphUser: {obj}")
+                    except Exception as e:
+                        logger.error(f"Invalid GraphUser: {d}", exc_info=e)
+                        raise e
+
+                return sync_data.users[id]
 
         def _register_service_principal(d):
             id = d['id']
-            if id not in sync_data.service_principals:
-                try:
-                    obj = GraphServicePrincipal.model_validate(d)
-                    sync_data.service_principals[id] = obj
-                    logger.debug(f"Downloaded GraphServicePrincipal: {obj}")
-                except Exception as e:
-                    logger.error(f"Invalid GraphServicePrincipal: {d}", exc_info=e)
-                    raise e
-
-            return sync_data.service_principals[id]
+            with lock:
+                if id not in sync_data.service_principals:
+                    try:
+                        obj = GraphServicePrincipal.from_graph(d)
+                        sync_data.service_principals[id] = obj
+                        logger.debug(f"Downloaded GraphServicePrincipal: {obj}")
+                    except Exception as e:
+                        logger.error(f"Invalid GraphServicePrincipal: {d}", exc_info=e)
+                        raise e
+
+                return sync_data.service_principals[id]
 
         def _register_group(d):
             id = d['id']
-            if id not in sync_data.groups:
-                try:
-                    if (
-                        (d.get('securityEnabled') or self._include_non_security_groups) and
-                        ((not d.get('mailEnabled')) or self._include_mail_enabled_groups)
-                    ):
-                        obj = GraphGroup.model_validate(d)
-                        sync_data.groups[id] = obj
-                        logger.debug(f"Downloaded GraphGroup: {obj}")
-                    else:
-                        logger.info(f"Skipping group '{d['displayName']}': {d}")
-                        return None
-                except Exception as e:
-                    logger.error(f"Invalid GraphGroup: {d}", exc_info=e)
-                    raise e
+            with lock:
+                if id not in sync_data.groups:
+                    try:
+                        if self._is_group_included(d):
+                            obj = GraphGroup.from_graph(d)
+                            sync_data.groups[id] = obj
+                            logger.debug(f"Downloaded GraphGroup: {obj}")
+                        else:
+                            logger.info(f"Skipping group '{d['displayName']}': {d}")
+                            return None
+                    except Exception as e:
+                        logger.error(f"Invalid GraphGroup: {d}", exc_info=e)
+                        raise e
 
-            return sync_data.groups[id]
+                return sync_data.groups[id]
 
         deep_sync_groups_xref: Dict[str, Dict] = {}
         visited_group_names: Set[str] = set()
 
         group_names = set(group_names)
 
-        for depth in range(group_search_depth):
-            logger.info(f"Performing group search (depth {depth+1} of {group_search_depth})")
+        def _register_members(group_info: dict, group_members: Iterable[dict], depth: int):
+            """registers group and its members, `group_members` are consumed as they come, i.e. page by page"""
+            _register_group(group_info)
 
-            for group_name in deepcopy(sorted(set(group_names))):
-                if group_name in visited_group_names:
-                    continue
+            group = sync_data.groups[group_info['id']]
 
-                visited_group_names.add(group_name)
+            # snapshot keeps ids of members of each group, attributes of members are stored once, as they come
+            snapshot_member_ids = [] if self._group_snapshot is not None else None
 
-                logger.info(f"Resolving group by name: {group_name}")
-                group_info = self.get_group_by_name(group_name)
-                if not group_info:
-                    logger.warning(f"Group not found, skipping: {group_name}")
-                    continue
+            for m in group_members:
+                if snapshot_member_ids is not None:
+                    self._group_snapshot.set_principal(m)
+                    snapshot_member_ids.append(m['id'])
 
-                group_id = group_info['id']
-                deep_sync_groups_xref[group_id] = group_info
+                r = None
 
-                logger.info(f"Downloading members of group_name: {group_name} (id={group_id})")
-                group_members = self.get_group_members(group_id)
+                if m['@odata.type'] == '#microsoft.graph.user':
+                    r = _register_user(m)
 
-                _register_group(group_info)
+                if m['@odata.type'] == '#microsoft.graph.servicePrincipal':
+                    r = _register_service_principal(m)
 
-                group = sync_data.groups[group_id]
+                if m['@odata.type'] == '#microsoft.graph.group':
+                    r = _register_group(m)
+                    if r:
+                        with lock:
+                            group_names.add(r.display_name)
 
-                for m in group_members:
-                    # remove any None values, without that aliases dont work well
-                    m = {k: v for k, v in m.items() if v is not None}
+                if r:
+                    if isinstance(r, Exception):
+                        with lock:
+                            sync_data.errors.append((m, r))
+                    else:
+                        group.members[r.id] = r
+                        r.extra_data["search_depth"] = depth + 1
+
+            if snapshot_member_ids is not None:
+                self._group_snapshot.set_members(
+                    group.id, {k: group_info.get(k)
+                               for k in ['id', 'displayName', 'mailEnabled', 'securityEnabled']},
+                    snapshot_member_ids)
+
+        def _sync_group(group_name: str, depth: int, prefetched: Dict[str, tuple]):
+            if group_name in prefetched:
+                group_info, first_page = prefetched[group_name]
+            else:
+                logger.info(f"Resolving group by name: {group_name}")
+                group_info, first_page = self.get_group_by_name(group_name), None
 
-                    if m['@odata.type'] == '#microsoft.graph.user':
-                        r = _register_user(m)
+            if not group_info:
+                logger.warning(f"Group not found, skipping: {group_name}")
+                return
 
-                    if m['@odata.type'] == '#microsoft.graph.servicePrincipal':
-                        r = _register_service_principal(m)
+            group_id = group_info['id']
+            with lock:
+                deep_sync_groups_xref[group_id] = group_info
 
-                    if m['@odata.type'] == '#microsoft.graph.group':
-                        r = _register_group(m)
-                        if r:
-                            group_names.add(r.display_name)
+            logger.info(f"Downloading members of group_name: {group_name} (id={group_id})")
+            _register_members(group_info, self.get_group_members(group_id, first_page=first_page), depth)
 
-                    if r:
-                        if isinstance(r, Exception):
-                            sync_data.errors.append((m, r))
-                        else:
-                            group.members[r.id] = r
-                            r.extra_data["search_depth"] = depth + 1
+        if self._transitive_members and group_search_depth > 1:
+            levels, group_members = self.get_transitive_group_members(group_names, group_search_depth,
+                                                                      known_groups)
+
+            # registration follows search depth order, so that `search_depth` is the same as in depth by depth search
+            for depth, level in enumerate(levels):
+                logger.info(f"Registering groups (depth {depth+1} of {group_search_depth})")
+                for group_info in level:
+                    deep_sync_groups_xref[group_info['id']] = group_info
+                    _register_members(group_info, group_members[group_info['id']], depth)
+        else:
+            known_groups = known_groups or {}
+            visited_group_names.update(info['displayName'] for info, _ in known_groups.values())
+
+            for depth in range(group_search_depth):
+                logger.info(f"Performing group search (depth {depth+1} of {group_search_depth})")
+
+                # names discovered while processing this depth, are processed at the next one
+                depth_group_names = sorted(set(group_names) - visited_group_names)
+                visited_group_names.update(depth_group_names)
+
+                if depth == 0:
+                    for group_id, (group_info, members) in known_groups.items():
+                        deep_sync_groups_xref[group_id] = group_info
+                        _register_members(group_info, members, depth)
+
+                # resolve names and download first page of members using batches,
+                # rest of the pages are downloaded by the workers
+                prefetched: Dict[str, tuple] = {}
+                if self._batch_requests and depth_group_names:
+                    logger.info(f"Resolving {len(depth_group_names)} group(s) by name")
+                    group_infos = self.get_groups_by_name(depth_group_names)
+                    found = {name: info['id'] for name, info in group_infos.items() if info}
+                    first_pages = self.get_groups_members_first_page(found.values())
+                    prefetched = {
+                        name: (info, first_pages.get(info['id']) if info else None)
+                        for name, info in group_infos.items()
+                    }
+
+                tasks = [partial(_sync_group, group_name, depth, prefetched) for group_name in depth_group_names]
+                self._gather(f"graph_group_search_depth_{depth+1}", tasks)
 
         msg = f"Downloaded: errors={len(sync_data.errors)}, groups={len(sync_data.groups)}, users={len(sync_data.users)}, service_principals={len(sync_data.service_principals)}"
 
@@ -341,4 +1191,10 @@ class GraphAPIClient:
 
         logger.debug(f"Effective deep sync group names: {sync_data.deep_sync_group_names}")
 
+        if self._group_snapshot is not None:
+            self._group_snapshot.flush()
+
+        if self._group_name_cache is not None:
+            self._group_name_cache.flush()
+
         return sync_data
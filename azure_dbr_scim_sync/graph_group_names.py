@@ -0,0 +1,98 @@
+import logging
+import time
+from typing import Callable, Dict, List, Set
+
+from .persisted_cache import Cache
+
+logger = logging.getLogger('sync.cache')
+
+
+class GroupNameCache(Cache):
+    """
+    Persisted cache of graph group names resolution, display name -> groups with that name
+    (`id`, `displayName`, `securityEnabled` and `mailEnabled` of each).
+
+    Negative entries (groups that were not found, or are not synced, i.e. non-security or mail-enabled groups)
+    expire after `negative_ttl` seconds. Other entries are valid until groups change feed reports
+    the group as renamed, deleted, or changed, see `on_group_change()`.
+    """
+
+    def __init__(self, path: str, negative_ttl: int = 24 * 3600, **kwargs):
+        self._negative_ttl = negative_ttl
+        # group id -> names of entries with that group
+        self._names_by_id: Dict[str, Set[str]] = {}
+        super().__init__(path, auto_flush=False, **kwargs)
+
+    def get_groups(self, name: str, is_positive: Callable[[List[dict]], bool] = None) -> List[dict]:
+        """
+        :param is_positive: tells if groups are a positive entry, by default all entries are positive
+        :return: cached groups with `name` (can be empty), or None if name is not cached or negative entry expired
+        """
+        with self._lock:
+            entry = self._data.get(name)
+            if entry is None:
+                return None
+
+            if (is_positive is not None and not is_positive(entry['groups']) and
+                    time.time() - entry['resolved_at'] > self._negative_ttl):
+                logger.debug(f"Group name cache: negative entry expired: {name}")
+                return None
+
+            return entry['groups']
+
+    def set_groups(self, name: str, groups: List[dict]):
+        groups = [{k: g.get(k) for k in ['id', 'displayName', 'mailEnabled', 'securityEnabled']} for g in groups]
+        with self._lock:
+            self._unindex(name)
+            self[name] = {'groups': groups, 'resolved_at': time.time()}
+            for g in groups:
+                self._names_by_id.setdefault(g['id'], set()).add(name)
+
+    def on_group_change(self, group: dict):
+        """invalidates entries of a group reported by groups change feed, as renamed, deleted, or changed"""
+        with self._lock:
+            names = set(self._names_by_id.get(group['id'], ()))
+            if '@removed' not in group:
+                # only changed attributes may be present
+                changed = {k: v for k, v in group.items() if k in ['displayName', 'mailEnabled', 'securityEnabled']}
+                names = {
+                    x
+                    for x in names if any(
+                        g['id'] == group['id'] and any(g.get(k) != v for k, v in changed.items())
+                        for g in self._data[x]['groups'])
+                }
+                # group could have got the name of a group that was not found before
+                if changed.get('displayName') in self._data and changed['displayName'] not in self._names_by_id.get(
+                        group['id'], ()):
+                    names.add(changed['displayName'])
+
+            for name in names:
+                logger.info(f"Group name cache: invalidating: {name} (id={group['id']})")
+                self.invalidate(name)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._unindex(key)
+            super().invalidate(key)
+
+    def _unindex(self, name: str):
+        entry = self._data.get(name)
+        for g in entry['groups'] if entry else []:
+            names = self._names_by_id.get(g['id'])
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    self._names_by_id.pop(g['id'])
+
+    def _load(self):
+        with self._lock:
+            super()._load()
+            self._names_by_id = {}
+            for name, entry in self._data.items():
+                for g in entry['groups']:
+                    self._names_by_id.setdefault(g['id'], set()).add(name)
+
+    def clear(self):
+        with self._lock:
+            self._names_by_id = {}
+            super().clear()
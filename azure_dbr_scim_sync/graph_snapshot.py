@@ -0,0 +1,168 @@
+import gzip
+import json
+import logging
+from typing import Dict, Iterable, List, Set
+
+from .persisted_cache import Cache
+
+logger = logging.getLogger('sync.snapshot')
+
+
+class GroupSnapshotStore(Cache):
+    """
+    Persisted snapshot of graph groups members, keyed by group id.
+
+    Attributes of each member are stored once, no matter how many groups it belongs to,
+    groups keep only list of references to their members.
+    Data is persisted as gzip compressed, compact json (locally or on adls, same as `Cache`).
+
+    `get()` and `[]` return `{'group': group info, 'members': [member info, ...]}`, same as it was set.
+    """
+
+    _FORMAT_VERSION = 1
+
+    def __init__(self, path: str, **kwargs):
+        # id -> member info, shared by all groups
+        self._principals: Dict[str, dict] = {}
+        super().__init__(path, auto_flush=False, **kwargs)
+
+    def get(self, key):
+        with self._lock:
+            g = self._data.get(key)
+            if g is None:
+                return None
+
+            return {'group': g['group'], 'members': [self._principals[x] for x in g['members']]}
+
+    def __setitem__(self, key, value):
+        for m in value['members']:
+            self.set_principal(m)
+
+        self.set_members(key, value['group'], [m['id'] for m in value['members']])
+
+    def set_principal(self, principal: dict):
+        """stores attributes of member, shared by all groups it is a member of"""
+        principal = {k: v for k, v in principal.items() if v is not None}
+        with self._lock:
+            self._principals[principal['id']] = principal
+
+    def set_members(self, key, group_info: dict, member_ids: List[str]):
+        """sets members of group `key` by their ids, attributes of members are stored by `set_principal()`"""
+        group_info = {k: v for k, v in group_info.items() if v is not None}
+        with self._lock:
+            self._data[key] = {'group': group_info, 'members': list(member_ids)}
+            self._change_counter = self._change_counter + 1
+
+    def get_principal(self, id: str) -> dict:
+        with self._lock:
+            return self._principals.get(id)
+
+    def update_principals(self, principals: Iterable[dict]):
+        """updates attributes of members, that are in the snapshot"""
+        principals = {p['id']: {k: v for k, v in p.items() if v is not None} for p in principals}
+
+        with self._lock:
+            principals = {k: v for k, v in principals.items() if k in self._principals}
+            if not principals:
+                return
+
+            self._principals.update(principals)
+
+            self._change_counter = self._change_counter + len(principals)
+
+    def get_group_info(self, key) -> dict:
+        with self._lock:
+            g = self._data.get(key)
+            return g['group'] if g else None
+
+    def member_ids(self, key) -> Set[str]:
+        with self._lock:
+            g = self._data.get(key)
+            return set(g['members']) if g else set()
+
+    def evict(self, keep_group_names: Set[str]) -> List[str]:
+        """removes groups with display names not in `keep_group_names`, and members that are no longer referenced"""
+        with self._lock:
+            evicted = [k for k, g in self._data.items() if g['group'].get('displayName') not in keep_group_names]
+            for k in evicted:
+                logger.info(f"Evicting group from snapshot: {self._data[k]['group'].get('displayName')} (id={k})")
+                self._data.pop(k)
+
+            if evicted:
+                self._change_counter = self._change_counter + len(evicted)
+                self._evict_unreferenced_principals()
+
+            return evicted
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.pop(key, None)
+                self._change_counter = self._change_counter + 1
+                self._evict_unreferenced_principals()
+
+    def _evict_unreferenced_principals(self):
+        referenced = set()
+        for g in self._data.values():
+            referenced.update(g['members'])
+
+        self._principals = {k: v for k, v in self._principals.items() if k in referenced}
+
+    def _load(self):
+        with self._lock:
+            try:
+                with self._get_handle("rb") as f:
+                    data = json.loads(gzip.decompress(f.read()))
+            except FileNotFoundError:
+                data = None
+
+            self._data = {}
+            self._principals = {}
+
+            if not data:
+                return
+
+            if data.get('version') != self._FORMAT_VERSION:
+                logger.warning(f"Unknown snapshot format version: {data.get('version')}, ignoring snapshot")
+                return
+
+            # members are saved as indexes of principals list
+            principals = data['principals']
+            self._principals = {p['id']: p for p in principals}
+            self._data = {
+                k: {
+                    'group': group_info,
+                    'members': [principals[idx]['id'] for idx in members]
+                }
+                for k, (group_info, members) in data['groups'].items()
+            }
+
+            logger.info(f"Loaded snapshot: groups={len(self._data)}, principals={len(self._principals)}")
+
+    def flush(self):
+        with self._lock:
+            self._evict_unreferenced_principals()
+
+            principals = list(self._principals.values())
+            idx = {p['id']: i for i, p in enumerate(principals)}
+            data = {
+                'version': self._FORMAT_VERSION,
+                'principals': principals,
+                'groups': {
+                    k: [g['group'], [idx[x] for x in g['members']]]
+                    for k, g in self._data.items()
+                }
+            }
+
+            json_str = json.dumps(data, separators=(',', ':'))
+            with self._get_handle("wb") as f:
+                f.write(gzip.compress(json_str.encode('utf-8'), compresslevel=5))
+
+            self._change_counter = 0
+
+    def clear(self):
+        with self._lock:
+            if self._data:
+                self._data = {}
+                self._principals = {}
+                self.flush()
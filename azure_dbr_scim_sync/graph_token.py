@@ -0,0 +1,94 @@
+import logging
+import os
+import time
+from threading import Event, Lock, Thread
+
+from azure.core.credentials import AccessToken, TokenCredential
+from azure.identity import DefaultAzureCredential, DeviceCodeCredential
+
+logger = logging.getLogger('sync.graph')
+
+GRAPH_SCOPE = 'https://graph.microsoft.com/.default'
+
+
+class GraphTokenProvider:
+    """
+    Thread safe provider of Graph API access tokens, using one credential for its lifetime.
+
+    Token is refreshed by background thread, `refresh_margin` seconds before it expires, hence callers
+    get the cached token without waiting for auth. Only the first call, and calls made after the token
+    expired (i.e. when background refresh keeps failing), get a new token, one caller at a time.
+    """
+
+    # token with less validity left is not handed out to callers
+    _MIN_VALIDITY = 60
+    _RETRY_INTERVAL = 30
+
+    def __init__(self, credential: TokenCredential = None, scope: str = GRAPH_SCOPE, refresh_margin: int = 300):
+        self._credential = credential
+        self._scope = scope
+        self._refresh_margin = refresh_margin
+        self._token: AccessToken = None
+        self._lock = Lock()
+        self._stop = Event()
+        self._refresh_thread: Thread = None
+
+    @staticmethod
+    def default_credential() -> TokenCredential:
+        if os.environ.get('AZURE_CLIENT_ID') == 'DeviceCodeAuth' and os.environ.get(
+                'AZURE_CLIENT_SECRET') == 'DeviceCodeAuth':
+            logger.info("Using device authentication auth!")
+            return DeviceCodeCredential()
+
+        return DefaultAzureCredential()
+
+    def _is_valid(self, token: AccessToken) -> bool:
+        return token is not None and token.expires_on - time.time() > self._MIN_VALIDITY
+
+    def get_token(self) -> str:
+        token = self._token
+        if not self._is_valid(token):
+            with self._lock:
+                # other caller could have refreshed it while waiting for the lock
+                token = self._token
+                if not self._is_valid(token):
+                    token = self._refresh()
+
+        return token.token
+
+    def _refresh(self) -> AccessToken:
+        # has to be called with lock held
+        if self._credential is None:
+            self._credential = self.default_credential()
+
+        token = self._credential.get_token(self._scope)
+        self._token = token
+        logger.debug(f"Got new graph token, expires in {int(token.expires_on - time.time())}s")
+
+        if self._refresh_thread is None:
+            self._refresh_thread = Thread(target=self._refresh_loop, name='graph_token_refresh', daemon=True)
+            self._refresh_thread.start()
+
+        return token
+
+    def _refresh_loop(self):
+        while True:
+            token = self._token
+            time_left = token.expires_on - time.time()
+            # short lived tokens are refreshed in the half of their lifetime
+            delay = max(time_left - self._refresh_margin, time_left / 2, 1)
+            if self._stop.wait(delay):
+                return
+
+            try:
+                with self._lock:
+                    if self._token is token:
+                        self._refresh()
+            except Exception as e:
+                logger.warning(f"Graph token refresh failed, retrying in {self._RETRY_INTERVAL}s", exc_info=e)
+                if self._stop.wait(self._RETRY_INTERVAL):
+                    return
+
+    def close(self):
+        """stops background refresh"""
+        self._stop.set()
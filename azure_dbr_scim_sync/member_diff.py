@@ -0,0 +1,114 @@
+from array import array
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# ids are kept as 64 bit integers
+_TYPECODE = 'q'
+
+
+class IdInterner:
+    """Interns string ids to dense integers (0, 1, ...), shared by all the groups"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._values: List[str] = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def intern(self, value: str) -> int:
+        idx = self._ids.get(value)
+        if idx is not None:
+            return idx
+
+        with self._lock:
+            idx = self._ids.get(value)
+            if idx is None:
+                idx = len(self._values)
+                self._values.append(value)
+                self._ids[value] = idx
+
+            return idx
+
+    def get(self, value: str, default: int = -1) -> int:
+        """:return: integer of `value`, without interning it"""
+        return self._ids.get(value, default)
+
+    def lookup(self, values: Iterable[str]) -> Iterator[Optional[int]]:
+        """:return: integers of `values`, None for values that are not interned"""
+        return map(self._ids.get, values)
+
+    def value(self, idx: int) -> str:
+        return self._values[idx]
+
+    def values(self, ids: Iterable[int]) -> List[str]:
+        return list(map(self._values.__getitem__, ids))
+
+
+class MemberIds:
+    """
+    Databricks ids of synced principals, interned to integers, by graph id of principal. Members of groups are
+    sorted arrays of Databricks integer ids, hence diff of members of large groups is computed by merging
+    sorted arrays of integers, instead of sets and dicts of string ids.
+    """
+
+    def __init__(self):
+        self.dbr_ids = IdInterner()
+        # graph id -> dbr integer id
+        self._dbr_of_graph: Dict[str, int] = {}
+
+    def set(self, graph_id: str, dbr_id: str):
+        """maps principal `graph_id` to `dbr_id`"""
+        self._dbr_of_graph[graph_id] = self.dbr_ids.intern(dbr_id)
+
+    def desired(self, graph_ids: Iterable[str], fallback: Callable[[str], str] = None) -> array:
+        """
+        :param fallback: resolves dbr id of members, that are not mapped
+        :return: sorted dbr integer ids of members with `graph_ids`, members without dbr id are ignored
+        """
+        graph_ids = graph_ids if isinstance(graph_ids, list) else list(graph_ids)
+        ids = set(map(self._dbr_of_graph.get, graph_ids))
+        if None in ids:
+            ids.discard(None)
+            if fallback is not None:
+                for graph_id in graph_ids:
+                    if graph_id not in self._dbr_of_graph:
+                        dbr_id = fallback(graph_id)
+                        if dbr_id:
+                            ids.add(self.dbr_ids.intern(dbr_id))
+
+        return array(_TYPECODE, sorted(ids))
+
+    def actual(self, dbr_ids: Iterable[str]) -> array:
+        """:return: sorted dbr integer ids of current members of group"""
+        dbr_ids = dbr_ids if isinstance(dbr_ids, list) else list(dbr_ids)
+        ids = set(self.dbr_ids.lookup(dbr_ids))
+        if None in ids:
+            # members, that are not synced
+            ids.discard(None)
+            ids.update(map(self.dbr_ids.intern, dbr_ids))
+
+        return array(_TYPECODE, sorted(ids))
+
+    @staticmethod
+    def diff(desired: array, actual: array) -> Tuple[array, array]:
+        """:return: sorted dbr integer ids of members to remove, and to add, merged from both sorted arrays"""
+        to_remove, to_add = array(_TYPECODE), array(_TYPECODE)
+        i = j = 0
+        desired_len, actual_len = len(desired), len(actual)
+        while i < desired_len and j < actual_len:
+            d, a = desired[i], actual[j]
+            if d == a:
+                i += 1
+                j += 1
+            elif d < a:
+                to_add.append(d)
+                i += 1
+            else:
+                to_remove.append(a)
+                j += 1
+
+        to_add.extend(desired[i:])
+        to_remove.extend(actual[j:])
+        return to_remove, to_add
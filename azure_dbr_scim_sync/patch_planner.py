@@ -0,0 +1,210 @@
+import json
+import logging
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, List
+
+from databricks.sdk.service import iam
+
+from .retry import get_status_code
+
+logger = logging.getLogger('sync.patch')
+
+_SCHEMAS = [iam.PatchSchema.URN_IETF_PARAMS_SCIM_API_MESSAGES_2_0_PATCH_OP.value]
+
+
+@dataclass
+class PatchChunk:
+    """members removed, and then added, by one PATCH request"""
+    remove_ids: List[str]
+    add_ids: List[str]
+    # number of members removed by one filter, 1 when removals are not coalesced
+    filter_values: int = 1
+
+    @property
+    def operations(self) -> List[iam.Patch]:
+        ops = []
+        for i in range(0, len(self.remove_ids), self.filter_values):
+            values = self.remove_ids[i:i + self.filter_values]
+            path = ' or '.join(f'value eq "{x}"' for x in values)
+            ops.append(iam.Patch(op=iam.PatchOp.REMOVE, path=f"members[{path}]"))
+
+        if self.add_ids:
+            ops.append(iam.Patch(op=iam.PatchOp.ADD, value={'members': [{'value': x} for x in self.add_ids]}))
+
+        return ops
+
+    def __len__(self):
+        """number of members removed and added"""
+        return len(self.remove_ids) + len(self.add_ids)
+
+    @property
+    def size(self) -> int:
+        """bytes of request body"""
+        return len(json.dumps({'Operations': [x.as_dict() for x in self.operations], 'schemas': _SCHEMAS}))
+
+
+class PatchPlanner:
+    """
+    Packs membership changes of a group into PATCH requests: removals first, then additions, in order.
+
+    Removals are coalesced into filters of up to `max_filter_values` members
+    (`members[value eq "a" or value eq "b"]`), additions into one operation per request, and requests are
+    sized by bytes of their body (`max_bytes`) and number of operations (`max_ops`).
+
+    Limits are learned from rejected requests, for all the following requests: request rejected as too large
+    (`413`) lowers `max_bytes` and `max_ops` to half of it. Request with coalesced filters rejected as invalid
+    (`400`) is retried with its removals alone, and if these are rejected as well, with members removed one by
+    one, which, once accepted, disables coalescing. The rest of the changes is then planned again, and sent in
+    the same order.
+    """
+
+    # bytes of request body without operations, and bytes of each removal and addition, on top of the id
+    _BASE_BYTES = 100
+    _REMOVE_OP_BYTES = 60
+    _REMOVE_FILTER_VALUE_BYTES = 20
+    _ADD_OP_BYTES = 50
+    _ADD_MEMBER_BYTES = 20
+
+    def __init__(self,
+                 name: str,
+                 max_bytes: int = 64 * 1024,
+                 max_ops: int = 50,
+                 max_filter_values: int = 50,
+                 min_bytes: int = 1024):
+        self.name = name
+        self._lock = Lock()
+        self._max_bytes = max_bytes
+        self._max_ops = max_ops
+        self._max_filter_values = max_filter_values
+        self._min_bytes = min_bytes
+
+        self._requests = 0
+        self._operations = 0
+        self._rejected = 0
+
+    def plan(self,
+             to_remove: List[str],
+             to_add: List[str],
+             max_filter_values: int = None) -> List[PatchChunk]:
+        """
+        :param max_filter_values: overrides learned number of members removed by one filter
+        :return: requests removing `to_remove` members, and then adding `to_add` members
+        """
+        with self._lock:
+            max_bytes, max_ops = self._max_bytes, self._max_ops
+            filter_values = min(max_filter_values or self._max_filter_values, self._max_filter_values)
+
+        chunks = []
+        chunk = PatchChunk([], [], filter_values)
+        size = self._BASE_BYTES
+        ops = 0
+
+        for x in to_remove:
+            new_op = len(chunk.remove_ids) % filter_values == 0
+            cost = len(x) + (self._REMOVE_OP_BYTES if new_op else self._REMOVE_FILTER_VALUE_BYTES)
+            if chunk.remove_ids and (size + cost > max_bytes or (new_op and ops + 1 > max_ops)):
+                chunks.append(chunk)
+                chunk = PatchChunk([], [], filter_values)
+                size, ops, new_op = self._BASE_BYTES, 0, True
+                cost = len(x) + self._REMOVE_OP_BYTES
+
+            chunk.remove_ids.append(x)
+            size += cost
+            ops += new_op
+
+        for x in to_add:
+            new_op = not chunk.add_ids
+            cost = len(x) + self._ADD_MEMBER_BYTES + (self._ADD_OP_BYTES if new_op else 0)
+            if len(chunk) and (size + cost > max_bytes or (new_op and ops + 1 > max_ops)):
+                chunks.append(chunk)
+                chunk = PatchChunk([], [], filter_values)
+                size, ops, new_op = self._BASE_BYTES, 0, True
+                cost = len(x) + self._ADD_MEMBER_BYTES + self._ADD_OP_BYTES
+
+            chunk.add_ids.append(x)
+            size += cost
+            ops += new_op
+
+        if len(chunk):
+            chunks.append(chunk)
+
+        return chunks
+
+    def apply(self, send: Callable, to_remove: List[str], to_add: List[str]):
+        """
+        sends planned requests one after another, using `send(operations=...)`, and plans the rest of changes
+        again, when request is rejected for its size, or for coalesced removals
+        """
+        max_filter_values = None
+        # number of members, removed one by one, after their coalesced removal was rejected
+        probed_removals = 0
+        pending = self.plan(to_remove, to_add)
+        while pending:
+            chunk = pending[0]
+            operations = chunk.operations
+            try:
+                send(operations=operations)
+            except Exception as e:
+                status_code = get_status_code(e)
+                coalesced = chunk.filter_values > 1 and len(chunk.remove_ids) > 1
+                if status_code == 400 and coalesced and chunk.add_ids:
+                    # request may be rejected for its additions, e.g. unknown members, hence removals are
+                    # sent on their own first, and additions after them
+                    pending[0:1] = [
+                        PatchChunk(chunk.remove_ids, [], chunk.filter_values),
+                        PatchChunk([], chunk.add_ids)
+                    ]
+                    continue
+
+                if status_code == 413 and len(chunk) > 1:
+                    self._lower_limits(chunk)
+                elif status_code == 400 and coalesced:
+                    # coalescing is disabled for all groups only once the same removals are accepted one by one
+                    logger.warning(f"{self.name}: request with coalesced removals was rejected, "
+                                   f"removing members one by one: {e}")
+                    max_filter_values = 1
+                    probed_removals = len(chunk.remove_ids)
+                else:
+                    raise
+
+                with self._lock:
+                    self._rejected += 1
+                pending = self.plan([x for c in pending for x in c.remove_ids],
+                                    [x for c in pending for x in c.add_ids],
+                                    max_filter_values=max_filter_values)
+                if status_code == 413 and len(pending[0]) >= len(chunk):
+                    # limits cannot be lowered any more
+                    raise
+                continue
+
+            with self._lock:
+                self._requests += 1
+                self._operations += len(operations)
+                if probed_removals:
+                    probed_removals = max(0, probed_removals - len(chunk.remove_ids))
+                    if not probed_removals and self._max_filter_values > 1:
+                        logger.warning(f"{self.name}: coalesced removals are not accepted, "
+                                       f"removing members one by one")
+                        self._max_filter_values = 1
+            pending.pop(0)
+
+    def _lower_limits(self, chunk: PatchChunk):
+        """lowers limits to half of `chunk`, that was rejected as too large"""
+        size, op_count = chunk.size, len(chunk.operations)
+        with self._lock:
+            self._max_bytes = max(self._min_bytes, min(self._max_bytes, size // 2))
+            self._max_ops = max(1, min(self._max_ops, op_count // 2))
+            logger.warning(f"{self.name}: request of {size} bytes is too large, "
+                           f"lowering limits: max_bytes={self._max_bytes}, max_ops={self._max_ops}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'operations': self._operations,
+                'rejected': self._rejected,
+                'max_bytes': self._max_bytes,
+                'max_ops': self._max_ops,
+                'max_filter_values': self._max_filter_values
+            }
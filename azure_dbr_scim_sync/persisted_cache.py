@@ -19,7 +19,8 @@ class Cache:
                  container: str = None,
                  tenat_id: str = None,
                  client_id: str = None,
-                 client_secret: str = None):
+                 client_secret: str = None,
+                 auto_flush: bool = True):
         self._storage_account = storage_account
         self._container = container or os.getenv('AZURE_STORAGE_CONTAINER')
         self._path = path
@@ -41,6 +42,8 @@ class Cache:
         self._data = {}
         self._lock = RLock()
         self._change_counter = 0
+        # when disabled, changes are persisted only by explicit `flush()`
+        self._auto_flush = auto_flush
         self._load()
 
     def _get_handle(self, mode):
@@ -89,7 +92,7 @@ class Cache:
 
     def _auto_flush_if_needed(self):
         with self._lock:
-            if self._change_counter >= 10:
+            if self._auto_flush and self._change_counter >= 10:
                 self.flush()
 
     def _load(self):
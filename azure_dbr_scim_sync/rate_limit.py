@@ -0,0 +1,274 @@
+import logging
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock
+from typing import Callable
+
+from requests.adapters import HTTPAdapter
+
+from .retry import get_status_code
+
+logger = logging.getLogger('sync.rate_limit')
+
+
+def parse_retry_after(value, default: float = None) -> float:
+    """`Retry-After` header value in seconds, it can be either number of seconds, or http date"""
+    if value is None:
+        return default
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter, shared by all threads making requests to the same API.
+
+    When any response is throttled, all the threads are paused for `Retry-After` seconds,
+    and request rate is halved. Every successful request moves the rate back up towards
+    90% of the rate of successful requests at the time of throttling (the ceiling), and slowly above it,
+    in case the ceiling was raised since.
+    """
+
+    # successful requests within last second, needed to estimate the ceiling
+    _MIN_SAMPLE = 10
+
+    def __init__(self,
+                 name: str,
+                 max_rate: float = 500.0,
+                 min_rate: float = 1.0,
+                 burst: int = 20,
+                 default_retry_after: float = 1.0):
+        self.name = name
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._burst = burst
+        self._default_retry_after = default_retry_after
+
+        self._lock = Lock()
+        self._rate = max_rate
+        self._ceiling = None
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # times of successful requests within last second, rate at which throttling happens is the ceiling
+        self._recent = deque()
+
+        self._requests = 0
+        self._throttled = 0
+        self._waited = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def acquire(self):
+        """waits until request can be made"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    # bursts are capped to a fraction of the rate, so that they do not get throttled on their own
+                    capacity = min(self._burst, max(1.0, self._rate / 10))
+                    self._tokens = min(capacity, self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._requests += 1
+                        return
+
+                    wait = (1 - self._tokens) / self._rate
+
+                self._waited += wait
+
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            now = time.monotonic()
+            self._recent.append(now)
+            while self._recent[0] < now - 1:
+                self._recent.popleft()
+
+            target = self._ceiling * 0.9 if self._ceiling else self._max_rate
+            if self._rate < target:
+                # get back close to the ceiling quickly
+                self._rate = min(target, self._rate + max(0.1, (target - self._rate) * 0.02))
+            else:
+                self._rate = min(self._max_rate, self._rate + 0.01)
+
+    def on_throttled(self, retry_after: float = None):
+        """pauses all threads for `retry_after` seconds, and lowers the rate"""
+        retry_after = self._default_retry_after if retry_after is None else retry_after
+
+        with self._lock:
+            self._throttled += 1
+            now = time.monotonic()
+
+            # concurrent requests are throttled together, rate is lowered only once per pause,
+            # and only when enough requests were made to tell the ceiling, otherwise pause is enough
+            observed = len([x for x in self._recent if x >= now - 1])
+            lower_rate = now >= self._paused_until and observed >= self._MIN_SAMPLE
+            if lower_rate:
+                self._ceiling = max(self._min_rate, min(self._rate, observed))
+                self._rate = max(self._min_rate, self._ceiling / 2)
+                self._recent.clear()
+
+            self._paused_until = max(self._paused_until, now + retry_after)
+            # no burst after the pause
+            self._tokens = 0.0
+            self._updated = max(self._updated, now)
+
+        if lower_rate:
+            logger.warning(f"{self.name}: throttled, pausing all requests for {retry_after:.1f}s, "
+                           f"rate={self._rate:.1f}/s, ceiling={self._ceiling:.1f}/s")
+        else:
+            logger.debug(f"{self.name}: throttled, pausing all requests for {retry_after:.1f}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'throttled': self._throttled,
+                'waited_seconds': round(self._waited, 3),
+                'rate': round(self._rate, 2)
+            }
+
+
+class ConcurrencyLimiter:
+    """
+    AIMD limit of concurrent requests, shared by all threads making requests to the same API.
+
+    Limit is halved when a request is throttled (`429`) or fails on server side (`5xx`), once for all
+    requests started before that. It is raised by one per `limit` successful requests, as long as
+    their latency stays within `latency_tolerance` times the lowest recent latency, up to `max_concurrency`.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, min_concurrency: int = 1, latency_tolerance: float = 2.0):
+        self.name = name
+        self._max_concurrency = max_concurrency
+        self._min_concurrency = min_concurrency
+        self._latency_tolerance = latency_tolerance
+
+        self._cond = Condition(Lock())
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._min_latency = None
+        self._decreased_at = 0.0
+
+        self._requests = 0
+        self._throttled = 0
+        self._waited = 0.0
+
+    @property
+    def limit(self) -> int:
+        return max(self._min_concurrency, int(self._limit))
+
+    def acquire(self) -> float:
+        """waits until request can be made, :return: start time of the request, for `release()`"""
+        with self._cond:
+            start = time.monotonic()
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+
+            now = time.monotonic()
+            self._waited += now - start
+            self._in_flight += 1
+            self._requests += 1
+            return now
+
+    def release(self, started: float, throttled: bool = False):
+        """:param started: value returned by `acquire()`"""
+        with self._cond:
+            now = time.monotonic()
+            self._in_flight -= 1
+            self._cond.notify()
+
+            if throttled:
+                self._throttled += 1
+                # concurrent requests get throttled together, limit is lowered only once for them
+                if started < self._decreased_at:
+                    return
+
+                self._decreased_at = now
+                self._limit = max(float(self._min_concurrency), self._limit / 2)
+                logger.warning(f"{self.name}: throttled, concurrency={self.limit}")
+                return
+
+            latency = now - started
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            else:
+                # lowest latency slowly follows the observed latency, so that single fast response is forgotten
+                self._min_latency += (latency - self._min_latency) * 0.05
+            if latency <= self._min_latency * self._latency_tolerance and self._limit < self._max_concurrency:
+                self._limit = min(float(self._max_concurrency), self._limit + 1 / self._limit)
+                self._cond.notify()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        calls `func` as one request, errors are retried by the caller, errors of throttling (`429`),
+        server side errors (`5xx`) and errors without status code, i.e. connection errors, lower the limit
+        """
+        started = self.acquire()
+        throttled = False
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            status_code = get_status_code(err)
+            throttled = status_code is None or status_code == 429 or status_code >= 500
+            raise
+        finally:
+            self.release(started, throttled)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'requests': self._requests,
+                'throttled': self._throttled,
+                'waited_seconds': round(self._waited, 3),
+                'concurrency': self.limit
+            }
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    `HTTPAdapter` passing every request through `RateLimiter`,
+    throttled requests (429, or 503 with `Retry-After`) are retried up to `max_attempts` times
+    """
+
+    def __init__(self, rate_limiter: RateLimiter, max_attempts: int = 7, **kwargs):
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def is_throttled(response) -> bool:
+        return response.status_code == 429 or (response.status_code == 503 and 'Retry-After' in response.headers)
+
+    def send(self, request, **kwargs):
+        for attempt in range(self.max_attempts):
+            self.rate_limiter.acquire()
+            response = super().send(request, **kwargs)
+
+            if not self.is_throttled(response):
+                self.rate_limiter.on_success()
+                return response
+
+            self.rate_limiter.on_throttled(
+                parse_retry_after(response.headers.get('Retry-After'), default=float(2**attempt)))
+
+            if attempt + 1 < self.max_attempts:
+                response.close()
+
+        # return original response when retries have been exhausted
+        return response
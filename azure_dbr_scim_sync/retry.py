@@ -0,0 +1,151 @@
+import functools
+import logging
+import random
+import time
+from collections import Counter
+from threading import Lock
+from typing import Callable
+
+from databricks.sdk.errors import DatabricksError, platform
+
+logger = logging.getLogger('sync.retry')
+
+# throttling, and server side errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_STATUS_CODES = {v: k for k, v in platform.STATUS_CODE_MAPPING.items()}
+
+
+def get_status_code(err: BaseException) -> int:
+    """:return: HTTP status code of error of databricks sdk (or of its cause, i.e. when sdk timed out retrying it)"""
+    while err is not None:
+        if isinstance(err, DatabricksError):
+            for cls in type(err).__mro__:
+                if cls in _STATUS_CODES:
+                    return _STATUS_CODES[cls]
+
+            # SCIM API errors, that are not mapped to specific error class
+            if err.error_code and err.error_code.startswith('SCIM_') and err.error_code[5:].isdigit():
+                return int(err.error_code[5:])
+
+        err = err.__cause__
+
+    return None
+
+
+class RetryPolicy:
+    """
+    Retries calls failing with `RETRYABLE_STATUS_CODES`, up to `max_attempts` times, with exponential backoff
+    and full jitter (random delay up to `base_delay * 2^attempt`, capped at `max_delay`), but not shorter
+    than `Retry-After` of the error.
+
+    Retries of all the workers are limited by shared budget: every call adds `budget_ratio` of a retry to it,
+    every retry takes one. When the budget runs out, the circuit breaker opens: all the calls wait
+    for `breaker_cooldown` seconds (with jitter), before the budget is refilled to `min_budget`.
+    """
+
+    def __init__(self,
+                 name: str,
+                 max_attempts: int = 10,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 budget_ratio: float = 0.2,
+                 min_budget: float = 10.0,
+                 max_budget: float = 100.0,
+                 breaker_cooldown: float = 30.0):
+        self.name = name
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._budget_ratio = budget_ratio
+        self._min_budget = min_budget
+        self._max_budget = max_budget
+        self._breaker_cooldown = breaker_cooldown
+
+        self._lock = Lock()
+        self._budget = min_budget
+        self._open_until = 0.0
+
+        self._calls = 0
+        self._retries = Counter()
+        self._failed = 0
+        self._breaker_opened = 0
+        self._waited = 0.0
+
+    def __call__(self, func: Callable) -> Callable:
+        """decorator, retrying calls of `func`"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+
+        return wrapper
+
+    def call(self, func: Callable, *args, **kwargs):
+        with self._lock:
+            self._calls += 1
+            self._budget = min(self._max_budget, self._budget + self._budget_ratio)
+
+        for attempt in range(self._max_attempts):
+            self._wait_if_open()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                status_code = get_status_code(err)
+                if status_code not in RETRYABLE_STATUS_CODES:
+                    raise
+
+                if attempt + 1 >= self._max_attempts:
+                    with self._lock:
+                        self._failed += 1
+                    logger.error(f"{self.name}: giving up after {self._max_attempts} attempts: {err}")
+                    raise
+
+                delay = random.uniform(0, min(self._max_delay, self._base_delay * 2**attempt))
+                delay = max(delay, getattr(err, 'retry_after_secs', None) or 0)
+                self._on_retry(status_code, delay)
+                logger.debug(f"{self.name}: retrying in {delay:.1f}s, attempt {attempt + 2} of "
+                             f"{self._max_attempts}, status={status_code}: {err}")
+                time.sleep(delay)
+
+    def _on_retry(self, status_code: int, delay: float):
+        with self._lock:
+            self._retries[status_code] += 1
+            self._waited += delay
+            if self._budget >= 1:
+                self._budget -= 1
+                return
+
+            now = time.monotonic()
+            if now < self._open_until:
+                return
+
+            self._breaker_opened += 1
+            self._open_until = now + self._breaker_cooldown
+            # calls resume, and retry, slowly after the pause
+            self._budget = self._min_budget
+
+        logger.warning(f"{self.name}: retry budget exhausted, pausing all calls for {self._breaker_cooldown:.0f}s")
+
+    def _wait_if_open(self):
+        with self._lock:
+            wait = self._open_until - time.monotonic()
+            if wait <= 0:
+                return
+
+            # calls do not resume all at once
+            wait += random.uniform(0, self._base_delay)
+            self._waited += wait
+
+        time.sleep(wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'retries': sum(self._retries.values()),
+                'retries_by_status': dict(self._retries),
+                'failed': self._failed,
+                'breaker_opened': self._breaker_opened,
+                'waited_seconds': round(self._waited, 3)
+            }
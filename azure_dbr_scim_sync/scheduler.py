@@ -0,0 +1,143 @@
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from typing import Callable, Dict, Hashable, Iterable, List, Tuple
+
+logger = logging.getLogger('sync.scheduler')
+
+
+class DependencyScheduler:
+    """
+    Runs tasks on named pools of worker threads, each task as soon as all the tasks it depends on succeeded,
+    instead of waiting for all tasks of a previous phase.
+
+    Tasks depending on a task that failed (or was skipped) are skipped. Dependencies on keys that were never
+    added are considered met. Tasks that succeeded in a previous `run()` satisfy dependencies of later runs.
+    Dependencies must not form cycles. Tasks that are ready run in order they were added, hence tasks released
+    late do not wait for all the tasks that were ready before them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = Condition()
+        # tasks added since last run, in order: key -> (func, pool name, dependencies)
+        self._added: Dict[Hashable, Tuple[Callable, str, set]] = {}
+        self._failed = set()
+        # results of tasks that succeeded, in any run
+        self._results: Dict[Hashable, object] = {}
+
+        # state of current run
+        self._waiting: Dict[Hashable, set] = {}
+        self._dependents: Dict[Hashable, List[Hashable]] = {}
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        # pool -> heap of tasks that are ready, (order of task, key)
+        self._ready: Dict[str, List[Tuple[int, Hashable]]] = {}
+        self._order: Dict[Hashable, int] = {}
+        self._errors: List[Exception] = []
+        self._pending = 0
+
+    def add(self, key: Hashable, func: Callable, pool: str, depends_on: Iterable[Hashable] = ()):
+        """adds task `func`, identified by `key`, to run on `pool` after tasks with `depends_on` keys"""
+        if key in self._added or key in self._results or key in self._failed:
+            raise ValueError(f"{self.name}: task already added: {key}")
+        self._added[key] = (func, pool, set(depends_on) - {key})
+
+    def run(self, pool_sizes: Dict[str, int]) -> Tuple[Dict[Hashable, object], List[Exception]]:
+        """
+        runs all added tasks, `pool_sizes` is number of worker threads of each pool
+
+        :return: results of tasks that succeeded, by key, and errors of tasks that failed
+        """
+        tasks, self._added = self._added, {}
+        self._errors = []
+        self._waiting = {}
+        self._dependents = {}
+        self._ready = {pool: [] for pool in pool_sizes}
+        self._order = {key: i for i, key in enumerate(tasks)}
+        self._pending = len(tasks)
+        if not tasks:
+            return {}, []
+
+        self._executors = {
+            pool: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{self.name}_{pool}")
+            for pool, size in pool_sizes.items()
+        }
+        try:
+            with self._lock:
+                for key, (_, _, depends_on) in tasks.items():
+                    waiting = set(x for x in depends_on if x in tasks)
+                    for x in waiting:
+                        self._dependents.setdefault(x, []).append(key)
+                    self._waiting[key] = waiting
+
+                for key, (_, _, depends_on) in tasks.items():
+                    if depends_on & self._failed:
+                        self._skip(key, tasks)
+
+                ready = [key for key, waiting in self._waiting.items() if not waiting]
+                for key in ready:
+                    del self._waiting[key]
+                    self._submit(key, tasks)
+
+                while self._pending:
+                    self._lock.wait()
+        finally:
+            for executor in self._executors.values():
+                executor.shutdown()
+
+        return {k: self._results[k] for k in tasks if k in self._results}, self._errors
+
+    def result(self, key: Hashable):
+        """:return: result of task `key` that succeeded, None otherwise"""
+        with self._lock:
+            return self._results.get(key)
+
+    def _submit(self, key, tasks):
+        # has to be called with lock held, each submitted call runs the first task that is ready
+        _, pool, _ = tasks[key]
+        heapq.heappush(self._ready[pool], (self._order[key], key))
+        self._executors[pool].submit(self._execute_next, pool, tasks)
+
+    def _execute_next(self, pool, tasks):
+        with self._lock:
+            _, key = heapq.heappop(self._ready[pool])
+            func = tasks[key][0]
+
+        try:
+            result = func()
+        except Exception as e:
+            logger.error(f"{self.name}: task {key} failed: {e}")
+            with self._lock:
+                self._errors.append(e)
+                self._failed.add(key)
+                self._pending -= 1
+                for dependent in self._dependents.pop(key, []):
+                    self._skip(dependent, tasks)
+                self._lock.notify_all()
+            return
+
+        with self._lock:
+            self._results[key] = result
+            self._pending -= 1
+            for dependent in self._dependents.pop(key, []):
+                waiting = self._waiting.get(dependent)
+                if waiting is None:
+                    # skipped already
+                    continue
+                waiting.discard(key)
+                if not waiting:
+                    del self._waiting[dependent]
+                    self._submit(dependent, tasks)
+            self._lock.notify_all()
+
+    def _skip(self, key, tasks):
+        # has to be called with lock held, skips task and all its dependents
+        if key in self._failed:
+            return
+        logger.warning(f"{self.name}: skipping task {key}, as its dependency failed")
+        self._waiting.pop(key, None)
+        self._failed.add(key)
+        self._pending -= 1
+        for dependent in self._dependents.pop(key, []):
+            self._skip(dependent, tasks)
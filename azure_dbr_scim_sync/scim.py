@@ -1,28 +1,55 @@
-import functools
-import itertools
+import hashlib
+import json
 import logging
 import os
-import time
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import Callable, Generic, Iterable, List, TypeVar
+from array import array
+from threading import Lock
+from typing import Callable, Generic, Iterable, List, MutableMapping, Set, TypeVar
+from weakref import WeakKeyDictionary
 
 from databricks.sdk import AccountClient
-from databricks.sdk.core import DatabricksError
+from databricks.sdk.config import Config
+from databricks.sdk.core import ApiClient
 from databricks.sdk.service import iam
-from databricks.labs.blueprint.parallel import Threads
+from databricks.labs.blueprint.parallel import ManyError, Threads
 from functools import partial
 
-from .persisted_cache import Cache
+from .member_diff import MemberIds
+from .patch_planner import PatchPlanner
+from .rate_limit import ConcurrencyLimiter
+from .retry import RetryPolicy
+from .scheduler import DependencyScheduler
+from .scim_cache import IdIndex, PrincipalCache
+from .scim_index import PrincipalIndex
+from .scim_lookup import BatchedLookup
 from .version import __version__
 
 T = TypeVar("T")
 
 logger = logging.getLogger('sync.scim')
 
-user_cache = Cache(path='cache_user.json')
-group_cache = Cache(path='cache_group.json')
-spn_cache = Cache(path='cache_spn.json')
+user_cache = PrincipalCache(path='cache_user.json')
+group_cache = PrincipalCache(path='cache_group.json')
+spn_cache = PrincipalCache(path='cache_spn.json')
+# graph id <-> dbr id of all the synced principals
+id_index = IdIndex(path='cache_ids.json')
+
+# retries of throttled, or failed on server side, calls of all the workers
+scim_retry_policy = RetryPolicy('scim')
+# databricks sdk retries throttled (429, 503) requests on its own, until this timeout (in seconds), hence it
+# waits for `Retry-After` of the first response at most, and the call is then retried by `scim_retry_policy`
+_SDK_RETRY_TIMEOUT_SECONDS = 1
+# packing of group members changes into patches, with limits learned by all the workers
+scim_patch_planner = PatchPlanner('scim')
+
+# concurrency limiter of the current sync, by api client of account client, see `_limit_concurrency`
+_client_limiters: MutableMapping[ApiClient, ConcurrencyLimiter] = WeakKeyDictionary()
+_client_limiters_lock = Lock()
+
+# max number of members, new group is created with, others are added by patches
+_CREATE_GROUP_MAX_MEMBERS = 1000
 
 
 def get_account_client():
@@ -45,53 +72,23 @@ def get_account_client():
 
     if client_id and client_secret:
         logger.info("Using env variables auth")
-        return AccountClient(host=host,
-                             account_id=account_id,
-                             client_id=client_id,
-                             client_secret=client_secret,
-                             auth_type="azure-client-secret",
-                             product="azure_dbr_scim_sync",
-                             product_version=__version__)
+        return new_account_client(host=host,
+                                  account_id=account_id,
+                                  client_id=client_id,
+                                  client_secret=client_secret,
+                                  auth_type="azure-client-secret")
     else:
         # allow AccountClient do it's own auth method
         logger.info("Using databricks.sdk auth probing")
-        return AccountClient(host=host,
-                             account_id=account_id,
-                             product="azure_dbr_scim_sync",
-                             product_version=__version__)
-
-
-def retry_on_429(retry_num, retry_sleep_sec):
-    """
-    retry help decorator.
-    :param retry_num: the retry num; retry sleep sec
-    :return: decorator
-    """
+        return new_account_client(host=host, account_id=account_id)
 
-    def decorator(func):
-        """decorator"""
-        # preserve information about the original function, or the func name will be "wrapper" not "func"
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            """wrapper"""
-            for attempt in range(retry_num):
-                try:
-                    return func(*args, **kwargs)
-                except DatabricksError as err:
-                    msg = str(err) or ""
-                    if "Too Many Requests" in msg or msg.startswith("50"):
-                        logging.error("Trying attempt %s of %s. (in %s seconds)", attempt + 1, retry_num,
-                                      retry_sleep_sec)
-                        time.sleep(retry_sleep_sec)
-                    else:
-                        raise err
 
-            logging.error("func %s retry failed", func)
-            raise Exception('Exceed max retry num: {} failed'.format(retry_num))
-
-        return wrapper
-
-    return decorator
+def new_account_client(**kwargs) -> AccountClient:
+    """:return: account client, which throttled requests are retried by `scim_retry_policy`, not by the sdk"""
+    return AccountClient(config=Config(retry_timeout_seconds=_SDK_RETRY_TIMEOUT_SECONDS,
+                                       product="azure_dbr_scim_sync",
+                                       product_version=__version__,
+                                       **kwargs))
 
 
 @dataclass
@@ -101,6 +98,8 @@ class MergeResult(Generic[T]):
     created: T
     action: str
     changes: List[iam.Patch]
+    # actual state was not verified, it is trusted to be desired state, see `PrincipalCache`
+    trusted: bool = False
 
     @property
     def external_id(self) -> str:
@@ -126,22 +125,29 @@ _generic_type_map = {
     'user': {
         'key_obj_field': 'user_name',
         'key_api_field': 'userName',
+        'resource': 'Users',
         'cache': user_cache
     },
     'group': {
         'key_obj_field': 'display_name',
         'key_api_field': 'displayName',
+        'resource': 'Groups',
         'cache': group_cache
     },
     'spn': {
         'key_obj_field': 'application_id',
         'key_api_field': 'applicationId',
+        'resource': 'ServicePrincipals',
         'cache': spn_cache
     }
 }
 
 
-def _generic_get_by_human_name(mapper, sdk_module, search_name):
+def _generic_get_by_human_name(mapper,
+                               sdk_module,
+                               search_name,
+                               principal_index: PrincipalIndex = None,
+                               batched_lookup: BatchedLookup = None):
     cache = mapper['cache']
     key_obj_field = mapper['key_obj_field']
     key_api_field = mapper['key_api_field']
@@ -149,6 +155,20 @@ def _generic_get_by_human_name(mapper, sdk_module, search_name):
     cached_id = cache[search_name]
     obj = None
 
+    if principal_index is not None:
+        # index has all the principals, hence no need to verify the cache
+        obj = principal_index.get(mapper['resource'], search_name)
+        if obj:
+            logger.debug(f"Index hit: {search_name=}, {obj.id=}")
+            if cached_id != obj.id:
+                cache[search_name] = obj.id
+            return obj
+
+        logger.debug(f"{search_name=} does not exist")
+        if cached_id:
+            cache.invalidate(search_name)
+        return None
+
     if cached_id:
         # verify cache
         try:
@@ -163,9 +183,15 @@ def _generic_get_by_human_name(mapper, sdk_module, search_name):
         cache.invalidate(search_name)
 
     # cache miss or cache poison scenario
-    res = list(sdk_module.list(filter=f'{key_api_field} eq "{search_name}"') or [])
-    if res and len(res) == 1:
-        obj = res[0]
+    obj = None
+    if batched_lookup is not None:
+        obj = batched_lookup.get(search_name)
+    else:
+        res = list(sdk_module.list(filter=f'{key_api_field} eq "{search_name}"') or [])
+        if res and len(res) == 1:
+            obj = res[0]
+
+    if obj:
         cache[search_name] = obj.id
         logger.debug(f"Found, {search_name=}, {obj.id=}")
         return obj
@@ -175,12 +201,90 @@ def _generic_get_by_human_name(mapper, sdk_module, search_name):
     return None
 
 
+def _new_batched_lookup(mapper, sdk_module, search_names: Iterable[str]) -> BatchedLookup:
+    """lookup of principals by name, in batches of names that are not in the cache, see `BatchedLookup`"""
+    cache = mapper['cache']
+    return BatchedLookup(sdk_module,
+                         key_api_field=mapper['key_api_field'],
+                         key_obj_field=mapper['key_obj_field'],
+                         expected_keys=[x for x in search_names if not cache[x]])
+
+
+def _fingerprint(desired) -> str:
+    """hash of desired attributes of principal, other than group members"""
+    d = {k: v for k, v in desired.as_dict().items() if k != 'members'}
+    return hashlib.sha1(json.dumps(d, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _members_hash(member_dbr_ids: Iterable[str]) -> str:
+    """hash of group members (dbr ids)"""
+    return hashlib.sha1('\n'.join(sorted(member_dbr_ids)).encode('utf-8')).hexdigest()
+
+
+def _get_trusted_result(mapper, desired: T) -> MergeResult[T]:
+    """:return: 'no change' result, if cached principal is trusted to be in desired state, otherwise None"""
+    search_name = desired.__dict__[mapper['key_obj_field']]
+    trusted_id = mapper['cache'].get_trusted_id(search_name, _fingerprint(desired))
+    if not trusted_id:
+        return None
+
+    logger.debug(f"Cache trusted: {search_name=}, id={trusted_id}")
+    return _trusted_result(desired, trusted_id)
+
+
+def _trusted_result(desired: T, trusted_id: str) -> MergeResult[T]:
+    """:return: 'no change' result of principal trusted to be in desired state, with `trusted_id`"""
+    actual = deepcopy(desired)
+    actual.id = trusted_id
+    if isinstance(actual, iam.Group):
+        # only graph ids of desired members are known, members are verified by members sync
+        actual.members = None
+
+    return MergeResult(desired=deepcopy(desired),
+                       actual=actual,
+                       action="no change",
+                       changes=[],
+                       created=None,
+                       trusted=True)
+
+
 def _delete_if_exists_by_human_name(mapper, sdk_module, search_name):
     obj = _generic_get_by_human_name(mapper, sdk_module, search_name)
     if obj:
         logging.info(f"Deleting: {obj}")
         sdk_module.delete(obj.id)
         user_cache.invalidate(search_name)
+        id_index.invalidate_id(obj.id)
+
+
+def _run_phase(name: str, tasks: List[Callable], worker_threads: int) -> list:
+    """
+    runs `tasks` of a sync phase on `worker_threads` threads, and raises their errors after all tasks are done
+
+    :return: results of tasks that returned something, in no particular order
+    """
+    results, errors = Threads.gather(name, tasks, num_threads=worker_threads)
+    if errors:
+        if len(errors) == 1:
+            raise errors[0]
+        raise ManyError(errors)
+
+    return results
+
+
+def _limit_concurrency(account_client: AccountClient, max_concurrency: int) -> ConcurrencyLimiter:
+    """
+    passes all requests of `account_client` through new `ConcurrencyLimiter`, of up to `max_concurrency`,
+    calls of its api client are wrapped only by the first sync, next syncs replace the limiter
+    """
+    api_client = account_client.api_client
+    limiter = ConcurrencyLimiter('scim', max_concurrency)
+    with _client_limiters_lock:
+        if api_client not in _client_limiters:
+            do = api_client.do
+            api_client.do = lambda *args, **kwargs: _client_limiters[api_client].call(do, *args, **kwargs)
+        _client_limiters[api_client] = limiter
+    return limiter
 
 
 def _delete_if_exists_by_human_name_parallel(mapper, sdk_module, search_names, worker_threads):
@@ -189,10 +293,17 @@ def _delete_if_exists_by_human_name_parallel(mapper, sdk_module, search_names, w
                                     for search_name in search_names
     ]
 
-    Threads.strict("delete_by_name", tasks)
-
-def _generic_create_or_update(mapper, desired: T, actual: T, compare_fields: List[str], sdk_module,
-                              dry_run: bool) -> T:
+    _run_phase("delete_by_name", tasks, worker_threads)
+    mapper['cache'].flush()
+    id_index.flush()
+
+def _generic_create_or_update(mapper,
+                              desired: T,
+                              actual: T,
+                              compare_fields: List[str],
+                              sdk_module,
+                              dry_run: bool,
+                              member_dbr_ids: List[str] = None) -> T:
     ResultClass = MergeResult[T]
     cache = mapper['cache']
     key_obj_field = mapper['key_obj_field']
@@ -208,16 +319,18 @@ def _generic_create_or_update(mapper, desired: T, actual: T, compare_fields: Lis
         if not dry_run:
             d = deepcopy(desired.__dict__)
 
-            # dont create members, we do not know their dbr ids at this phase
-            # TODO: maybe there is a better way to handle it?
+            # desired members are graph ids, group is created only with members, which dbr ids are known,
+            # other members (and members over the limit) are added by members sync
             if isinstance(desired, iam.Group):
-                d['members'] = []
+                d['members'] = [iam.ComplexValue(value=x) for x in (member_dbr_ids or [])[:_CREATE_GROUP_MAX_MEMBERS]]
 
             created: T = sdk_module.create(**d)
             assert created
             assert created.id
 
-            cache[created.__dict__[key_obj_field]] = created.id
+            cache.set_verified(created.__dict__[key_obj_field], created.id, _fingerprint(desired))
+            if desired.external_id:
+                id_index.set(desired.external_id, created.id, _fingerprint(desired))
 
         return ResultClass(desired=desired, actual=None, action="new", changes=[], created=created)
     else:
@@ -254,6 +367,11 @@ def _generic_create_or_update(mapper, desired: T, actual: T, compare_fields: Lis
                 cache.invalidate(desired.__dict__[key_obj_field])
         else:
             logger.debug(f"[{dry_run=}] no changes, current={actual}")
+            cache.set_verified(desired.__dict__[key_obj_field], actual.id, _fingerprint(desired))
+
+        if desired.external_id:
+            # changed principal is verified again by next sync
+            id_index.set(desired.external_id, actual.id, None if operations else _fingerprint(desired))
 
         return ResultClass(desired=desired,
                            actual=actual,
@@ -266,15 +384,24 @@ def _generic_create_or_update_parallel(client: AccountClient,
                                        desired_objs: Iterable[T],
                                        create_fun: Callable,
                                        dry_run=False,
-                                       worker_threads: int = 3):
+                                       worker_threads: int = 3,
+                                       principal_index: PrincipalIndex = None,
+                                       batched_lookup: BatchedLookup = None):
     logger.info(f"[{dry_run=}] Starting processing: total={len(desired_objs)}")
 
     tasks = [
-        partial(create_fun, client, desired, dry_run) 
-        for desired in desired_objs
+        partial(create_fun,
+                client,
+                desired,
+                dry_run,
+                principal_index=principal_index,
+                batched_lookup=batched_lookup) for desired in desired_objs
     ]
 
-    merge_results: List[MergeResult[T]] = Threads.strict("create_or_update", tasks)
+    merge_results: List[MergeResult[T]] = _run_phase("create_or_update", tasks, worker_threads)
+    if batched_lookup is not None and batched_lookup.request_count:
+        logger.info(
+            f"[{dry_run=}] Looked up principals missing in cache, requests={batched_lookup.request_count}")
 
     total_change_count = sum(x.effecitve_change_count for x in merge_results)
     logger.info(f"[{dry_run=}] Finished processing, changes={total_change_count}, total={len(desired_objs)}")
@@ -308,8 +435,12 @@ class ScimSyncObject:
 #
 # Users
 #
-def get_user_by_email(client: AccountClient, user_name: str) -> iam.User:
-    return _generic_get_by_human_name(_generic_type_map['user'], client.users, user_name)
+def get_user_by_email(client: AccountClient,
+                      user_name: str,
+                      principal_index: PrincipalIndex = None,
+                      batched_lookup: BatchedLookup = None) -> iam.User:
+    return _generic_get_by_human_name(_generic_type_map['user'], client.users, user_name, principal_index,
+                                      batched_lookup)
 
 
 def delete_users_if_exists(client: AccountClient, user_name_list: List[str], worker_threads: int = 3):
@@ -317,16 +448,25 @@ def delete_users_if_exists(client: AccountClient, user_name_list: List[str], wor
                                              worker_threads)
 
 
-@retry_on_429(100, 1)
+@scim_retry_policy
 def delete_user_if_exists(client: AccountClient, email: str):
     _delete_if_exists_by_human_name(_generic_type_map['user'], client.users, email)
 
 
-@retry_on_429(100, 1)
-def create_or_update_user(client: AccountClient, desired_user: iam.User, dry_run=False):
+@scim_retry_policy
+def create_or_update_user(client: AccountClient,
+                          desired_user: iam.User,
+                          dry_run=False,
+                          principal_index: PrincipalIndex = None,
+                          batched_lookup: BatchedLookup = None):
+    trusted = _get_trusted_result(_generic_type_map['user'], desired_user)
+    if trusted:
+        return trusted
+
     return _generic_create_or_update(mapper=_generic_type_map['user'],
                                      desired=desired_user,
-                                     actual=get_user_by_email(client, desired_user.user_name),
+                                     actual=get_user_by_email(client, desired_user.user_name, principal_index,
+                                                              batched_lookup),
                                      compare_fields=["displayName", "active"],
                                      sdk_module=client.users,
                                      dry_run=dry_run)
@@ -335,13 +475,22 @@ def create_or_update_user(client: AccountClient, desired_user: iam.User, dry_run
 def create_or_update_users(client: AccountClient,
                            desired_users: Iterable[iam.User],
                            dry_run=False,
-                           worker_threads: int = 3):
+                           worker_threads: int = 3,
+                           principal_index: PrincipalIndex = None,
+                           batch_lookups=True):
+
+    batched_lookup = None
+    if batch_lookups:
+        batched_lookup = _new_batched_lookup(_generic_type_map['user'], client.users,
+                                             [x.user_name for x in desired_users])
 
     ret = _generic_create_or_update_parallel(client=client,
                                              desired_objs=desired_users,
                                              create_fun=create_or_update_user,
                                              dry_run=dry_run,
-                                             worker_threads=worker_threads)
+                                             worker_threads=worker_threads,
+                                             principal_index=principal_index,
+                                             batched_lookup=batched_lookup)
     user_cache.flush()
     return ret
 
@@ -349,8 +498,12 @@ def create_or_update_users(client: AccountClient,
 #
 # Groups
 #
-def get_group_by_name(client: AccountClient, group_name: str) -> iam.Group:
-    return _generic_get_by_human_name(_generic_type_map['group'], client.groups, group_name)
+def get_group_by_name(client: AccountClient,
+                      group_name: str,
+                      principal_index: PrincipalIndex = None,
+                      batched_lookup: BatchedLookup = None) -> iam.Group:
+    return _generic_get_by_human_name(_generic_type_map['group'], client.groups, group_name, principal_index,
+                                      batched_lookup)
 
 
 def delete_groups_if_exists(client: AccountClient, group_name_list: List[str], worker_threads: int = 3):
@@ -358,32 +511,53 @@ def delete_groups_if_exists(client: AccountClient, group_name_list: List[str], w
                                              worker_threads)
 
 
-@retry_on_429(100, 1)
+@scim_retry_policy
 def delete_group_if_exists(client: AccountClient, group_name: str):
     _delete_if_exists_by_human_name(_generic_type_map['group'], client.groups, group_name)
 
 
-@retry_on_429(100, 1)
+@scim_retry_policy
 def create_or_update_group(client: AccountClient,
                            desired_group: iam.Group,
-                           dry_run=False) -> List[MergeResult[iam.Group]]:
+                           dry_run=False,
+                           principal_index: PrincipalIndex = None,
+                           batched_lookup: BatchedLookup = None,
+                           member_dbr_ids: List[str] = None) -> List[MergeResult[iam.Group]]:
+    """
+    :param member_dbr_ids: dbr ids of members, to create new group with, instead of adding them by members sync
+    """
+    trusted = _get_trusted_result(_generic_type_map['group'], desired_group)
+    if trusted:
+        return trusted
+
     return _generic_create_or_update(mapper=_generic_type_map['group'],
                                      desired=desired_group,
-                                     actual=get_group_by_name(client, desired_group.display_name),
+                                     actual=get_group_by_name(client, desired_group.display_name, principal_index,
+                                                              batched_lookup),
                                      compare_fields=["displayName"],
                                      sdk_module=client.groups,
-                                     dry_run=dry_run)
+                                     dry_run=dry_run,
+                                     member_dbr_ids=member_dbr_ids)
 
 
 def create_or_update_groups(client: AccountClient,
                             desired_groups: Iterable[iam.Group],
                             dry_run=False,
-                            worker_threads: int = 3):
+                            worker_threads: int = 3,
+                            principal_index: PrincipalIndex = None,
+                            batch_lookups=True):
+    batched_lookup = None
+    if batch_lookups:
+        batched_lookup = _new_batched_lookup(_generic_type_map['group'], client.groups,
+                                             [x.display_name for x in desired_groups])
+
     ret = _generic_create_or_update_parallel(client=client,
                                              desired_objs=desired_groups,
                                              create_fun=create_or_update_group,
                                              dry_run=dry_run,
-                                             worker_threads=worker_threads)
+                                             worker_threads=worker_threads,
+                                             principal_index=principal_index,
+                                             batched_lookup=batched_lookup)
 
     group_cache.flush()
     return ret
@@ -392,8 +566,12 @@ def create_or_update_groups(client: AccountClient,
 #
 # Service principals
 #
-def get_service_principals_by_app(client: AccountClient, application_id: str) -> iam.ServicePrincipal:
-    return _generic_get_by_human_name(_generic_type_map['spn'], client.service_principals, application_id)
+def get_service_principals_by_app(client: AccountClient,
+                                  application_id: str,
+                                  principal_index: PrincipalIndex = None,
+                                  batched_lookup: BatchedLookup = None) -> iam.ServicePrincipal:
+    return _generic_get_by_human_name(_generic_type_map['spn'], client.service_principals, application_id,
+                                      principal_index, batched_lookup)
 
 
 def delete_service_principals_if_exists(client: AccountClient,
@@ -403,19 +581,26 @@ def delete_service_principals_if_exists(client: AccountClient,
                                              application_id_list, worker_threads)
 
 
-@retry_on_429(100, 1)
+@scim_retry_policy
 def delete_service_principal_if_exists(client: AccountClient, application_id: str):
     _delete_if_exists_by_human_name(_generic_type_map['spn'], client.service_principals, application_id)
 
 
-@retry_on_429(100, 1)
+@scim_retry_policy
 def create_or_update_service_principal(client: AccountClient,
                                        desired_service_principal: iam.ServicePrincipal,
-                                       dry_run=False) -> List[MergeResult[iam.ServicePrincipal]]:
+                                       dry_run=False,
+                                       principal_index: PrincipalIndex = None,
+                                       batched_lookup: BatchedLookup = None) -> List[MergeResult[iam.ServicePrincipal]]:
+    trusted = _get_trusted_result(_generic_type_map['spn'], desired_service_principal)
+    if trusted:
+        return trusted
+
     return _generic_create_or_update(mapper=_generic_type_map['spn'],
                                      desired=desired_service_principal,
                                      actual=get_service_principals_by_app(
-                                         client, desired_service_principal.application_id),
+                                         client, desired_service_principal.application_id, principal_index,
+                                         batched_lookup),
                                      compare_fields=["displayName", "active"],
                                      sdk_module=client.service_principals,
                                      dry_run=dry_run)
@@ -424,13 +609,22 @@ def create_or_update_service_principal(client: AccountClient,
 def create_or_update_service_principals(client: AccountClient,
                                         desired_service_principals: Iterable[iam.ServicePrincipal],
                                         dry_run=False,
-                                        worker_threads: int = 3):
+                                        worker_threads: int = 3,
+                                        principal_index: PrincipalIndex = None,
+                                        batch_lookups=True):
+
+    batched_lookup = None
+    if batch_lookups:
+        batched_lookup = _new_batched_lookup(_generic_type_map['spn'], client.service_principals,
+                                             [x.application_id for x in desired_service_principals])
 
     ret = _generic_create_or_update_parallel(client=client,
                                              desired_objs=desired_service_principals,
                                              create_fun=create_or_update_service_principal,
                                              dry_run=dry_run,
-                                             worker_threads=worker_threads)
+                                             worker_threads=worker_threads,
+                                             principal_index=principal_index,
+                                             batched_lookup=batched_lookup)
     spn_cache.flush()
     return ret
 
@@ -440,11 +634,9 @@ def create_or_update_service_principals(client: AccountClient,
 #
 
 
-# https://stackoverflow.com/questions/312443/how-do-i-split-a-list-into-equally-sized-chunks/22045226#22045226
-def _chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield list(lst[i:i + n])
+def _log_request_stats(limiter: ConcurrencyLimiter):
+    logger.info(f"SCIM requests: {limiter.stats()}, retries: {scim_retry_policy.stats()}, "
+                f"patches: {scim_patch_planner.stats()}")
 
 
 def sync(*,
@@ -455,22 +647,143 @@ def sync(*,
          deep_sync_group_names: Iterable[str],
          dry_run_security_principals=False,
          dry_run_members=False,
-         worker_threads: int = 10):
+         worker_threads: int = 10,
+         member_worker_threads: int = None,
+         prefetch_principals=False,
+         batch_lookups=True,
+         cache_trust_ttl: int = 0,
+         cache_trust_sample_rate: float = 0.05,
+         skip_unchanged_members=False):
+    """
+    Creates or updates users, service principals and groups, all at the same time, and syncs members of
+    each deep synced group as soon as the group, and all its members, are created or updated.
+
+    :param worker_threads: number of concurrent requests when creating or updating principals
+    :param member_worker_threads: number of groups, which members are synced concurrently,
+        by default `worker_threads`
+    :param skip_unchanged_members: users and service principals, that did not change since they were last
+        synced, are not created or updated, their ids are taken from `id_index`
+    """
+    member_worker_threads = member_worker_threads or worker_threads
+    # concurrency of all the phases is lowered when SCIM API is overloaded
+    limiter = _limit_concurrency(account_client, max(worker_threads, member_worker_threads))
+
+    for kind in ['user', 'group', 'spn']:
+        # see `PrincipalCache`
+        _generic_type_map[kind]['cache'].trust_ttl = cache_trust_ttl
+        _generic_type_map[kind]['cache'].trust_sample_rate = cache_trust_sample_rate
+
+    principal_index = None
+    if prefetch_principals:
+        # one bulk download of the account, instead of looking up every principal one by one
+        logger.info("Downloading all users, groups and service principals of the account...")
+        principal_index = PrincipalIndex.build(account_client,
+                                               worker_threads=worker_threads,
+                                               retry_policy=scim_retry_policy)
+
+    users, groups, service_principals = list(users), list(groups), list(service_principals)
+
+    # deep sync group names
+    group_name_to_external_ids = {g.display_name: g.external_id for g in groups}
+
+    deep_sync_group_external_ids = set(group_name_to_external_ids[u] for u in deep_sync_group_names)
+    assert len(deep_sync_group_names) == len(deep_sync_group_external_ids)
+
+    upserts = {
+        'user': (create_or_update_user, account_client.users),
+        'group': (create_or_update_group, account_client.groups),
+        'spn': (create_or_update_service_principal, account_client.service_principals)
+    }
+    order = _upsert_order(users, groups, service_principals, deep_sync_group_external_ids)
+
+    batched_lookups = {}
+    if batch_lookups:
+        for kind, (_, sdk_module) in upserts.items():
+            mapper = _generic_type_map[kind]
+            batched_lookups[kind] = _new_batched_lookup(
+                mapper, sdk_module, [x.__dict__[mapper['key_obj_field']] for k, x in order if k == kind])
+
+    # new deep synced groups are created with their members, hence after users and service principals of the group
+    create_groups_with_members = not (dry_run_security_principals or dry_run_members)
+    principal_kinds = {x.external_id: kind for kind, x in order}
+
+    scheduler = DependencyScheduler('sync')
+    # ids of principals, as they are created or updated, for diffs of members
+    member_ids = MemberIds()
+    skipped = 0
+    for kind, desired in order:
+        indexed_id = None
+        if skip_unchanged_members and kind in ['user', 'spn']:
+            indexed_id = id_index.get_id(desired.external_id, _fingerprint(desired))
+        if indexed_id:
+            skipped += 1
+            scheduler.add(desired.external_id,
+                          partial(_upsert_and_map_ids, partial(_trusted_result, desired, indexed_id), member_ids),
+                          pool='upserts')
+            continue
+
+        upsert = partial(upserts[kind][0],
+                         account_client,
+                         desired,
+                         dry_run_security_principals,
+                         principal_index=principal_index,
+                         batched_lookup=batched_lookups.get(kind))
+        depends_on = []
+        if kind == 'group' and create_groups_with_members and desired.external_id in deep_sync_group_external_ids:
+            member_external_ids = [x.value for x in desired.members or []]
+            upsert = partial(_create_or_update_group_with_members, upsert, member_ids, member_external_ids)
+            # only new groups wait for their members, nested groups may depend on each other, they are added
+            # by members sync, unless already synced
+            if not _is_group_known(desired, principal_index):
+                depends_on = [x for x in member_external_ids if principal_kinds.get(x) in ['user', 'spn']]
+
+        scheduler.add(desired.external_id,
+                      partial(_upsert_and_map_ids, upsert, member_ids),
+                      pool='upserts',
+                      depends_on=depends_on)
+
+    def _add_member_tasks():
+        for group in groups:
+            if group.external_id not in deep_sync_group_external_ids:
+                logger.warning(
+                    f"Shallow synced group detected, skipping member sync for: name={group.display_name}, id={group.external_id}"
+                )
+                continue
+
+            # released as soon as the group, and all its members, have Databricks ids
+            member_external_ids = [x.value for x in group.members or []]
+            scheduler.add(('members', group.external_id),
+                          partial(_sync_group_members_or_error, account_client, scheduler, member_ids,
+                                  group.external_id, member_external_ids, dry_run_members, skip_unchanged_members),
+                          pool='members',
+                          depends_on=[group.external_id] + member_external_ids)
+
+    if skipped:
+        logger.info(f"Skipping {skipped} users and service principals, unchanged since last sync")
+
+    # in dry run, pending changes of principals have to be known before any members are synced
+    if not dry_run_security_principals:
+        _add_member_tasks()
 
     logger.info("Starting creating or updating users, groups and service principals...")
-    result = ScimSyncObject(users=create_or_update_users(account_client,
-                                                         users,
-                                                         dry_run=dry_run_security_principals,
-                                                         worker_threads=worker_threads),
-                            service_principals=create_or_update_service_principals(
-                                account_client,
-                                service_principals,
-                                dry_run=dry_run_security_principals,
-                                worker_threads=worker_threads),
-                            groups=create_or_update_groups(account_client,
-                                                           groups,
-                                                           dry_run=dry_run_security_principals,
-                                                           worker_threads=worker_threads))
+    pool_sizes = {'upserts': worker_threads, 'members': member_worker_threads}
+    results, errors = scheduler.run(pool_sizes)
+
+    for kind, batched_lookup in batched_lookups.items():
+        if batched_lookup.request_count:
+            logger.info(f"Looked up {kind} principals missing in cache, requests={batched_lookup.request_count}")
+
+    for cache in (user_cache, spn_cache, group_cache, id_index):
+        cache.flush()
+
+    if errors:
+        # not all principals were created or updated, member syncs of their groups were skipped
+        _log_request_stats(limiter)
+        _raise_errors(errors + [x for x in results.values() if isinstance(x, Exception)])
+
+    result = ScimSyncObject(users=[scheduler.result(x.external_id) for x in users],
+                            service_principals=[scheduler.result(x.external_id) for x in service_principals],
+                            groups=[scheduler.result(x.external_id) for x in groups])
 
     logger.info(
         f"Finished creating and updating, changes counts: users={result.users_effecitve_change_count}, groups={result.groups_effecitve_change_count}, service_principals={result.service_principals_effecitve_change_count}"
@@ -480,101 +793,151 @@ def sync(*,
             logger.warning(
                 "There are pending changes, dry run cannot continue without first applying these changes. Run with --dry-run-members to apply above changes and display changes to group membership without applying them."
             )
+            _log_request_stats(limiter)
             return result
         else:
             logger.info("There are no pending changes, dry run will continue...")
 
-    logger.info("Starting synchronization of group members...")
+        logger.info("Starting synchronization of group members...")
+        _add_member_tasks()
+        results, errors = scheduler.run(pool_sizes)
 
-    # xref both ways
-    graph_to_dbr_ids = {
-        u.external_id: u.id
-        for u in itertools.chain(result.users, result.groups, result.service_principals)
-    }
+    # member tasks return errors of groups that failed, other groups are synced nevertheless
+    group_cache.flush()
+    id_index.flush()
+    _log_request_stats(limiter)
+    _raise_errors(errors + [x for x in results.values() if isinstance(x, Exception)])
 
-    dbr_to_graph_ids = {
-        u.id: u.external_id
-        for u in itertools.chain(result.users, result.groups, result.service_principals)
-    }
+    return result
 
-    assert len(graph_to_dbr_ids) == len(dbr_to_graph_ids)
 
-    # deep sync group names
-    group_name_to_external_ids = {u.desired.display_name: u.external_id for u in result.groups}
+def _upsert_order(users: List[iam.User], groups: List[iam.Group], service_principals: List[iam.ServicePrincipal],
+                  deep_sync_group_external_ids: Set[str]):
+    """
+    orders principals so that members of deep synced groups, and then the group, are created or updated
+    one group after another, and all other principals after them
 
-    deep_sync_group_external_ids = set(group_name_to_external_ids[u] for u in deep_sync_group_names)
-    assert len(deep_sync_group_names) == len(deep_sync_group_external_ids)
+    :return: (kind, principal) in order
+    """
+    kinds = {}
+    for kind, objs in [('user', users), ('spn', service_principals), ('group', groups)]:
+        for x in objs:
+            kinds[x.external_id] = (kind, x)
 
-    # check which group members to add or remove
-    for group_merge_result in result.groups:
-        if group_merge_result.external_id not in deep_sync_group_external_ids:
-            logger.warning(
-                f"Shallow synced group detected, skipping member sync for: name={group_merge_result.effective.display_name}, id={group_merge_result.external_id}"
-            )
-            continue
+    ordered = {}
+    for group in groups:
+        if group.external_id in deep_sync_group_external_ids:
+            for member in group.members or []:
+                if member.value in kinds:
+                    ordered.setdefault(member.value, kinds[member.value])
+            ordered.setdefault(group.external_id, kinds[group.external_id])
 
-        # desired group uses external_id's to show membership
-        graph_group_member_ids = set(x.value for x in group_merge_result.desired.members)
+    for external_id, x in kinds.items():
+        ordered.setdefault(external_id, x)
 
-        # .effective is either created, or actual group
-        dbr_group = group_merge_result.effective
-        dbr_group_members = dbr_group.members or []
+    return list(ordered.values())
 
-        # we will action that using .patch command
-        to_delete_member_dbr_ids = set()
 
-        visited_member_dbr_ids = set()
-        visited_member_graph_ids = set()
+def _upsert_and_map_ids(upsert: Callable, member_ids: MemberIds) -> MergeResult:
+    """creates or updates principal with `upsert`, and maps its graph id to its dbr id in `member_ids`"""
+    merge_result = upsert()
+    # not created in dry run
+    if merge_result.effective is not None:
+        member_ids.set(merge_result.external_id, merge_result.id)
+    return merge_result
 
-        # process members that needs deleting from dbr group
-        for dbr_member in dbr_group_members:
-            member_dbr_id = dbr_member.value
-            member_graph_id = dbr_to_graph_ids.get(member_dbr_id)
 
-            # if not in graph group membership, mark as to remove
-            if (not member_graph_id) or (member_graph_id not in graph_group_member_ids):
-                to_delete_member_dbr_ids.add(member_dbr_id)
-                continue
+def _is_group_known(desired: iam.Group, principal_index: PrincipalIndex = None) -> bool:
+    """:return: True if group was synced before, or is in prefetched `principal_index`, i.e. is not created"""
+    if group_cache.get(desired.display_name) or id_index.get_id(desired.external_id):
+        return True
+    return bool(principal_index and principal_index.get('Groups', desired.display_name))
 
-            # mark visited ones, so we don't consider them later
-            visited_member_dbr_ids.add(member_dbr_id)
-            visited_member_graph_ids.add(member_graph_id)
-
-        # process members that needs adding to dbr group
-        to_add_member_graph_ids = graph_group_member_ids - visited_member_graph_ids
-        to_add_member_dbr_ids = set(graph_to_dbr_ids[x] for x in to_add_member_graph_ids
-                                    if x in graph_to_dbr_ids)
-
-        # create patch entries
-        # https://api-docs.databricks.com/rest/latest/account-scim-api.html
-        patch_operations = []
-
-        # first delete members, to resolve itermitent circle of A in B group membership changing into B in A.
-        if to_delete_member_dbr_ids:
-            patch_operations.extend([
-                iam.Patch(op=iam.PatchOp.REMOVE, path=f"members[value eq \"{x}\"]")
-                for x in to_delete_member_dbr_ids
-            ])
-
-        if to_add_member_dbr_ids:
-            add_chunks = list(_chunks(list(to_add_member_dbr_ids), 50))
-            for ac in add_chunks:
-                patch_operations.append(
-                    iam.Patch(op=iam.PatchOp.ADD, value={'members': [{
-                        'value': x
-                    } for x in ac]}))
-
-        if patch_operations:
-            logger.info(
-                f"group {group_merge_result.desired.display_name} members changes: {patch_operations}")
-            group_merge_result.changes.extend(patch_operations)
-
-            if not dry_run_members:
-                patch_chunks = list(_chunks(patch_operations, 50))
-                for pc in patch_chunks:
-                    account_client.groups.patch(
-                        id=group_merge_result.id,
-                        operations=pc,
-                        schemas=[iam.PatchSchema.URN_IETF_PARAMS_SCIM_API_MESSAGES_2_0_PATCH_OP])
 
-    return result
+def _create_or_update_group_with_members(upsert: Callable, member_ids: MemberIds,
+                                         member_external_ids: List[str]) -> MergeResult[iam.Group]:
+    """creates or updates group with `upsert`, new group is created with members, that were already synced"""
+    return upsert(member_dbr_ids=member_ids.dbr_ids.values(member_ids.desired(member_external_ids)))
+
+
+def _raise_errors(errors: List[Exception]):
+    if errors:
+        if len(errors) == 1:
+            raise errors[0]
+        raise ManyError(errors)
+
+
+def _sync_group_members_or_error(account_client: AccountClient,
+                                 scheduler: DependencyScheduler,
+                                 member_ids: MemberIds,
+                                 group_external_id: str,
+                                 member_external_ids: List[str],
+                                 dry_run_members: bool,
+                                 use_id_index=False) -> Exception:
+    """
+    syncs members of group, created or updated by `scheduler`, using ids of its members in `member_ids`
+
+    :param use_id_index: members, that are not synced by `scheduler`, are resolved from `id_index`
+    :return: error of `_sync_group_members()`, so that errors of other groups are reported too
+    """
+    group_merge_result = scheduler.result(group_external_id)
+    # members, that are not synced, are ignored
+    desired_member_ids = member_ids.desired(member_external_ids, id_index.get_id if use_id_index else None)
+
+    try:
+        _sync_group_members(account_client, group_merge_result, desired_member_ids, member_ids, dry_run_members)
+    except Exception as e:
+        logger.error(f"group {group_merge_result.desired.display_name} members sync failed: {e}")
+        # i.e. member was deleted, hence members of the group are not trusted to be unchanged by next sync
+        for x in member_external_ids:
+            id_index.invalidate(x)
+        return e
+
+
+def _sync_group_members(account_client: AccountClient,
+                        group_merge_result: MergeResult[iam.Group],
+                        desired_member_ids: array,
+                        member_ids: MemberIds,
+                        dry_run_members: bool):
+    """
+    diffs members of group with desired members, and applies the patches in order, removals first
+
+    :param desired_member_ids: sorted dbr ids of desired members, interned by `member_ids`
+    """
+    group_name = group_merge_result.desired.display_name
+    # members are trusted to be unchanged only when cache is trusted
+    members_hash = _members_hash(member_ids.dbr_ids.values(desired_member_ids)) if group_cache.trust_ttl else None
+    if group_merge_result.trusted:
+        if (group_cache.get_entry(group_name) or {}).get('members_hash') == members_hash:
+            logger.debug(f"group {group_name} members are trusted to be in sync")
+            return
+
+        # members were changed, or created, since members were last applied
+        group_merge_result.actual = scim_retry_policy.call(account_client.groups.get, group_merge_result.id)
+
+    # .effective is either created, or actual group
+    dbr_group = group_merge_result.effective
+    actual_member_ids = member_ids.actual(x.value for x in dbr_group.members or [])
+    to_delete_member_ids, to_add_member_ids = member_ids.diff(desired_member_ids, actual_member_ids)
+
+    # first delete members, to resolve itermitent circle of A in B group membership changing into B in A.
+    # https://api-docs.databricks.com/rest/latest/account-scim-api.html
+    to_delete = member_ids.dbr_ids.values(to_delete_member_ids)
+    to_add = member_ids.dbr_ids.values(to_add_member_ids)
+    patch_chunks = scim_patch_planner.plan(to_delete, to_add)
+    if patch_chunks:
+        patch_operations = [op for pc in patch_chunks for op in pc.operations]
+        logger.info(f"group {group_name} members changes: {patch_operations}")
+        group_merge_result.changes.extend(patch_operations)
+
+        if not dry_run_members:
+            # chunks of the group are applied one after another
+            patch = partial(scim_retry_policy.call,
+                            account_client.groups.patch,
+                            id=group_merge_result.id,
+                            schemas=[iam.PatchSchema.URN_IETF_PARAMS_SCIM_API_MESSAGES_2_0_PATCH_OP])
+            scim_patch_planner.apply(patch, to_delete, to_add)
+
+    # members not applied (dry run) cannot be trusted
+    group_cache.set_members_hash(group_name, group_merge_result.id,
+                                 None if patch_chunks and dry_run_members else members_hash)
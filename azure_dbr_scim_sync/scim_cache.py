@@ -0,0 +1,133 @@
+import logging
+import random
+import time
+
+from .persisted_cache import Cache
+
+logger = logging.getLogger('sync.cache')
+
+
+class PrincipalCache(Cache):
+    """
+    Persisted cache of Databricks principal ids, name -> `{'id', 'verified_at', 'fingerprint', 'members_hash'}`,
+    where `fingerprint` (attributes) and `members_hash` (group members) describe the last applied state.
+    Entries of older versions (name -> id) are still understood.
+
+    `cache[name]` returns the id. Without trust (`trust_ttl=0`, default) cached ids are always verified by
+    the caller. Otherwise entries verified within `trust_ttl` seconds, with the fingerprint of the desired
+    state, are trusted without verification, except for the random `trust_sample_rate` fraction of them.
+    """
+
+    def __init__(self, path: str, trust_ttl: int = 0, trust_sample_rate: float = 0.05, **kwargs):
+        self.trust_ttl = trust_ttl
+        self.trust_sample_rate = trust_sample_rate
+        # every synced principal gets verified, hence changes are persisted by `flush()` after each sync phase
+        super().__init__(path, auto_flush=False, **kwargs)
+
+    def get_entry(self, key) -> dict:
+        with self._lock:
+            entry = self._data.get(key)
+            if isinstance(entry, str):
+                return {'id': entry}
+            return dict(entry) if entry else None
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry['id'] if entry else None
+
+    def __setitem__(self, key, value):
+        """caches verified id of `key`, fingerprints are kept if the id did not change"""
+        with self._lock:
+            entry = self.get_entry(key) or {}
+            if entry.get('id') != value:
+                entry = {}
+            super().__setitem__(key, {**entry, 'id': value, 'verified_at': time.time()})
+
+    def set_verified(self, key, id: str, fingerprint: str):
+        """caches id of `key`, verified to have attributes with `fingerprint`"""
+        with self._lock:
+            self[key] = id
+            super().__setitem__(key, {**self.get_entry(key), 'fingerprint': fingerprint})
+
+    def set_members_hash(self, key, id: str, members_hash: str):
+        """records members of group `key` as applied, unless group is no longer cached with `id`"""
+        with self._lock:
+            entry = self.get_entry(key)
+            if entry and entry['id'] == id and entry.get('members_hash') != members_hash:
+                super().__setitem__(key, {**entry, 'members_hash': members_hash})
+
+    def get_trusted_id(self, key, fingerprint: str) -> str:
+        """:return: id of `key` if its entry can be trusted without verification, None otherwise"""
+        if not self.trust_ttl:
+            return None
+
+        entry = self.get_entry(key)
+        if not entry or entry.get('fingerprint') != fingerprint:
+            return None
+
+        if time.time() - entry.get('verified_at', 0) > self.trust_ttl:
+            return None
+
+        if random.random() < self.trust_sample_rate:
+            logger.debug(f"Cache trust: sampled for verification: {key}")
+            return None
+
+        return entry['id']
+
+
+class IdIndex(Cache):
+    """
+    Persisted index of ids of synced principals, graph id -> `{'id', 'fingerprint'}`, and Databricks id -> graph id,
+    where `fingerprint` describes attributes of principal, when it was last created or verified.
+
+    Principals with the same fingerprint are unchanged since, and their ids can be used without looking them up.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        # ids of all the synced principals are set, hence changes are persisted by `flush()` after each sync
+        super().__init__(path, auto_flush=False, **kwargs)
+        self._external_ids = {v['id']: k for k, v in self._data.items()}
+
+    def set(self, external_id: str, id: str, fingerprint: str = None):
+        """indexes principal `external_id` with Databricks `id`, verified to have attributes with `fingerprint`"""
+        with self._lock:
+            entry = self._data.get(external_id)
+            if entry == {'id': id, 'fingerprint': fingerprint}:
+                return
+
+            if entry:
+                self._external_ids.pop(entry['id'], None)
+            self[external_id] = {'id': id, 'fingerprint': fingerprint}
+            self._external_ids[id] = external_id
+
+    def invalidate(self, external_id: str):
+        with self._lock:
+            entry = self._data.get(external_id)
+            if entry:
+                self._external_ids.pop(entry['id'], None)
+            super().invalidate(external_id)
+
+    def invalidate_id(self, id: str):
+        """removes principal with Databricks `id`, i.e. when it was deleted"""
+        with self._lock:
+            external_id = self._external_ids.get(id)
+            if external_id:
+                self.invalidate(external_id)
+
+    def get_id(self, external_id: str, fingerprint: str = None) -> str:
+        """:return: Databricks id of `external_id`, if `fingerprint` is given only when it is unchanged"""
+        with self._lock:
+            entry = self._data.get(external_id)
+            if not entry or (fingerprint and entry['fingerprint'] != fingerprint):
+                return None
+            return entry['id']
+
+    def get_external_id(self, id: str) -> str:
+        """:return: graph id of principal with Databricks `id`"""
+        with self._lock:
+            return self._external_ids.get(id)
+
+    def clear(self):
+        with self._lock:
+            self._external_ids = {}
+            super().clear()
@@ -0,0 +1,132 @@
+import logging
+from functools import partial
+from typing import Dict, List
+
+from databricks.labs.blueprint.parallel import ManyError, Threads
+from databricks.sdk import AccountClient
+from databricks.sdk.service import iam
+
+from .retry import RetryPolicy
+
+logger = logging.getLogger('sync.scim')
+
+
+class PrincipalIndex:
+    """
+    In memory index of all users, groups and service principals of the account, downloaded in bulk,
+    with only attributes needed by the sync. Lookups of principals by name (user name, group display name,
+    or application id of service principal) or by external id are then answered without calling SCIM API.
+
+    Pages are requested concurrently by `startIndex`, once first page tells total number of results.
+    """
+
+    # resource -> (model, key attribute, attributes to download, page size)
+    _RESOURCES = {
+        'Users': (iam.User, 'userName', 'id,userName,displayName,active,externalId', 1000),
+        'Groups': (iam.Group, 'displayName', 'id,displayName,externalId,members', 100),
+        'ServicePrincipals': (iam.ServicePrincipal, 'applicationId', 'id,applicationId,displayName,active,externalId',
+                              1000)
+    }
+
+    def __init__(self):
+        # resource -> key -> principal
+        self._by_key: Dict[str, Dict[str, object]] = {x: {} for x in self._RESOURCES}
+        # resource -> lower case key -> principals, as names are compared case insensitively by SCIM API
+        self._by_lower_key: Dict[str, Dict[str, List[object]]] = {x: {} for x in self._RESOURCES}
+        # resource -> external id -> principal
+        self._by_external_id: Dict[str, Dict[str, object]] = {x: {} for x in self._RESOURCES}
+
+    @classmethod
+    def build(cls,
+              client: AccountClient,
+              resources: List[str] = None,
+              worker_threads: int = 10,
+              retry_policy: RetryPolicy = None) -> 'PrincipalIndex':
+        """
+        downloads all principals of `resources` (by default users, groups and service principals)
+
+        :param worker_threads: number of pages downloaded concurrently
+        :param retry_policy: retries download of each page
+        """
+        index = cls()
+        for resource in resources or list(cls._RESOURCES):
+            index._add_all(
+                resource,
+                _list_all(client, resource, *cls._RESOURCES[resource][2:], worker_threads, retry_policy))
+
+        return index
+
+    def _add_all(self, resource: str, values: List[dict]):
+        model, key_attr, _, _ = self._RESOURCES[resource]
+        for v in values:
+            obj = model.from_dict(v)
+            if v.get(key_attr) is not None:
+                self._by_key[resource][v[key_attr]] = obj
+                self._by_lower_key[resource].setdefault(v[key_attr].lower(), []).append(obj)
+            if obj.external_id:
+                self._by_external_id[resource][obj.external_id] = obj
+
+        logger.info(f"Indexed {resource}: {len(values)}")
+
+    def get(self, resource: str, key: str):
+        """
+        :return: principal with `key` (user name, group display name or application id), or the only principal
+          with `key` in other case, or None
+        """
+        obj = self._by_key[resource].get(key)
+        if obj is None:
+            matches = self._by_lower_key[resource].get(key.lower()) or []
+            obj = matches[0] if len(matches) == 1 else None
+
+        return obj
+
+    def get_by_external_id(self, resource: str, external_id: str):
+        return self._by_external_id[resource].get(external_id)
+
+    def __len__(self):
+        return sum(len(x) for x in self._by_key.values())
+
+
+def _list_all(client: AccountClient,
+              resource: str,
+              attributes: str,
+              page_size: int,
+              worker_threads: int,
+              retry_policy: RetryPolicy = None) -> List[dict]:
+    """downloads all pages of SCIM `resource` listing, first one to learn total number of results, rest concurrently"""
+    path = f"/api/2.0/accounts/{client.api_client.account_id}/scim/v2/{resource}"
+
+    def _get_page(start_index: int) -> dict:
+        return client.api_client.do('GET',
+                                    path,
+                                    query={
+                                        'attributes': attributes,
+                                        'startIndex': start_index,
+                                        'count': page_size
+                                    },
+                                    headers={'Accept': 'application/json'})
+
+    if retry_policy:
+        _get_page = retry_policy(_get_page)
+
+    first = _get_page(1)
+    values = list(first.get('Resources') or [])
+    total = int(first.get('totalResults') or 0)
+    # server can return fewer results than requested
+    step = len(values) or page_size
+
+    tasks = [partial(_get_page, start_index) for start_index in range(1 + step, total + 1, step)]
+    logger.info(f"Downloading {resource}: total={total}, pages={len(tasks) + 1}")
+    if tasks:
+        pages, errors = Threads.gather(f"list_{resource.lower()}", tasks, num_threads=worker_threads)
+        if errors:
+            if len(errors) == 1:
+                raise errors[0]
+            raise ManyError(errors)
+
+        for page in pages:
+            values.extend(page.get('Resources') or [])
+
+    # principals created or deleted during the download can shift pages
+    seen = set()
+    return [v for v in values if not (v['id'] in seen or seen.add(v['id']))]
@@ -0,0 +1,102 @@
+import logging
+from concurrent.futures import Future
+from threading import Lock
+from typing import Dict, Iterable, List
+
+logger = logging.getLogger('sync.scim')
+
+
+class BatchedLookup:
+    """
+    Looks up principals by name (`key_api_field`) using SCIM filters of many names each:
+    `userName eq "a" or userName eq "b" ...`, shared by all the worker threads.
+
+    Lookup of a name, that is not being looked up already, sends a filter with that name, and with the
+    upcoming names (`expected_keys`, i.e. names missing in the cache), so that their lookups are answered
+    with results of the same request. Threads looking up a name that is already in flight wait for results.
+    """
+
+    # max number of names in a filter, and max length of the filter
+    _BATCH_SIZE = 50
+    _MAX_FILTER_LENGTH = 4000
+
+    def __init__(self, sdk_module, key_api_field: str, key_obj_field: str, expected_keys: Iterable[str] = ()):
+        self._sdk_module = sdk_module
+        self._key_api_field = key_api_field
+        self._key_obj_field = key_obj_field
+        self._lock = Lock()
+        # names to look up ahead, in order of their expected lookups
+        self._expected: Dict[str, bool] = dict.fromkeys(expected_keys, True)
+        # name -> future of results of the filter request with that name
+        self._requests: Dict[str, Future] = {}
+        self.request_count = 0
+
+    def _condition(self, key: str) -> str:
+        return f'{self._key_api_field} eq "{key}"'
+
+    def _next_batch(self, key: str) -> List[str]:
+        # has to be called with lock held
+        batch = [key]
+        length = len(self._condition(key))
+        for k in list(self._expected):
+            if len(batch) >= self._BATCH_SIZE:
+                break
+            length += len(self._condition(k)) + len(' or ')
+            if length > self._MAX_FILTER_LENGTH:
+                break
+            if k != key and k not in self._requests:
+                batch.append(k)
+
+        for k in batch:
+            self._expected.pop(k, None)
+
+        return batch
+
+    def get(self, key: str):
+        """:return: principal with name `key`, or None when it does not exist (or name is not unique)"""
+        with self._lock:
+            future = self._requests.get(key)
+            batch = None
+            if future is None:
+                batch = self._next_batch(key)
+                future = Future()
+                for k in batch:
+                    self._requests[k] = future
+
+        if batch:
+            self._send(batch, future)
+
+        results = future.result()
+        with self._lock:
+            # name is looked up again, when asked again
+            if self._requests.get(key) is future:
+                self._requests.pop(key)
+
+        matches = results.get(key)
+        if matches is None:
+            matches = results.get(key.lower()) or []
+
+        return matches[0] if len(matches) == 1 else None
+
+    def _send(self, batch: List[str], future: Future):
+        try:
+            self.request_count += 1
+            logger.debug(f"Looking up {len(batch)} principal(s) by {self._key_api_field}")
+            res = list(self._sdk_module.list(filter=' or '.join(self._condition(k) for k in batch)) or [])
+        except Exception as e:
+            with self._lock:
+                for k in batch:
+                    if self._requests.get(k) is future:
+                        self._requests.pop(k)
+            future.set_exception(e)
+            return
+
+        # exact matches, and case insensitive matches, as names are compared by SCIM API
+        results: Dict[str, list] = {}
+        for obj in res:
+            name = obj.__dict__[self._key_obj_field]
+            results.setdefault(name, []).append(obj)
+            if name.lower() != name:
+                results.setdefault(name.lower(), []).append(obj)
+
+        future.set_result(results)
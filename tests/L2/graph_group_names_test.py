@@ -0,0 +1,67 @@
+import time
+
+from azure_dbr_scim_sync.graph_group_names import GroupNameCache
+
+
+def _group(id, name, **kwargs):
+    return {'id': id, 'displayName': name, 'securityEnabled': True, 'mailEnabled': False, **kwargs}
+
+
+def _is_positive(groups):
+    return len(groups) == 1
+
+
+def test_group_names_persistance(tmp_path):
+    file_name = str(tmp_path / 'group_names.json')
+
+    c = GroupNameCache(file_name)
+    c.set_groups('one', [_group('g1', 'one', extra='x')])
+    c.set_groups('missing', [])
+    c.flush()
+
+    c2 = GroupNameCache(file_name)
+    assert c2.get_groups('one', _is_positive) == [_group('g1', 'one')]
+    assert c2.get_groups('missing', _is_positive) == []
+    assert c2.get_groups('other', _is_positive) is None
+
+
+def test_group_names_negative_ttl(tmp_path):
+    c = GroupNameCache(str(tmp_path / 'group_names.json'), negative_ttl=1)
+    c.set_groups('one', [_group('g1', 'one')])
+    c.set_groups('missing', [])
+    c.set_groups('mail', [_group('g2', 'mail', mailEnabled=True)])
+
+    def _included(groups):
+        return _is_positive(groups) and not groups[0]['mailEnabled']
+
+    assert c.get_groups('mail', _included) is not None
+
+    time.sleep(1.1)
+    assert c.get_groups('one', _included) == [_group('g1', 'one')]
+    assert c.get_groups('missing', _included) is None
+    assert c.get_groups('mail', _included) is None
+
+
+def test_group_names_change_feed(tmp_path):
+    c = GroupNameCache(str(tmp_path / 'group_names.json'))
+    c.set_groups('one', [_group('g1', 'one')])
+    c.set_groups('two', [_group('g2', 'two')])
+    c.set_groups('three', [_group('g3', 'three')])
+    c.set_groups('new name', [])
+
+    # members changes keep the entry
+    c.on_group_change({'id': 'g1', 'displayName': 'one', 'members@delta': [{'id': 'u1'}]})
+    c.on_group_change({'id': 'g1', 'members@delta': [{'id': 'u1'}]})
+    assert c.get_groups('one') == [_group('g1', 'one')]
+
+    # rename invalidates both, old and new name
+    c.on_group_change({'id': 'g1', 'displayName': 'new name'})
+    assert c.get_groups('one') is None
+    assert c.get_groups('new name') is None
+
+    c.on_group_change({'id': 'g2', 'securityEnabled': False})
+    assert c.get_groups('two') is None
+
+    c.on_group_change({'id': 'g3', '@removed': {'reason': 'deleted'}})
+    assert c.get_groups('three') is None
+    assert list(c.keys()) == []
@@ -0,0 +1,51 @@
+import pytest
+from pydantic import ValidationError
+
+from azure_dbr_scim_sync.graph import (GraphGroup, GraphServicePrincipal,
+                                       GraphUser)
+
+
+def _validate(cls, data):
+    return cls.model_validate({k: v for k, v in data.items() if v is not None})
+
+
+@pytest.mark.parametrize("cls,data", [
+    (GraphUser, {'id': 'u1', 'displayName': 'user', 'userPrincipalName': 'u1@example.com'}),
+    (GraphUser, {
+        '@odata.type': '#microsoft.graph.user',
+        'id': 'u2',
+        'displayName': 'guest',
+        'userPrincipalName': 'guest#EXT#@example.com',
+        'mail': None,
+        'mailNickname': 'guest_gmail.com',
+        'accountEnabled': False,
+        'userType': 'Guest',
+        'appId': None
+    }),
+    (GraphUser, {'id': 'u3', 'displayName': 'user', 'userPrincipalName': 'u3@example.com', 'accountEnabled': 'false'}),
+    (GraphServicePrincipal, {'id': 's1', 'displayName': 'spn', 'appId': 'app', 'accountEnabled': True}),
+    (GraphGroup, {'id': 'g1', 'displayName': 'group', 'securityEnabled': True, 'mailEnabled': None}),
+])
+def test_from_graph(cls, data):
+    obj = cls.from_graph(data)
+    expected = _validate(cls, data)
+
+    assert obj == expected
+    assert obj.model_fields_set == expected.model_fields_set
+
+
+@pytest.mark.parametrize("cls,data", [
+    (GraphUser, {'id': 'u1', 'displayName': 'user', 'userPrincipalName': None}),
+    (GraphUser, {'id': 1, 'displayName': 'user', 'userPrincipalName': 'u1@example.com'}),
+    (GraphUser, {'id': 'u1', 'displayName': 'user', 'userPrincipalName': 'u1', 'accountEnabled': 'maybe'}),
+    (GraphServicePrincipal, {'id': 's1', 'displayName': 'spn'}),
+    (GraphGroup, {'id': 'g1'}),
+])
+def test_from_graph_malformed(cls, data):
+    with pytest.raises(ValidationError) as e:
+        _validate(cls, data)
+
+    with pytest.raises(ValidationError) as e_fast:
+        cls.from_graph(data)
+
+    assert e_fast.value.errors() == e.value.errors()
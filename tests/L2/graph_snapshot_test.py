@@ -0,0 +1,47 @@
+import os
+
+from azure_dbr_scim_sync.graph_snapshot import GroupSnapshotStore
+
+
+def _member(id, **kwargs):
+    return {'@odata.type': '#microsoft.graph.user', 'id': id, 'displayName': f"user {id}", **kwargs}
+
+
+def test_snapshot_persistance(tmp_path):
+    file_name = str(tmp_path / 'snapshot.json.gz')
+
+    s = GroupSnapshotStore(file_name)
+    s['g1'] = {'group': {'id': 'g1', 'displayName': 'one'}, 'members': [_member('a'), _member('b', mail=None)]}
+    s['g2'] = {'group': {'id': 'g2', 'displayName': 'two'}, 'members': [_member('b'), _member('c')]}
+    s.flush()
+
+    # members are stored once, None values are not stored
+    s2 = GroupSnapshotStore(file_name)
+    assert s2.get('g1') == {'group': {'id': 'g1', 'displayName': 'one'}, 'members': [_member('a'), _member('b')]}
+    assert s2.get('g2')['members'] == [_member('b'), _member('c')]
+    assert s2.get('g3') is None
+    assert s2.member_ids('g2') == {'b', 'c'}
+
+    # attributes of members are updated in all groups
+    s2.update_principals([_member('b', mail='x'), _member('z')])
+    assert s2.get('g1')['members'][1] == _member('b', mail='x')
+    assert s2.get('g2')['members'][0] == _member('b', mail='x')
+    assert s2.get_principal('z') is None
+
+    os.remove(file_name)
+
+
+def test_snapshot_eviction(tmp_path):
+    file_name = str(tmp_path / 'snapshot.json.gz')
+
+    s = GroupSnapshotStore(file_name)
+    s['g1'] = {'group': {'id': 'g1', 'displayName': 'one'}, 'members': [_member('a'), _member('b')]}
+    s['g2'] = {'group': {'id': 'g2', 'displayName': 'two'}, 'members': [_member('b'), _member('c')]}
+
+    assert s.evict({'two', 'three'}) == ['g1']
+    assert s.get('g1') is None
+    assert set(s._principals) == {'b', 'c'}
+    s.flush()
+
+    assert list(GroupSnapshotStore(file_name).keys()) == ['g2']
+
@@ -0,0 +1,425 @@
+import re
+import time
+import tracemalloc
+
+from azure_dbr_scim_sync.graph import GraphAPIClient
+from azure_dbr_scim_sync.graph_group_names import GroupNameCache
+from azure_dbr_scim_sync.graph_snapshot import GroupSnapshotStore
+from azure_dbr_scim_sync.persisted_cache import Cache
+from tests.graph_stub import GraphDirectory, GraphStub
+
+
+def _search_depths(sync_obj):
+    return {
+        g.display_name: {m.id: m.extra_data['search_depth']
+                         for m in g.members.values()}
+        for g in sync_obj.groups.values()
+    }
+
+
+def test_group_search_depth(monkeypatch):
+    directory = GraphDirectory()
+    directory.add_user('alice')
+    directory.add_user('bob')
+    directory.add_service_principal('robot')
+    directory.add_group('g-c', 'child', ['bob', 'g-p'])
+    directory.add_group('g-p', 'parent', ['alice', 'robot', 'g-c'])
+    directory.add_group('g-m', 'mail', ['alice'], mailEnabled=True)
+    directory.add_group('g-o', 'other', ['g-m'])
+
+    with GraphStub(directory, page_size=2) as stub:
+        graph_client = stub.client(monkeypatch, worker_threads=4)
+
+        shallow = graph_client.get_objects_for_sync(['parent', 'other', 'missing'])
+        assert shallow.deep_sync_group_names == ['other', 'parent']
+        assert set(shallow.users) == {'alice'}
+        assert set(shallow.groups) == {'g-p', 'g-c', 'g-o'}
+        assert shallow.groups['g-c'].members == {}
+
+        deep = graph_client.get_objects_for_sync(['parent', 'other', 'missing'], group_search_depth=3)
+        assert deep.deep_sync_group_names == ['child', 'other', 'parent']
+        assert set(deep.users) == {'alice', 'bob'}
+        assert set(deep.service_principals) == {'robot'}
+        assert _search_depths(deep) == {
+            'parent': {'alice': 1, 'robot': 1, 'g-c': 1},
+            'child': {'bob': 2, 'g-p': 2},
+            'other': {}
+        }
+
+
+def test_batch_requests(monkeypatch):
+    directory = GraphDirectory.generate(group_count=45, users_per_group=3, nested=False)
+    directory.add_group('g-quote', "o'neil & co", ['u-0-0'])
+    group_names = [f"group-{idx}" for idx in range(45)] + ["o'neil & co", 'missing']
+
+    with GraphStub(directory, page_size=2, throttle_batch_requests=True) as stub:
+        unbatched = stub.client(monkeypatch, batch_requests=False).get_objects_for_sync(group_names)
+        unbatched_count = stub.request_count
+
+        stub.request_count = 0
+        batched = stub.client(monkeypatch).get_objects_for_sync(group_names)
+        batched_count = stub.request_count
+
+    assert batched.model_dump() == unbatched.model_dump()
+    assert len(batched.deep_sync_group_names) == 46
+
+    # 3 envelopes for names + 3 for first member pages + 3 for count of members of groups with more than one
+    # page, each retried once because of 429, and 45 requests for second page of members
+    assert unbatched_count == 47 + 46 + 45 + 45
+    assert batched_count == 9 * 2 + 45
+
+
+def test_transitive_members(monkeypatch):
+    directory = GraphDirectory.generate(group_count=6, users_per_group=2, spns_per_group=1)
+    # cycle, and a group reachable at depth 2 and 3
+    directory.members['g-5'].append('g-0')
+    directory.members['g-0'].append('g-2')
+    directory.add_group('g-m', 'mail', ['u-0-0', 'g-4'], mailEnabled=True)
+    directory.members['g-1'].append('g-m')
+
+    with GraphStub(directory, page_size=2) as stub:
+        for depth in [2, 3, 10]:
+            for batch_requests in [True, False]:
+                expected = stub.client(monkeypatch, batch_requests=batch_requests).get_objects_for_sync(
+                    ['group-0', 'group-5', 'missing'], group_search_depth=depth)
+                actual = stub.client(monkeypatch, batch_requests=batch_requests,
+                                     transitive_members=True).get_objects_for_sync(
+                                         ['group-0', 'group-5', 'missing'], group_search_depth=depth)
+
+                assert actual.deep_sync_group_names == expected.deep_sync_group_names
+                assert _search_depths(actual) == _search_depths(expected)
+                assert actual.model_dump() == expected.model_dump()
+
+        # all members are downloaded only of groups within search depth, deeper groups are known by their ids
+        del stub.requests[:]
+        stub.client(monkeypatch, batch_requests=False,
+                    transitive_members=True).get_objects_for_sync(['group-0', 'group-5'], group_search_depth=2)
+        downloaded = {re.match(r'GET /beta/groups/([^/]+)/members\?', x).group(1)
+                      for x in stub.requests if re.match(r'GET /beta/groups/([^/]+)/members\?', x)}
+        assert downloaded == {'g-0', 'g-5', 'g-1', 'g-2'}
+        # nothing is downloaded of deeper groups
+        assert not [x for x in stub.requests if re.search(r'/groups/(g-3|g-4|g-m)/', x)]
+
+
+def test_incremental_member_delta(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    group_cache = Cache('cache_group.json')
+
+    directory = GraphDirectory.generate(group_count=3, users_per_group=5, nested=False)
+    directory.add_user('new-user')
+    group_names = ['group-0', 'group-1', 'group-2']
+    for name in group_names:
+        group_cache[name] = f"dbr-{name}"
+    group_cache.flush()
+
+    with GraphStub(directory, page_size=2) as stub:
+        graph_client = stub.client(monkeypatch, group_snapshot=GroupSnapshotStore('graph_group_snapshot.json.gz'))
+
+        # initial run downloads everything
+        delta_link, initial = graph_client.get_objects_for_sync_incremental(None, group_names,
+                                                                             graph_change_feed_grace_time=0)
+        assert initial.deep_sync_group_names == group_names
+
+        directory.add_member('g-0', 'new-user')
+        directory.remove_member('g-1', 'u-1-0')
+        directory.remove_member('g-1', 'u-1-1')
+        directory.add_member('g-1', 'u-1-1')
+
+        # only new member is downloaded
+        stub.requests = []
+        graph_client = stub.client(monkeypatch, group_snapshot=GroupSnapshotStore('graph_group_snapshot.json.gz'))
+        delta_link, incremental = graph_client.get_objects_for_sync_incremental(delta_link, group_names,
+                                                                                 graph_change_feed_grace_time=0)
+        assert not [x for x in stub.requests if '/members' in x or 'displayName eq' in x]
+        assert len([x for x in stub.requests if '$batch' in x]) == 1
+        assert incremental.deep_sync_group_names == ['group-0', 'group-1']
+        assert set(incremental.users) == {f"u-0-{idx}" for idx in range(5)} | {f"u-1-{idx}" for idx in range(1, 5)
+                                                                                } | {'new-user'}
+        full = stub.client(monkeypatch, group_snapshot=GroupSnapshotStore('full.json.gz')).get_objects_for_sync(
+            ['group-0', 'group-1'])
+        assert incremental.model_dump() == full.model_dump()
+
+        # expired delta token causes download of all groups
+        directory.expired_delta_token = len(directory.changes)
+        directory.remove_member('g-2', 'u-2-0')
+        _, expired = graph_client.get_objects_for_sync_incremental(delta_link, group_names,
+                                                                   graph_change_feed_grace_time=0)
+        assert expired.deep_sync_group_names == group_names
+        assert 'u-2-0' not in expired.users
+
+
+def test_incremental_change_feed_verify(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(GraphAPIClient, '_CONSISTENCY_POLL_INTERVAL', 0.2)
+    group_cache = Cache('cache_group.json')
+
+    directory = GraphDirectory.generate(group_count=2, users_per_group=2, nested=False)
+    directory.add_user('new-user')
+    directory.add_user('late-user')
+    group_names = ['group-0', 'group-1']
+    for name in group_names:
+        group_cache[name] = f"dbr-{name}"
+    group_cache.flush()
+
+    with GraphStub(directory, membership_lag=1.5) as stub:
+        graph_client = stub.client(monkeypatch, batch_requests=False)
+
+        # nothing changed, no waiting
+        start = time.monotonic()
+        delta_link, _ = graph_client.get_objects_for_sync_incremental(None, group_names,
+                                                                      graph_change_feed_grace_time=30)
+        delta_link, unchanged = graph_client.get_objects_for_sync_incremental(delta_link, group_names,
+                                                                              graph_change_feed_grace_time=30)
+        assert time.monotonic() - start < 5
+        assert unchanged.deep_sync_group_names == []
+
+        # changed group is downloaded as soon as its members endpoint catches up with the change feed
+        directory.add_member('g-0', 'new-user')
+        directory.remove_member('g-0', 'u-0-0')
+        del stub.requests[:]
+        start = time.monotonic()
+        delta_link, changed = graph_client.get_objects_for_sync_incremental(delta_link,
+                                                                            group_names,
+                                                                            graph_change_feed_grace_time=30,
+                                                                            graph_change_feed_verify=True)
+        assert 1.4 < time.monotonic() - start < 10
+        assert changed.deep_sync_group_names == ['group-0']
+        assert 'new-user' in changed.users
+        assert 'u-0-0' not in changed.users
+        # only changed members are polled, all members are downloaded once
+        assert len([x for x in stub.requests if '/groups/g-0/members?' in x]) == 1
+        assert len([x for x in stub.requests if '/groups/g-0/members/new-user?' in x]) >= 2
+
+        # grace time is the upper bound
+        directory.add_member('g-1', 'late-user')
+        start = time.monotonic()
+        _, stale = graph_client.get_objects_for_sync_incremental(delta_link,
+                                                                 group_names,
+                                                                 graph_change_feed_grace_time=0.5,
+                                                                 graph_change_feed_verify=True)
+        assert time.monotonic() - start < 1.4
+        assert stale.deep_sync_group_names == ['group-1']
+        assert 'late-user' not in stale.users
+
+
+def test_users_delta(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    user_cache = Cache('cache_user.json')
+    user_cache['u-0-0@example.com'] = 'dbr-1'
+    user_cache.flush()
+
+    directory = GraphDirectory.generate(group_count=2, users_per_group=2, nested=False)
+    directory.add_user('other')
+
+    with GraphStub(directory, page_size=2) as stub:
+        snapshot = GroupSnapshotStore('graph_group_snapshot.json.gz')
+        graph_client = stub.client(monkeypatch, group_snapshot=snapshot)
+        graph_client.get_objects_for_sync(['group-1'])
+
+        delta_link, users = graph_client.get_changed_users(None)
+        assert users == []
+
+        directory.update_user('u-0-0', accountEnabled=False)
+        directory.update_user('u-1-1', displayName='renamed')
+        directory.update_user('other', accountEnabled=False)
+
+        # u-0-0 is in user cache, u-1-1 is not cached, but is a member of group in the snapshot
+        user_cache['u-1-1@example.com'] = 'dbr-2'
+        user_cache.flush()
+
+        stub.requests = []
+        delta_link, users = graph_client.get_changed_users(delta_link)
+        assert not [x for x in stub.requests if '/members' in x]
+        assert {u.id: (u.active, u.display_name) for u in users} == {
+            'u-0-0': (False, 'user u-0-0'),
+            'u-1-1': (True, 'renamed')
+        }
+        assert snapshot.get('g-1')['members'][1]['displayName'] == 'renamed'
+
+        assert graph_client.get_changed_users(delta_link)[1] == []
+
+
+def test_group_members_streaming(monkeypatch):
+    directory = GraphDirectory.generate(group_count=1, users_per_group=6, nested=False)
+
+    with GraphStub(directory, page_size=2) as stub:
+        graph_client = stub.client(monkeypatch)
+
+        members = graph_client.get_group_members('g-0')
+        assert not stub.requests
+
+        # first page is downloaded on demand, second one in the background,
+        # members count tells that group is too small for typed streams
+        assert next(members)['id'] == 'u-0-0'
+        time.sleep(0.5)
+        member_requests = [x for x in stub.requests if '/members' in x and '$count' not in x]
+        assert len(member_requests) == 2
+        assert '$top=999' in member_requests[0]
+
+        assert [m['id'] for m in members] == [f"u-0-{x}" for x in range(1, 6)]
+        assert len(stub.requests) == 4
+        assert len([x for x in stub.requests if '/members/$count' in x]) == 1
+
+
+def test_group_members_typed_streams(monkeypatch):
+    monkeypatch.setattr(GraphAPIClient, '_TYPED_STREAMS_MIN_MEMBERS', 21)
+    directory = GraphDirectory.generate(group_count=4, users_per_group=15, spns_per_group=5, nested=False)
+    directory.add_group('g-big', 'big', [f"u-0-{x}" for x in range(15)] + [f"s-1-{x}" for x in range(5)] +
+                        ['g-2', 'g-3'])
+
+    with GraphStub(directory, page_size=3) as stub:
+        graph_client = stub.client(monkeypatch)
+
+        members = list(graph_client.get_group_members('g-big'))
+        assert sorted(m['id'] for m in members) == sorted(directory.members['g-big'])
+        assert all(m['@odata.type'] == directory.get_object(m['id'])['@odata.type'] for m in members)
+        for member_type in ['user', 'servicePrincipal', 'group']:
+            assert [x for x in stub.requests if f"/members/microsoft.graph.{member_type}?" in x]
+
+        # group below the threshold is downloaded as one stream
+        stub.requests = []
+        members = list(graph_client.get_group_members('g-0'))
+        assert len(members) == 20
+        assert not [x for x in stub.requests if 'microsoft.graph' in x]
+
+        # members are registered the same way
+        typed = graph_client.get_objects_for_sync(['big'], group_search_depth=2)
+        monkeypatch.setattr(GraphAPIClient, '_TYPED_STREAMS_MIN_MEMBERS', 1000)
+        single = graph_client.get_objects_for_sync(['big'], group_search_depth=2)
+        assert typed.model_dump() == single.model_dump()
+
+
+def test_group_members_typed_streams_memory(monkeypatch):
+    monkeypatch.setattr(GraphAPIClient, '_TYPED_STREAMS_MIN_MEMBERS', 1)
+    directory = GraphDirectory()
+    members = [directory.add_user(f"u-{idx}")['id'] for idx in range(6000)]
+    members += [directory.add_service_principal(f"s-{idx}")['id'] for idx in range(3000)]
+    directory.add_group('g-big', 'big', members)
+
+    with GraphStub(directory, page_size=100) as stub:
+        graph_client = stub.client(monkeypatch)
+        tracemalloc.start()
+        try:
+            # streams wait for slow consumer, instead of keeping all the pages downloaded ahead of it
+            for idx, m in enumerate(graph_client.get_group_members('g-big')):
+                if idx % 100 == 0:
+                    time.sleep(0.05)
+            _, streamed_peak = tracemalloc.get_traced_memory()
+
+            start, _ = tracemalloc.get_traced_memory()
+            all_members = list(graph_client.get_group_members('g-big'))
+            size = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            tracemalloc.stop()
+
+    assert len(all_members) == 9000
+    assert streamed_peak < size / 3
+
+
+def test_incremental_scoped_delta(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(GraphAPIClient, '_DELTA_SHARD_SIZE', 2)
+    group_cache = Cache('cache_group.json')
+
+    directory = GraphDirectory.generate(group_count=6, users_per_group=2, nested=False)
+    group_names = ['group-0', 'group-1', 'group-2']
+    for name in group_names:
+        group_cache[name] = f"dbr-{name}"
+    group_cache.flush()
+
+    with GraphStub(directory) as stub:
+        # upgrade from version without shards, changes since last delta link are still applied
+        graph_client = stub.client(monkeypatch)
+        legacy_delta_link, _ = graph_client.get_objects_for_sync_incremental(None, group_names,
+                                                                             graph_change_feed_grace_time=0)
+        assert isinstance(legacy_delta_link, str)
+
+        directory.remove_member('g-0', 'u-0-0')
+        graph_client = stub.client(monkeypatch, group_snapshot=GroupSnapshotStore('graph_group_snapshot.json.gz'))
+        shards, upgraded = graph_client.get_objects_for_sync_incremental(legacy_delta_link, group_names,
+                                                                         graph_change_feed_grace_time=0)
+        assert upgraded.deep_sync_group_names == ['group-0']
+        assert sorted(x['ids'] for x in shards) == [['g-0', 'g-1'], ['g-2']]
+
+        # changes of groups that are not synced are not read
+        directory.add_member('g-4', 'u-5-0')
+        directory.add_member('g-5', 'u-4-0')
+        directory.add_member('g-2', 'u-3-0')
+
+        stub.requests = []
+        shards, incremental = graph_client.get_objects_for_sync_incremental(shards, group_names,
+                                                                            graph_change_feed_grace_time=0)
+        delta_requests = [x for x in stub.requests if '/groups/delta' in x]
+        assert len(delta_requests) == 2
+        assert all("$filter=id eq 'g-" in x for x in delta_requests)
+        assert incremental.deep_sync_group_names == ['group-2']
+        assert 'u-3-0' in incremental.users
+
+        # expired delta token causes download of groups of that shard only
+        directory.expired_delta_token = 0
+        shard = [x for x in shards if x['ids'] == ['g-2']][0]
+        shard['delta_link'] = shard['delta_link'].replace(f"$deltatoken={len(directory.changes)}", "$deltatoken=0")
+        _, expired = graph_client.get_objects_for_sync_incremental(shards, group_names,
+                                                                   graph_change_feed_grace_time=0)
+        assert expired.deep_sync_group_names == ['group-2']
+
+        # group that is not synced anymore is not tracked
+        shards, _ = graph_client.get_objects_for_sync_incremental(shards, ['group-2', 'group-3'],
+                                                                  graph_change_feed_grace_time=0)
+        group_cache.invalidate('group-0')
+        group_cache.invalidate('group-1')
+        group_cache['group-3'] = 'dbr-group-3'
+        group_cache.flush()
+        shards, _ = graph_client.get_objects_for_sync_incremental(shards, ['group-2', 'group-3'],
+                                                                  graph_change_feed_grace_time=0)
+        assert sorted(x['ids'] for x in shards) == [['g-2'], ['g-3']]
+
+
+def test_group_name_cache(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    group_cache = Cache('cache_group.json')
+
+    directory = GraphDirectory.generate(group_count=3, users_per_group=2, nested=False)
+    directory.add_group('g-mail', 'group-mail', mailEnabled=True)
+    group_names = ['group-0', 'group-1', 'group-2', 'group-mail', 'group-missing']
+    for name in group_names:
+        group_cache[name] = f"dbr-{name}"
+    group_cache.flush()
+
+    def _name_lookups(stub):
+        return sorted(
+            re.search(r"displayName eq '(.*)'&", x).group(1) for x in stub.requests + stub.batch_requests
+            if 'displayName eq' in x)
+
+    with GraphStub(directory) as stub:
+
+        def _sync(delta_link, negative_ttl=3600):
+            graph_client = stub.client(monkeypatch,
+                                       group_snapshot=GroupSnapshotStore('graph_group_snapshot.json.gz'),
+                                       group_name_cache=GroupNameCache('graph_group_names.json',
+                                                                       negative_ttl=negative_ttl))
+            stub.requests, stub.batch_requests = [], []
+            return graph_client.get_objects_for_sync_incremental(delta_link,
+                                                                 group_names,
+                                                                 graph_change_feed_grace_time=0)
+
+        shards, initial = _sync(None)
+        assert initial.deep_sync_group_names == ['group-0', 'group-1', 'group-2']
+        assert _name_lookups(stub) == sorted(group_names)
+
+        # steady state needs no name lookups, including groups not found or skipped
+        directory.add_member('g-0', 'u-1-0')
+        shards, _ = _sync(shards)
+        assert _name_lookups(stub) == []
+
+        # renamed group is resolved by name again
+        directory.update_group('g-1', displayName='group-1-renamed')
+        shards, _ = _sync(shards)
+        assert 'group-1' not in GroupNameCache('graph_group_names.json').keys()
+        graph_client = stub.client(monkeypatch, group_name_cache=GroupNameCache('graph_group_names.json'))
+        assert graph_client.get_groups_by_name(['group-0', 'group-1'])['group-1'] is None
+        assert _name_lookups(stub) == ['group-1']
+
+        # negative entries expire
+        shards, _ = _sync(shards, negative_ttl=0)
+        assert _name_lookups(stub) == ['group-mail', 'group-missing']
@@ -31,9 +31,8 @@ def test_get_group_members(graph_client: GraphAPIClient):
 
     logging.info(f"group: {group_name}: {json.dumps(group_info, indent=4)}")
 
-    group_members = graph_client.get_group_members(group_info['id'])
+    group_members = list(graph_client.get_group_members(group_info['id']))
     assert group_members
-    assert isinstance(group_members, list)
     logging.info(f"members: {json.dumps(group_members, indent=4)}")
 
 
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from azure.core.credentials import AccessToken
+
+from azure_dbr_scim_sync.graph_token import GraphTokenProvider
+
+
+class CountingCredential:
+
+    def __init__(self, lifetime: float, delay: float = 0.0):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls += 1
+            return AccessToken(f"token-{self.calls}", int(time.time() + self.lifetime))
+
+
+def test_concurrent_callers_share_token():
+    credential = CountingCredential(lifetime=3600, delay=0.2)
+    provider = GraphTokenProvider(credential)
+
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(provider.get_token())) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    provider.close()
+    assert credential.calls == 1
+    assert set(tokens) == {'token-1'}
+
+
+def test_background_refresh(monkeypatch):
+    monkeypatch.setattr(GraphTokenProvider, '_MIN_VALIDITY', 0)
+    # token is refreshed 1s before expiry, callers never wait for it
+    credential = CountingCredential(lifetime=2, delay=0.2)
+    provider = GraphTokenProvider(credential, refresh_margin=1)
+
+    assert provider.get_token() == 'token-1'
+    time.sleep(1.8)
+    assert credential.calls == 2
+
+    start = time.time()
+    assert provider.get_token() == 'token-2'
+    assert time.time() - start < 0.1
+
+    provider.close()
@@ -0,0 +1,33 @@
+from azure_dbr_scim_sync.member_diff import IdInterner, MemberIds
+
+
+def test_id_interner():
+    interner = IdInterner()
+    assert [interner.intern(x) for x in ['a', 'b', 'a']] == [0, 1, 0]
+    assert interner.get('c') == -1
+    assert interner.values([1, 0]) == ['b', 'a']
+    assert len(interner) == 2
+
+
+def test_member_diff():
+    member_ids = MemberIds()
+    for idx in range(5):
+        member_ids.set(f"g-{idx}", f"d-{idx}")
+
+    # unknown members are ignored, unless resolved by fallback
+    desired = member_ids.desired(['g-4', 'g-0', 'g-2', 'g-2', 'g-x'])
+    assert member_ids.dbr_ids.values(desired) == ['d-0', 'd-2', 'd-4']
+    desired = member_ids.desired(['g-4', 'g-0', 'g-2', 'g-x'], {'g-x': 'd-x'}.get)
+    assert member_ids.dbr_ids.values(desired) == ['d-0', 'd-2', 'd-4', 'd-x']
+
+    # members not synced (d-z) are removed
+    actual = member_ids.actual(['d-3', 'd-0', 'd-1', 'd-z'])
+    to_remove, to_add = member_ids.diff(desired, actual)
+    assert member_ids.dbr_ids.values(to_remove) == ['d-1', 'd-3', 'd-z']
+    assert member_ids.dbr_ids.values(to_add) == ['d-2', 'd-4', 'd-x']
+    assert member_ids.diff(desired, member_ids.actual([])) == (member_ids.actual([]), desired)
+    assert member_ids.diff(member_ids.desired([]), actual) == (actual, member_ids.desired([]))
+
+    # principal recreated with new id
+    member_ids.set('g-0', 'd-new')
+    assert member_ids.dbr_ids.values(member_ids.desired(['g-0'])) == ['d-new']
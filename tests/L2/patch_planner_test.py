@@ -0,0 +1,139 @@
+import json
+import re
+
+import pytest
+from databricks.sdk.errors import BadRequest, DatabricksError
+
+from azure_dbr_scim_sync.patch_planner import PatchPlanner
+
+_SCHEMA = 'urn:ietf:params:scim:api:messages:2.0:PatchOp'
+
+
+def _ids(prefix: str, count: int):
+    return [f"{prefix}{x:016d}" for x in range(count)]
+
+
+class _Endpoint:
+    """records accepted operations, rejects requests larger than `max_bytes`, and coalesced removals"""
+
+    def __init__(self, max_bytes: int = None, coalesced_removals: bool = True, unknown_members=()):
+        self.max_bytes = max_bytes
+        self.coalesced_removals = coalesced_removals
+        self.unknown_members = set(unknown_members)
+        self.requests = []
+        self.rejected = 0
+
+    def __call__(self, operations):
+        body = {'Operations': [x.as_dict() for x in operations], 'schemas': [_SCHEMA]}
+        if self.max_bytes and len(json.dumps(body)) > self.max_bytes:
+            self.rejected += 1
+            raise DatabricksError('too large', error_code='SCIM_413')
+        if not self.coalesced_removals and any(' or ' in (x.path or '') for x in operations):
+            self.rejected += 1
+            raise BadRequest('invalid filter')
+        if any(m['value'] in self.unknown_members for x in operations if x.value for m in x.value['members']):
+            self.rejected += 1
+            raise BadRequest('members do not exist')
+        self.requests.append(operations)
+
+    def members(self, op: str):
+        members = []
+        for ops in self.requests:
+            for x in ops:
+                if x.op.value == 'remove' and op == 'remove':
+                    members.extend(re.findall(r'value eq "([^"]+)"', x.path))
+                elif x.op.value == 'add' and op == 'add':
+                    members.extend(m['value'] for m in x.value['members'])
+        return members
+
+
+def test_plan_coalesces_removals():
+    planner = PatchPlanner('test')
+    to_remove, to_add = _ids('r', 3000), _ids('a', 100)
+    chunks = planner.plan(to_remove, to_add)
+
+    # removals first, then additions, in order
+    assert [x for c in chunks for x in c.remove_ids] == to_remove
+    assert [x for c in chunks for x in c.add_ids] == to_add
+    assert all(not c.add_ids for c in chunks[:-1])
+
+    # 50 members removed by each filter: 2 requests, instead of 62 requests of 50 operations
+    assert len(chunks) == 2
+    assert chunks[0].operations[0].path.count(' or ') == 49
+    assert all(c.size <= 64 * 1024 and len(c.operations) <= 50 for c in chunks)
+
+
+@pytest.mark.parametrize('max_bytes', [1024, 4096, 64 * 1024])
+def test_plan_sizes_requests_by_bytes(max_bytes):
+    planner = PatchPlanner('test', max_bytes=max_bytes, max_ops=1000)
+    for filter_values in [1, 50]:
+        chunks = planner.plan(_ids('r', 500), _ids('a', 500), max_filter_values=filter_values)
+        assert all(c.size <= max_bytes for c in chunks)
+        # chunks are filled up to at least half of the limit
+        assert all(c.size > max_bytes / 2 for c in chunks[:-1])
+
+
+def test_apply_learns_max_bytes():
+    planner = PatchPlanner('test')
+    endpoint = _Endpoint(max_bytes=10000)
+    to_remove, to_add = _ids('r', 1000), _ids('a', 1000)
+    planner.apply(endpoint, to_remove, to_add)
+
+    assert endpoint.members('remove') == to_remove
+    assert endpoint.members('add') == to_add
+    stats = planner.stats()
+    assert stats['max_bytes'] <= 10000
+    assert stats['requests'] == len(endpoint.requests)
+
+    # limit is known for the next groups
+    rejected = endpoint.rejected
+    planner.apply(endpoint, to_remove, to_add)
+    assert endpoint.rejected == rejected
+
+
+def test_apply_raises_too_large_member():
+    planner = PatchPlanner('test', min_bytes=10)
+    endpoint = _Endpoint(max_bytes=10)
+    with pytest.raises(DatabricksError):
+        planner.apply(endpoint, _ids('r', 10), [])
+
+
+def test_apply_disables_coalescing():
+    planner = PatchPlanner('test')
+    endpoint = _Endpoint(coalesced_removals=False)
+    to_remove, to_add = _ids('r', 200), _ids('a', 10)
+    planner.apply(endpoint, to_remove, to_add)
+
+    assert endpoint.members('remove') == to_remove
+    assert endpoint.members('add') == to_add
+    # rejected with additions, and then removals alone
+    assert endpoint.rejected == 2
+    assert planner.stats()['max_filter_values'] == 1
+
+    planner.apply(endpoint, to_remove, to_add)
+    assert endpoint.rejected == 2
+
+
+def test_apply_keeps_coalescing_on_other_errors():
+    planner = PatchPlanner('test')
+
+    def _send(operations):
+        raise BadRequest('members do not exist')
+
+    with pytest.raises(BadRequest):
+        planner.apply(_send, _ids('r', 200), [])
+
+    assert planner.stats()['max_filter_values'] == 50
+
+
+def test_apply_keeps_coalescing_on_rejected_additions():
+    planner = PatchPlanner('test')
+    endpoint = _Endpoint(unknown_members=['unknown'])
+    to_remove = _ids('r', 60)
+    with pytest.raises(BadRequest):
+        planner.apply(endpoint, to_remove, ['a1', 'unknown'])
+
+    # removals were applied, coalesced
+    assert endpoint.members('remove') == to_remove
+    assert len(endpoint.requests) == 1
+    assert planner.stats()['max_filter_values'] == 50
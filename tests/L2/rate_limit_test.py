@@ -0,0 +1,143 @@
+import threading
+import time
+from functools import partial
+
+import pytest
+from databricks.sdk.errors import NotFound, TooManyRequests
+
+from azure_dbr_scim_sync.rate_limit import ConcurrencyLimiter, RateLimiter, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after('1.5') == 1.5
+    assert parse_retry_after(None, 2) == 2
+    assert parse_retry_after('garbage', 2) == 2
+    assert 0 < parse_retry_after(time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 10))) <= 10
+
+
+def test_throttling_pauses_all_threads():
+    limiter = RateLimiter('test')
+    limiter.on_throttled(0.5)
+
+    start = time.monotonic()
+    done = []
+
+    def _request():
+        limiter.acquire()
+        done.append(time.monotonic() - start)
+
+    threads = [threading.Thread(target=_request) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert min(done) >= 0.5
+    stats = limiter.stats()
+    assert stats['throttled'] == 1
+    assert stats['requests'] == 5
+    assert stats['waited_seconds'] >= 2.4
+
+
+def test_rate_adapts_to_ceiling():
+    limiter = RateLimiter('test', max_rate=100)
+    for _ in range(30):
+        limiter.acquire()
+        limiter.on_success()
+
+    # requests throttled together, lower the rate only once, to half of the observed ceiling
+    limiter.on_throttled(0.1)
+    assert limiter.rate == 15
+    limiter.on_throttled(0.1)
+    assert limiter.rate == 15
+
+    # rate goes back to the ceiling, and slowly above it
+    for _ in range(500):
+        limiter.on_success()
+    assert 27 <= limiter.rate < 35
+
+
+def test_few_requests_do_not_lower_rate():
+    limiter = RateLimiter('test', max_rate=100)
+    limiter.acquire()
+    limiter.on_success()
+
+    limiter.on_throttled(0)
+    assert limiter.rate == 100
+    assert limiter.stats()['throttled'] == 1
+
+
+def test_concurrency_limit_blocks_threads():
+    limiter = ConcurrencyLimiter('test', max_concurrency=2)
+    in_flight = []
+    lock = threading.Lock()
+
+    def _request():
+        started = limiter.acquire()
+        with lock:
+            in_flight.append(limiter.stats()['requests'] - len(done))
+        time.sleep(0.05)
+        with lock:
+            done.append(1)
+        limiter.release(started)
+
+    done = []
+    threads = [threading.Thread(target=_request) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert max(in_flight) == 2
+    assert limiter.stats()['waited_seconds'] > 0.1
+
+
+def test_concurrency_limit_aimd():
+    limiter = ConcurrencyLimiter('test', max_concurrency=8)
+    started = [limiter.acquire() for _ in range(8)]
+
+    # requests in flight are throttled together, limit is halved only once for them
+    limiter.release(started.pop(), throttled=True)
+    assert limiter.limit == 4
+    limiter.release(started.pop(), throttled=True)
+    assert limiter.limit == 4
+    for _ in started:
+        limiter.release(time.monotonic() - 0.1)
+
+    limiter.release(limiter.acquire(), throttled=True)
+    assert limiter.limit == 2
+
+    # limit grows back while latency is healthy, but not while it is slow
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(time.monotonic() - 0.1)
+    assert limiter.limit == 5
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(time.monotonic() - 0.5)
+    assert limiter.limit == 5
+    for _ in range(50):
+        limiter.acquire()
+        limiter.release(time.monotonic() - 0.1)
+    assert limiter.limit == 8
+    assert limiter.stats() == {'requests': 74, 'throttled': 3, 'waited_seconds': 0.0, 'concurrency': 8}
+
+
+def test_concurrency_limited_call():
+    limiter = ConcurrencyLimiter('test', max_concurrency=8)
+    assert limiter.call(lambda x: x + 1, 1) == 2
+
+    # missing principal is not throttling
+    with pytest.raises(NotFound):
+        limiter.call(partial(_raise, NotFound('missing')))
+    assert limiter.limit == 8
+
+    with pytest.raises(TooManyRequests):
+        limiter.call(partial(_raise, TooManyRequests('throttled')))
+    assert limiter.limit == 4
+    assert limiter.stats()['requests'] == 3
+
+
+def _raise(err: Exception):
+    raise err
@@ -0,0 +1,82 @@
+import pytest
+from databricks.sdk.errors import (DatabricksError, InternalError, NotFound,
+                                   TooManyRequests)
+
+from azure_dbr_scim_sync import retry
+from azure_dbr_scim_sync.retry import RetryPolicy, get_status_code
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    """delays slept by retry policy, without sleeping"""
+    slept = []
+    monkeypatch.setattr(retry.time, 'sleep', slept.append)
+    return slept
+
+
+def _failing(*errors):
+    errors = list(errors)
+
+    def _call(value):
+        if errors:
+            raise errors.pop(0)
+        return value
+
+    return _call
+
+
+def test_get_status_code():
+    assert get_status_code(TooManyRequests('throttled')) == 429
+    assert get_status_code(InternalError('failed')) == 500
+    assert get_status_code(NotFound('missing')) == 404
+    assert get_status_code(DatabricksError('bad gateway', error_code='SCIM_502')) == 502
+    assert get_status_code(ValueError('other')) is None
+
+    # sdk gives up retrying throttled requests with timeout
+    try:
+        raise TimeoutError('timed out') from TooManyRequests('throttled')
+    except TimeoutError as e:
+        assert get_status_code(e) == 429
+
+
+def test_retry_policy(sleeps):
+    policy = RetryPolicy('test', base_delay=0.5)
+    call = policy(_failing(InternalError('failed'), TooManyRequests('throttled', retry_after_secs=7)))
+    assert call('ok') == 'ok'
+
+    # full jitter of first retry, and retry after of the second
+    assert 0 <= sleeps[0] <= 0.5
+    assert sleeps[1] == 7
+    assert policy.stats() == {
+        'calls': 1,
+        'retries': 2,
+        'retries_by_status': {
+            500: 1,
+            429: 1
+        },
+        'failed': 0,
+        'breaker_opened': 0,
+        'waited_seconds': pytest.approx(sum(sleeps), abs=0.001)
+    }
+
+    # not retryable, or too many attempts
+    with pytest.raises(NotFound):
+        policy.call(_failing(NotFound('missing')), 'ok')
+    with pytest.raises(InternalError):
+        RetryPolicy('test', max_attempts=3).call(_failing(*[InternalError('failed')] * 3), 'ok')
+    assert len(sleeps) == 4
+
+
+def test_retry_budget_opens_breaker(sleeps):
+    policy = RetryPolicy('test', max_attempts=5, budget_ratio=0, min_budget=2, breaker_cooldown=60)
+    assert policy.call(_failing(*[InternalError('failed')] * 4), 'ok') == 'ok'
+
+    # two retries within budget, then all calls are paused for the cooldown
+    stats = policy.stats()
+    assert stats['retries'] == 4
+    assert stats['breaker_opened'] == 1
+    assert max(sleeps) >= 59
+
+    with pytest.raises(NotFound):
+        policy.call(_failing(NotFound('missing')), 'ok')
+    assert max(sleeps[-1:]) >= 59
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+from azure_dbr_scim_sync.scheduler import DependencyScheduler
+
+
+def test_dependencies():
+    scheduler = DependencyScheduler('test')
+    finished = []
+
+    def _task(key, delay=0.0):
+
+        def _run():
+            time.sleep(delay)
+            finished.append(key)
+            return key.upper()
+
+        return _run
+
+    scheduler.add('slow', _task('slow', 0.2), 'a')
+    scheduler.add('fast', _task('fast'), 'a')
+    scheduler.add('after-fast', _task('after-fast'), 'b', depends_on=['fast', 'not-added'])
+    scheduler.add('after-both', _task('after-both'), 'b', depends_on=['fast', 'slow'])
+    results, errors = scheduler.run({'a': 2, 'b': 1})
+
+    # task is released as soon as its dependencies are done, not after all the tasks of pool
+    assert finished.index('after-fast') < finished.index('slow')
+    assert finished[-1] == 'after-both'
+    assert results == {'slow': 'SLOW', 'fast': 'FAST', 'after-fast': 'AFTER-FAST', 'after-both': 'AFTER-BOTH'}
+    assert errors == []
+
+    # results of previous runs satisfy dependencies
+    scheduler.add('next', lambda: scheduler.result('slow') + '!', 'a', depends_on=['slow'])
+    assert scheduler.run({'a': 1}) == ({'next': 'SLOW!'}, [])
+    with pytest.raises(ValueError):
+        scheduler.add('next', lambda: None, 'a')
+
+
+def test_failed_dependency_skips_dependents():
+    scheduler = DependencyScheduler('test')
+    ran = []
+    lock = threading.Lock()
+
+    def _ok(key):
+
+        def _run():
+            with lock:
+                ran.append(key)
+
+        return _run
+
+    def _fail():
+        raise ValueError('failed')
+
+    scheduler.add('fails', _fail, 'a')
+    scheduler.add('ok', _ok('ok'), 'a')
+    scheduler.add('child', _ok('child'), 'a', depends_on=['fails', 'ok'])
+    scheduler.add('grandchild', _ok('grandchild'), 'a', depends_on=['child'])
+    scheduler.add('other', _ok('other'), 'a', depends_on=['ok'])
+    results, errors = scheduler.run({'a': 2})
+
+    assert sorted(ran) == ['ok', 'other']
+    assert set(results) == {'ok', 'other'}
+    assert [str(x) for x in errors] == ['failed']
+    assert scheduler.result('child') is None
+
+    # failures of previous runs skip tasks of later runs
+    scheduler.add('late', _ok('late'), 'a', depends_on=['grandchild'])
+    assert scheduler.run({'a': 1}) == ({}, [])
+    assert 'late' not in ran
@@ -0,0 +1,73 @@
+import json
+
+from azure_dbr_scim_sync.scim_cache import IdIndex, PrincipalCache
+
+
+def test_principal_cache_legacy_entries(tmp_path):
+    file_name = str(tmp_path / 'cache_user.json')
+    with open(file_name, 'w') as f:
+        json.dump({'a@example.com': 'id-a'}, f)
+
+    c = PrincipalCache(file_name, trust_ttl=60, trust_sample_rate=0)
+    assert c['a@example.com'] == 'id-a'
+    assert c['b@example.com'] is None
+    # legacy entries have no fingerprint
+    assert c.get_trusted_id('a@example.com', 'f1') is None
+
+
+def test_principal_cache_trust(tmp_path):
+    file_name = str(tmp_path / 'cache_group.json')
+
+    c = PrincipalCache(file_name, trust_ttl=60, trust_sample_rate=0)
+    c.set_verified('one', 'id-1', 'f1')
+    c.set_members_hash('one', 'id-1', 'm1')
+    # group is no longer cached with this id
+    c.set_members_hash('one', 'id-2', 'm2')
+    c.flush()
+
+    c2 = PrincipalCache(file_name, trust_ttl=60, trust_sample_rate=0)
+    assert c2.get_trusted_id('one', 'f1') == 'id-1'
+    assert c2.get_trusted_id('one', 'f2') is None
+    assert c2.get_entry('one')['members_hash'] == 'm1'
+
+    # id looked up again keeps fingerprints, other id drops them
+    c2['one'] = 'id-1'
+    assert c2.get_trusted_id('one', 'f1') == 'id-1'
+    c2['one'] = 'id-3'
+    assert c2.get_trusted_id('one', 'f1') is None
+    assert c2.get_entry('one').get('members_hash') is None
+
+    # no trust without ttl, after ttl, or when sampled for verification
+    c2.set_verified('one', 'id-3', 'f1')
+    assert PrincipalCache(file_name, trust_sample_rate=0).get_trusted_id('one', 'f1') is None
+    c2.trust_ttl = -1
+    assert c2.get_trusted_id('one', 'f1') is None
+    c2.trust_ttl = 60
+    c2.trust_sample_rate = 1
+    assert c2.get_trusted_id('one', 'f1') is None
+
+
+def test_id_index(tmp_path):
+    file_name = str(tmp_path / 'cache_ids.json')
+
+    index = IdIndex(file_name)
+    index.set('g-1', 'id-1', 'f1')
+    index.set('g-2', 'id-2')
+    index.flush()
+
+    index = IdIndex(file_name)
+    assert index.get_id('g-1') == 'id-1'
+    assert index.get_id('g-1', 'f1') == 'id-1'
+    assert index.get_id('g-1', 'f2') is None
+    # changed principal, not verified yet
+    assert index.get_id('g-2', 'f1') is None
+    assert index.get_external_id('id-2') == 'g-2'
+
+    # principal recreated with new id
+    index.set('g-1', 'id-3', 'f1')
+    assert index.get_external_id('id-1') is None
+    assert index.get_external_id('id-3') == 'g-1'
+
+    index.invalidate_id('id-3')
+    assert index.get_id('g-1') is None
+    assert index.get_external_id('id-3') is None
@@ -0,0 +1,416 @@
+import pytest
+from databricks.sdk.core import DatabricksError
+from databricks.sdk.service import iam
+
+from azure_dbr_scim_sync import scim
+from azure_dbr_scim_sync.patch_planner import PatchPlanner
+from azure_dbr_scim_sync.scim_index import PrincipalIndex
+from tests.scim_stub import ScimDirectory, ScimStub, desired_principals, sync_groups
+
+
+def _memberships(directory: ScimDirectory):
+    names = {
+        x['id']: x.get('userName') or x.get('applicationId') or x.get('displayName')
+        for objects in directory.resources.values()
+        for x in objects.values()
+    }
+    return {
+        g['displayName']: sorted(names[x] for x in directory.member_ids(g['id']))
+        for g in directory.resources['Groups'].values()
+    }
+
+
+def test_principal_index(scim_caches):
+    directory = ScimDirectory.generate(user_count=250, group_count=3, spn_count=2, members_per_group=2)
+
+    with ScimStub(directory, max_page_size=40) as stub:
+        index = PrincipalIndex.build(stub.client(), worker_threads=4)
+
+    assert len(index) == 255
+    assert index.get('Users', 'user-249@example.com').external_id == 'u-249'
+    assert index.get_by_external_id('ServicePrincipals', 's-1').application_id == 'app-1'
+    assert len(index.get('Groups', 'group-2').members) == 2
+    assert index.get('Users', 'missing@example.com') is None
+    # 7 pages of users, and one of groups and service principals
+    assert len(stub.requests) == 9
+
+    # names are matched case insensitively, as by SCIM API filters
+    assert index.get('Users', 'User-249@Example.com').external_id == 'u-249'
+    assert index.get('Groups', 'GROUP-2').display_name == 'group-2'
+    index._add_all('Users', [{'id': 'x', 'userName': 'USER-249@example.com'}])
+    assert index.get('Users', 'User-249@Example.com') is None
+    assert index.get('Users', 'USER-249@example.com').id == 'x'
+
+
+def test_sync_prefetched_names_case_insensitive(scim_caches):
+    directory = ScimDirectory()
+    directory.add_user('User-0@Example.com', displayName='user 0', externalId='u-0', active=True)
+    users, groups, spns = desired_principals(user_count=1, group_count=0)
+    with ScimStub(directory) as stub:
+        result = sync_groups(stub, users, groups, spns, prefetch_principals=True)
+
+        assert [x.action for x in result.users] == ['no change']
+        assert stub.requests_of('POST') == []
+
+
+@pytest.mark.parametrize('prefetch_principals', [False, True])
+def test_sync(scim_caches, prefetch_principals):
+    # part of the principals exist, one of them with outdated display name, and one group has wrong member
+    directory = ScimDirectory.generate(user_count=10, spn_count=1)
+    directory.find('Users', 'user-0@example.com')['displayName'] = 'old name'
+    directory.add_group('group-0', [directory.find('Users', 'user-1@example.com')['id']], externalId='g-0')
+
+    users, groups, spns = desired_principals(user_count=20, group_count=3, spn_count=2)
+    with ScimStub(directory) as stub:
+        result = sync_groups(stub, users, groups, spns, prefetch_principals=prefetch_principals)
+
+        user_actions = {x.desired.user_name: x.action for x in result.users}
+        assert user_actions['user-0@example.com'] == 'change'
+        assert list(user_actions.values()).count('new') == 10
+        assert {x.desired.application_id: x.action for x in result.service_principals} == {
+            'app-0': 'no change',
+            'app-1': 'new'
+        }
+        assert {x.desired.display_name: x.action for x in result.groups} == {
+            'group-0': 'no change',
+            'group-1': 'new',
+            'group-2': 'new'
+        }
+        assert directory.find('Users', 'user-0@example.com')['displayName'] == 'user 0'
+        assert _memberships(directory) == {
+            f"group-{idx}": sorted([f"user-{x}@example.com" for x in range(idx, 20, 3)] + ['app-0', 'app-1'])
+            for idx in range(3)
+        }
+
+        # with prefetch, existing principals are not looked up one by one
+        lookups = [x for x in stub.requests if x.startswith('GET') and ('filter=' in x or 'Users/' in x)]
+        assert bool(lookups) != prefetch_principals
+
+        # second run does not change anything, and cached ids are used (changed principals are not cached)
+        stub.requests = []
+        result = sync_groups(stub, users, groups, spns, prefetch_principals=prefetch_principals)
+        assert result.effecitve_change_count == 0
+        assert all('user-0@' in x for x in stub.requests if 'filter=' in x)
+        assert not [x for x in stub.requests if not x.startswith('GET')]
+
+
+@pytest.mark.parametrize('batch_lookups', [False, True])
+def test_sync_batch_lookups(scim_caches, batch_lookups):
+    # first sync, nothing is cached yet, and most of the principals are new
+    directory = ScimDirectory.generate(user_count=120)
+    users, groups, spns = desired_principals(user_count=400, group_count=2)
+    with ScimStub(directory) as stub:
+        result = sync_groups(stub, users, groups, spns, batch_lookups=batch_lookups)
+
+        user_actions = [x.action for x in result.users]
+        assert user_actions.count('no change') == 120
+        assert user_actions.count('new') == 280
+        assert _memberships(directory) == {
+            f"group-{idx}": sorted(f"user-{x}@example.com" for x in range(idx, 400, 2))
+            for idx in range(2)
+        }
+
+        # list calls finding anything are followed by a request of the empty next page
+        lookups = [x for x in stub.requests_of('GET', 'Users') if 'filter=' in x]
+        if batch_lookups:
+            assert len(lookups) <= 2 * 2 * (400 // 50)
+            assert max(x.count('+or+') for x in lookups) == 49
+        else:
+            assert len(lookups) == 2 * 120 + 280
+
+
+def test_sync_dry_run_new_principals(scim_caches):
+    directory = ScimDirectory()
+    directory.add_user('user-0@example.com', displayName='user 0', externalId='u-0', active=True)
+    users, groups, spns = desired_principals(user_count=2, group_count=1)
+    with ScimStub(directory) as stub:
+        result = sync_groups(stub, users, groups, spns, dry_run_security_principals=True)
+
+        # new principals are reported, nothing is created, and members are not synced
+        assert [x.action for x in result.users] == ['no change', 'new']
+        assert [x.action for x in result.groups] == ['new']
+        assert stub.requests_of('POST') == [] and stub.requests_of('PATCH') == []
+
+
+def test_sync_cache_trust(scim_caches):
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=20, group_count=3, spn_count=1)
+    with ScimStub(directory) as stub:
+        sync_groups(stub, users, groups, spns, cache_trust_ttl=3600, cache_trust_sample_rate=0)
+
+        # nothing is looked up, when nothing changed
+        stub.requests = []
+        result = sync_groups(stub, users, groups, spns, cache_trust_ttl=3600, cache_trust_sample_rate=0)
+        assert result.effecitve_change_count == 0
+        assert all(x.trusted for x in result.users + result.groups + result.service_principals)
+        assert stub.requests == []
+
+        # changed user is verified, and group with new member is downloaded
+        directory.find('Groups', 'group-1')['members'].pop()
+        users[0].display_name = 'new name'
+        users.append(iam.User(user_name="new@example.com", display_name="new", external_id="u-new", active=True))
+        groups[0].members.append(iam.ComplexValue(value="u-new"))
+        stub.requests = []
+        result = sync_groups(stub, users, groups, spns, cache_trust_ttl=3600, cache_trust_sample_rate=0)
+        assert {x.desired.user_name: x.action for x in result.users if not x.trusted} == {
+            'user-0@example.com': 'change',
+            'new@example.com': 'new'
+        }
+        assert [x.desired.display_name for x in result.groups if x.changes] == ['group-0']
+        assert directory.find('Users', 'user-0@example.com')['displayName'] == 'new name'
+        assert 'new@example.com' in _memberships(directory)['group-0']
+        assert len(stub.requests_of('GET', 'Groups/')) == 1
+
+        # member removed directly in the account is not detected while trusted, but it is when verified
+        assert len(_memberships(directory)['group-1']) == len(groups[1].members) - 1
+        stub.requests = []
+        result = sync_groups(stub, users, groups, spns, cache_trust_ttl=3600, cache_trust_sample_rate=1)
+        assert [x.desired.display_name for x in result.groups if x.changes] == ['group-1']
+        assert len(_memberships(directory)['group-1']) == len(groups[1].members)
+
+
+def test_sync_members_concurrently(scim_caches):
+    # group-0 has 60 members to remove and 60 to add, patch of group-1 fails
+    directory = ScimDirectory.generate(user_count=180)
+    group_0 = directory.add_group('group-0', [x['id'] for x in list(directory.resources['Users'].values())[120:]],
+                                  externalId='g-0')
+    directory.add_group('group-1', [], externalId='g-1')
+    directory.add_group('group-2', [], externalId='g-2')
+
+    users, groups, spns = desired_principals(user_count=180, group_count=3)
+    groups[0].members = [iam.ComplexValue(value=f"u-{x}") for x in range(60, 120)]
+    with ScimStub(directory) as stub:
+        group_1_path = f"/scim/v2/Groups/{directory.find('Groups', 'group-1')['id']}"
+        stub.failures[f"PATCH {group_1_path}"] = 400
+        with pytest.raises(DatabricksError):
+            sync_groups(stub, users, groups, spns, worker_threads=3)
+
+        # other groups were synced
+        memberships = _memberships(directory)
+        assert memberships['group-0'] == sorted(f"user-{x}@example.com" for x in range(60, 120))
+        assert memberships['group-1'] == []
+        assert memberships['group-2'] == sorted(f"user-{x}@example.com" for x in range(2, 180, 3))
+
+        # patches of group are in order: 60 removals, coalesced by filters of 50 members, then additions
+        ops = [op['op'] for path, chunk in stub.patches if path.endswith(group_0['id']) for op in chunk]
+        assert ops == ['remove'] * 2 + ['add']
+
+        # failed group is synced by next run
+        stub.failures = {}
+        result = sync_groups(stub, users, groups, spns, worker_threads=3)
+        assert [x.desired.display_name for x in result.groups if x.changes] == ['group-1']
+        assert _memberships(directory)['group-1'] == sorted(f"user-{x}@example.com" for x in range(1, 180, 3))
+
+
+def test_sync_worker_threads(scim_caches):
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=60, group_count=12)
+    for g in groups:
+        directory.add_group(g.display_name, [], externalId=g.external_id)
+    with ScimStub(directory, latency=0.02) as stub:
+        sync_groups(stub, users, groups, spns, worker_threads=3, member_worker_threads=1)
+
+        # phases overlap, but each has its own workers
+        upserts = [x.get('GET', 0) + x.get('POST', 0) for x in stub.in_flight]
+        members = [x.get('PATCH', 0) for x in stub.in_flight]
+        assert max(upserts) == 3
+        assert max(members) == 1
+        assert len(stub.requests_of('PATCH')) == 12
+
+
+def test_sync_limits_concurrency_of_client(scim_caches):
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=20, group_count=2)
+    with ScimStub(directory) as stub:
+        client = stub.client()
+        adapters = dict(client.api_client._session.adapters)
+        limiters = []
+        for worker_threads in [4, 2]:
+            request_count = len(stub.requests)
+            scim.sync(account_client=client,
+                      users=users,
+                      groups=groups,
+                      service_principals=spns,
+                      deep_sync_group_names=[g.display_name for g in groups],
+                      worker_threads=worker_threads)
+            limiters.append(scim._client_limiters[client.api_client])
+            assert limiters[-1].stats()['requests'] == len(stub.requests) - request_count
+
+        # adapters of the sdk are kept, requests of each sync pass through its own limiter
+        assert client.api_client._session.adapters == adapters
+        assert limiters[0] is not limiters[1]
+        assert limiters[1].stats()['concurrency'] == 2
+
+
+def test_sync_retries_transient_errors(scim_caches, monkeypatch):
+    monkeypatch.setattr(scim.scim_retry_policy, '_base_delay', 0.01)
+    directory = ScimDirectory()
+    directory.add_group('group-0', [], externalId='g-0')
+    users, groups, spns = desired_principals(user_count=6, group_count=1)
+    with ScimStub(directory) as stub:
+        group_path = f"/scim/v2/Groups/{directory.find('Groups', 'group-0')['id']}"
+        stub.failures[f"PATCH {group_path}"] = [500, 502]
+        retries = scim.scim_retry_policy.stats()['retries']
+        sync_groups(stub, users, groups, spns)
+
+        assert scim.scim_retry_policy.stats()['retries'] - retries == 2
+        assert _memberships(directory)['group-0'] == sorted(f"user-{x}@example.com" for x in range(6))
+
+
+def test_sync_retries_throttled_requests(scim_caches, monkeypatch):
+    monkeypatch.setattr(scim.scim_retry_policy, '_base_delay', 0.01)
+    directory = ScimDirectory()
+    directory.add_group('group-0', [], externalId='g-0')
+    users, groups, spns = desired_principals(user_count=6, group_count=1)
+    with ScimStub(directory) as stub:
+        group_path = f"/scim/v2/Groups/{directory.find('Groups', 'group-0')['id']}"
+        stub.failures[f"PATCH {group_path}"] = [429]
+        retries = scim.scim_retry_policy.stats()['retries_by_status'].get(429, 0)
+        sync_groups(stub, users, groups, spns)
+
+        # sdk waits for the throttled request, and gives up, it is retried once, by the retry policy
+        assert scim.scim_retry_policy.stats()['retries_by_status'][429] - retries == 1
+        assert len(stub.requests_of('PATCH', 'Groups')) == 2
+        assert _memberships(directory)['group-0'] == sorted(f"user-{x}@example.com" for x in range(6))
+
+
+def test_sync_pipelined(scim_caches):
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=60, group_count=6, spn_count=1)
+    for g in groups:
+        directory.add_group(g.display_name, [], externalId=g.external_id)
+    with ScimStub(directory, latency=0.01) as stub:
+        sync_groups(stub, users, groups, spns, worker_threads=2)
+
+        # members of first group are synced before all principals are created
+        requests = stub.requests
+        first_patch = min(i for i, x in enumerate(requests) if x.startswith('PATCH'))
+        last_post = max(i for i, x in enumerate(requests) if x.startswith('POST'))
+        assert first_patch < last_post
+
+        memberships = _memberships(directory)
+        assert len(stub.requests_of('PATCH')) == 6
+        assert memberships['group-5'] == sorted([f"user-{x}@example.com" for x in range(5, 60, 6)] + ['app-0'])
+
+
+def test_sync_creates_groups_with_members(scim_caches, monkeypatch):
+    monkeypatch.setattr(scim, '_CREATE_GROUP_MAX_MEMBERS', 8)
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=30, group_count=2, spn_count=1)
+
+    # members are not applied in dry run
+    with ScimStub(directory) as stub:
+        result = sync_groups(stub, users, groups, spns, dry_run_members=True)
+        assert _memberships(directory) == {'group-0': [], 'group-1': []}
+        assert all(x.changes for x in result.groups)
+
+    # groups created by dry run are cached, and would not wait for their members
+    scim_caches('_new')
+    directory = ScimDirectory()
+    with ScimStub(directory) as stub:
+        sync_groups(stub, users, groups, spns)
+
+        # 8 of 16 members created with the group, 8 more added by one patch
+        added = [len(op['value']['members']) for _, ops in stub.patches for op in ops]
+        assert added == [8, 8]
+        assert len(stub.requests_of('PATCH')) == 2
+        assert _memberships(directory)['group-1'] == sorted([f"user-{x}@example.com" for x in range(1, 30, 2)] +
+                                                            ['app-0'])
+
+
+def test_sync_existing_groups_do_not_wait_for_members(scim_caches, monkeypatch):
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=20, group_count=2, spn_count=1)
+    dependencies = {}
+    add = scim.DependencyScheduler.add
+
+    def _add(self, key, func, pool, depends_on=()):
+        dependencies[key] = list(depends_on)
+        return add(self, key, func, pool, depends_on)
+
+    monkeypatch.setattr(scim.DependencyScheduler, 'add', _add)
+    with ScimStub(directory) as stub:
+        # new groups are created with their members
+        sync_groups(stub, users, groups, spns)
+        assert all(len(dependencies[g.external_id]) == len(g.members) for g in groups)
+        memberships = _memberships(directory)
+
+        # groups that were already synced are updated without waiting for their members
+        sync_groups(stub, users, groups, spns)
+        assert all(dependencies[g.external_id] == [] for g in groups)
+        assert _memberships(directory) == memberships
+
+
+def test_sync_skip_unchanged_members(scim_caches):
+    directory = ScimDirectory()
+    users, groups, spns = desired_principals(user_count=300, group_count=1, spn_count=1)
+    with ScimStub(directory) as stub:
+        sync_groups(stub, users, groups, spns, skip_unchanged_members=True)
+
+        # one member removed: one group GET, and one PATCH
+        del stub.requests[:]
+        groups[0].members = groups[0].members[1:]
+        result = sync_groups(stub, users, groups, spns, skip_unchanged_members=True)
+        assert [x.split('?')[0] for x in stub.requests] == [
+            f"GET /scim/v2/Groups/{result.groups[0].id}", f"PATCH /scim/v2/Groups/{result.groups[0].id}"
+        ]
+        assert len(result.users) == 300 and all(x.trusted for x in result.users)
+        assert 'user-0@example.com' not in _memberships(directory)['group-0']
+
+        # changed and new principals are synced
+        del stub.requests[:]
+        users[1].display_name = 'changed'
+        users.append(iam.User(user_name='new@example.com', display_name='new', external_id='u-new', active=True))
+        groups[0].members.append(iam.ComplexValue(value='u-new'))
+        sync_groups(stub, users, groups, spns, skip_unchanged_members=True)
+        assert len(stub.requests_of('GET', 'Users')) == 2
+        assert directory.find('Users', 'user-1@example.com')['displayName'] == 'changed'
+        assert 'new@example.com' in _memberships(directory)['group-0']
+
+        # deleted principals are not indexed
+        scim.delete_users_if_exists(stub.client(), ['user-2@example.com'])
+        assert scim.id_index.get_id('u-2') is None
+
+        # member deleted outside of sync fails the patch, and is synced again by next sync
+        user_3 = directory.find('Users', 'user-3@example.com')
+        directory.resources['Users'].pop(user_3['id'])
+        group = directory.find('Groups', 'group-0')
+        group['members'] = [x for x in group['members'] if x['value'] != user_3['id']]
+        with pytest.raises(DatabricksError):
+            sync_groups(stub, users, groups, spns, skip_unchanged_members=True)
+
+        sync_groups(stub, users, groups, spns, skip_unchanged_members=True)
+        assert {'user-2@example.com', 'user-3@example.com'} <= set(_memberships(directory)['group-0'])
+
+
+def test_sync_mass_leavers(scim_caches, monkeypatch):
+    # 2950 of 3000 members leave group-0, and 10 join it
+    directory = ScimDirectory.generate(user_count=3010)
+    user_ids = [x['id'] for x in directory.resources['Users'].values()]
+    group = directory.add_group('group-0', user_ids[:3000], externalId='g-0')
+    users, groups, spns = desired_principals(user_count=3010, group_count=1)
+    groups[0].members = [iam.ComplexValue(value=f"u-{x}") for x in range(2950, 3010)]
+    expected = sorted(f"user-{x}@example.com" for x in range(2950, 3010))
+
+    # removals are coalesced into few requests, removals first
+    with ScimStub(directory) as stub:
+        sync_groups(stub, users, groups, spns)
+
+        assert _memberships(directory)['group-0'] == expected
+        ops = [op['op'] for _, ops in stub.patches for op in ops]
+        removals = ops.count('remove')
+        assert ops[removals:] == ['add'] and removals <= 62
+        assert len(stub.patches) == 3
+
+    # limits are learned from rejected requests
+    group['members'] = [{'value': x} for x in user_ids[:3000]]
+    monkeypatch.setattr(scim, 'scim_patch_planner', PatchPlanner('scim'))
+    with ScimStub(directory) as stub:
+        stub.max_patch_bytes = 20000
+        stub.coalesced_removals = False
+        sync_groups(stub, users, groups, spns)
+
+        assert _memberships(directory)['group-0'] == expected
+        stats = scim.scim_patch_planner.stats()
+        assert stats['max_bytes'] <= 20000 and stats['max_filter_values'] == 1
+        assert len(stub.patches) == stats['requests'] + stats['rejected']
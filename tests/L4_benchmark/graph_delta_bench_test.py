@@ -0,0 +1,51 @@
+import logging
+import time
+
+from azure_dbr_scim_sync.graph_snapshot import GroupSnapshotStore
+from azure_dbr_scim_sync.persisted_cache import Cache
+from tests.graph_stub import GraphDirectory, GraphStub
+
+logger = logging.getLogger('sync')
+
+
+def test_scoped_delta_pages(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+    # tenant with 10k groups, where 100 are synced, every group has one change since last run
+    directory = GraphDirectory.generate(group_count=10000, users_per_group=1, nested=False)
+    group_names = [f"group-{idx}" for idx in range(0, 10000, 100)]
+    group_cache = Cache('cache_group.json')
+    for name in group_names:
+        group_cache[name] = f"dbr-{name}"
+    group_cache.flush()
+
+    results = {}
+    with GraphStub(directory, page_size=100) as stub:
+        for scoped in [False, True]:
+            snapshot = GroupSnapshotStore(f"snapshot-{scoped}.json.gz") if scoped else None
+            graph_client = stub.client(monkeypatch, group_snapshot=snapshot)
+            delta_link, _ = graph_client.get_objects_for_sync_incremental(None,
+                                                                         group_names,
+                                                                         graph_change_feed_grace_time=0)
+
+            start_change = len(directory.changes)
+            for idx in range(10000):
+                directory.add_member(f"g-{idx}", f"u-{(idx + 1) % 10000}-0")
+
+            stub.requests = []
+            start = time.time()
+            _, sync_obj = graph_client.get_objects_for_sync_incremental(delta_link,
+                                                                       group_names,
+                                                                       graph_change_feed_grace_time=0)
+            elapsed = time.time() - start
+            delta_pages = len([x for x in stub.requests if '/groups/delta' in x])
+            results[scoped] = delta_pages
+            assert len(sync_obj.groups) == 100
+
+            # undo changes, so that both runs see the same tenant
+            for group_id, member_id, _ in directory.changes[start_change:]:
+                directory.members[group_id].remove(member_id)
+
+            logger.warning(f"incremental run (scoped={scoped}): delta pages={delta_pages}, time={elapsed:.2f}s")
+
+    assert results[False] / results[True] >= 50
@@ -0,0 +1,53 @@
+import logging
+import time
+
+from azure_dbr_scim_sync.graph import GraphServicePrincipal, GraphUser
+
+logger = logging.getLogger('sync')
+
+
+def _members(count: int):
+    for i in range(count):
+        if i % 10:
+            yield GraphUser, {
+                '@odata.type': '#microsoft.graph.user',
+                'id': f"user-{i}",
+                'displayName': f"user {i}",
+                'mail': None if i % 3 else f"user-{i}@example.com",
+                'mailNickname': f"user-{i}",
+                'accountEnabled': True,
+                'userPrincipalName': f"user-{i}@example.com",
+                'userType': 'Member',
+                'appId': None,
+                'mailEnabled': None,
+                'securityEnabled': None
+            }
+        else:
+            yield GraphServicePrincipal, {
+                '@odata.type': '#microsoft.graph.servicePrincipal',
+                'id': f"spn-{i}",
+                'displayName': f"spn {i}",
+                'appId': f"app-{i}",
+                'accountEnabled': True,
+                'userPrincipalName': None,
+                'mail': None
+            }
+
+
+def test_model_construction_1m_members():
+    members = list(_members(1_000_000))
+
+    start = time.time()
+    for cls, d in members:
+        cls.model_validate({k: v for k, v in d.items() if v is not None})
+    validate_time = time.time() - start
+
+    start = time.time()
+    for cls, d in members:
+        cls.from_graph(d)
+    fast_time = time.time() - start
+
+    logger.warning(f"1M members: model_validate={validate_time:.2f}s, from_graph={fast_time:.2f}s, "
+                   f"speedup={validate_time / fast_time:.1f}x")
+
+    assert fast_time < validate_time
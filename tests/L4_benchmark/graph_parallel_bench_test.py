@@ -0,0 +1,131 @@
+import logging
+import re
+import time
+
+from azure_dbr_scim_sync.graph import GraphAPIClient
+from tests.graph_stub import GraphDirectory, GraphStub
+
+logger = logging.getLogger('sync')
+
+
+def test_parallel_group_search(monkeypatch):
+    # 100 groups, 2 levels deep, 250 members each => 3 member pages per group, 50ms per request
+    directory = GraphDirectory.generate(group_count=100, users_per_group=240, spns_per_group=10)
+    group_names = [f"group-{idx}" for idx in range(0, 100, 2)]
+
+    with GraphStub(directory, latency=0.05) as stub:
+        timings = {}
+        results = {}
+        for worker_threads in [1, 10]:
+            graph_client = stub.client(monkeypatch, worker_threads=worker_threads, batch_requests=False)
+            start = time.time()
+            results[worker_threads] = graph_client.get_objects_for_sync(group_names, group_search_depth=2)
+            timings[worker_threads] = time.time() - start
+
+    logger.warning(f"get_objects_for_sync: serial={timings[1]:.2f}s, parallel(10)={timings[10]:.2f}s, "
+                   f"speedup={timings[1] / timings[10]:.1f}x")
+
+    serial, parallel = results[1], results[10]
+    assert serial.deep_sync_group_names == parallel.deep_sync_group_names
+    assert len(serial.deep_sync_group_names) == 100
+    assert serial.model_dump() == parallel.model_dump()
+    assert timings[1] / timings[10] > 3
+
+
+def test_batch_round_trips(monkeypatch):
+    # typical whitelist: 2000 small groups, that fit in first page of members
+    directory = GraphDirectory.generate(group_count=2000, users_per_group=20, nested=False)
+    group_names = [f"group-{idx}" for idx in range(2000)]
+
+    with GraphStub(directory, latency=0.01) as stub:
+        counts = {}
+        timings = {}
+        for batch_requests in [False, True]:
+            stub.request_count = 0
+            graph_client = stub.client(monkeypatch, batch_requests=batch_requests)
+            start = time.time()
+            graph_client.get_objects_for_sync(group_names)
+            timings[batch_requests] = time.time() - start
+            counts[batch_requests] = stub.request_count
+
+    logger.warning(f"round trips: unbatched={counts[False]} ({timings[False]:.2f}s), "
+                   f"batched={counts[True]} ({timings[True]:.2f}s)")
+
+    assert counts[False] / counts[True] >= 10
+
+
+def test_transitive_members_round_trips(monkeypatch):
+    # 20 org charts, 8 levels deep
+    directory = GraphDirectory()
+    for org in range(20):
+        for level in range(8):
+            members = [directory.add_user(f"u-{org}-{level}-{idx}")['id'] for idx in range(10)]
+            if level < 7:
+                members.append(f"g-{org}-{level+1}")
+            directory.add_group(f"g-{org}-{level}", f"org-{org}-{level}", members)
+
+    group_names = [f"org-{org}-0" for org in range(20)]
+
+    with GraphStub(directory, latency=0.05) as stub:
+        counts = {}
+        timings = {}
+        name_lookups = {}
+        for batch_requests in [False, True]:
+            for transitive_members in [False, True]:
+                stub.request_count = 0
+                del stub.requests[:]
+                graph_client = stub.client(monkeypatch,
+                                           batch_requests=batch_requests,
+                                           transitive_members=transitive_members)
+                start = time.time()
+                graph_client.get_objects_for_sync(group_names, group_search_depth=8)
+                timings[batch_requests, transitive_members] = time.time() - start
+                counts[batch_requests, transitive_members] = stub.request_count
+                name_lookups[batch_requests, transitive_members] = len(
+                    [x for x in stub.requests if x.startswith('GET /v1.0/groups?')])
+
+        # members of groups deeper than search depth are not downloaded
+        del stub.requests[:]
+        stub.client(monkeypatch, batch_requests=False,
+                    transitive_members=True).get_objects_for_sync(group_names, group_search_depth=2)
+        member_downloads = len([x for x in stub.requests if re.match(r'GET /beta/groups/[^/]+/members\?', x)])
+
+    for batch_requests in [False, True]:
+        logger.warning(f"round trips ({batch_requests=}): "
+                       f"depth by depth={counts[batch_requests, False]} ({timings[batch_requests, False]:.2f}s), "
+                       f"transitive={counts[batch_requests, True]} ({timings[batch_requests, True]:.2f}s)")
+
+    # no name lookups of child groups
+    assert name_lookups[False, True] == 20 and name_lookups[False, False] == 160
+    # 4 waves of requests, instead of 2 waves per search depth
+    assert timings[True, True] < timings[True, False]
+    # 2 levels of 20 org charts
+    assert member_downloads == 40
+
+
+def test_typed_member_streams(monkeypatch):
+    # one large group: 4000 users, 3000 service principals, 3000 groups, 100 members per page, 50ms per request
+    directory = GraphDirectory()
+    members = [directory.add_user(f"u-{idx}")['id'] for idx in range(4000)]
+    members += [directory.add_service_principal(f"s-{idx}")['id'] for idx in range(3000)]
+    for idx in range(3000):
+        directory.add_group(f"g-{idx}", f"child-{idx}")
+        members.append(f"g-{idx}")
+    directory.add_group('g-big', 'big', members)
+
+    with GraphStub(directory, latency=0.05) as stub:
+        timings = {}
+        results = {}
+        for min_members in [None, 1000]:
+            monkeypatch.setattr(GraphAPIClient, '_TYPED_STREAMS_MIN_MEMBERS', min_members or len(members) + 1)
+            graph_client = stub.client(monkeypatch)
+            start = time.time()
+            results[min_members] = graph_client.get_objects_for_sync(['big'])
+            timings[min_members] = time.time() - start
+
+    logger.warning(f"largest group download: single stream={timings[None]:.2f}s, "
+                   f"typed streams={timings[1000]:.2f}s, speedup={timings[None] / timings[1000]:.1f}x")
+
+    assert results[None].model_dump() == results[1000].model_dump()
+    # 100 pages of all members vs 40 pages of users
+    assert timings[None] / timings[1000] > 1.7
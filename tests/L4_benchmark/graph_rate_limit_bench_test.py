@@ -0,0 +1,45 @@
+import logging
+import time
+
+from azure_dbr_scim_sync.rate_limit import RateLimiter
+from tests.graph_stub import GraphDirectory, GraphStub
+
+logger = logging.getLogger('sync')
+
+
+class PerRequestBackoff(RateLimiter):
+    """previous behavior: only throttled request waits for `Retry-After`, other workers keep on sending"""
+
+    def on_throttled(self, retry_after: float = None):
+        with self._lock:
+            self._throttled += 1
+        time.sleep(retry_after)
+
+
+def test_throttled_tenant_throughput(monkeypatch):
+    # tenant allows 20 requests per second, 20 workers, every group takes 2 requests
+    directory = GraphDirectory.generate(group_count=100, users_per_group=10, nested=False)
+    group_names = [f"group-{idx}" for idx in range(100)]
+
+    results = {}
+    for name, limiter in [('per_request', PerRequestBackoff('graph')), ('shared', RateLimiter('graph'))]:
+        with GraphStub(directory, latency=0.01, requests_per_second=20) as stub:
+            graph_client = stub.client(monkeypatch, worker_threads=20, batch_requests=False, rate_limiter=limiter)
+            start = time.time()
+            try:
+                graph_client.get_objects_for_sync(group_names)
+                error = None
+            except Exception as e:
+                error = type(e).__name__
+            elapsed = time.time() - start
+            results[name] = (elapsed, stub.throttled_count, error, limiter.stats())
+
+        logger.warning(f"{name}: time={elapsed:.2f}s, throttled responses={stub.throttled_count}, error={error}, "
+                       f"limiter={limiter.stats()}")
+
+    shared_time, shared_throttled, shared_error, _ = results['shared']
+    per_request_time, per_request_throttled, _, _ = results['per_request']
+
+    assert shared_error is None
+    assert shared_throttled < per_request_throttled
+    assert shared_time < per_request_time
@@ -0,0 +1,39 @@
+import logging
+import time
+
+from azure_dbr_scim_sync.graph_snapshot import GroupSnapshotStore
+
+logger = logging.getLogger('sync')
+
+
+def test_snapshot_500k_memberships(tmp_path):
+    file_name = str(tmp_path / 'snapshot.json.gz')
+
+    # 1000 groups with 500 members each, drawn from 100k users
+    s = GroupSnapshotStore(file_name)
+    for g in range(1000):
+        s[f"group-{g}"] = {
+            'group': {'id': f"group-{g}", 'displayName': f"group {g}", 'securityEnabled': True},
+            'members': [{
+                '@odata.type': '#microsoft.graph.user',
+                'id': f"user-{u}",
+                'displayName': f"user {u}",
+                'userPrincipalName': f"user-{u}@example.com",
+                'accountEnabled': True
+            } for u in range(g * 100, g * 100 + 500)]
+        }
+
+    start = time.time()
+    s.flush()
+    flush_time = time.time() - start
+
+    start = time.time()
+    s2 = GroupSnapshotStore(file_name)
+    load_time = time.time() - start
+
+    size = tmp_path.joinpath('snapshot.json.gz').stat().st_size
+    logger.warning(f"snapshot of 500k memberships: flush={flush_time:.2f}s, load={load_time:.2f}s, "
+                   f"size={size / 1024 / 1024:.1f}MB")
+
+    assert len(s2.member_ids('group-999')) == 500
+    assert load_time < 5
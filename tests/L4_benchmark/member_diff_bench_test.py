@@ -0,0 +1,104 @@
+import logging
+import random
+import time
+import tracemalloc
+import uuid
+from threading import Lock
+
+from azure_dbr_scim_sync.member_diff import MemberIds
+
+logger = logging.getLogger('sync')
+
+
+class _LegacyDiff:
+    """diff of members, with sets and dicts of string ids built for each group from results of the scheduler"""
+
+    def __init__(self, principals):
+        self._lock = Lock()
+        self._results = dict(principals)
+
+    def _result(self, x):
+        with self._lock:
+            return self._results.get(x)
+
+    def diff(self, desired, actual):
+        graph_to_dbr_ids = {}
+        for x in desired:
+            member_dbr_id = self._result(x)
+            if member_dbr_id is not None:
+                graph_to_dbr_ids[x] = member_dbr_id
+        dbr_to_graph_ids = {v: k for k, v in graph_to_dbr_ids.items()}
+
+        graph_group_member_ids = set(desired)
+        to_delete_member_dbr_ids = set()
+        visited_member_dbr_ids = set()
+        visited_member_graph_ids = set()
+        for member_dbr_id in actual:
+            member_graph_id = dbr_to_graph_ids.get(member_dbr_id)
+            if (not member_graph_id) or (member_graph_id not in graph_group_member_ids):
+                to_delete_member_dbr_ids.add(member_dbr_id)
+                continue
+            visited_member_dbr_ids.add(member_dbr_id)
+            visited_member_graph_ids.add(member_graph_id)
+
+        to_add_member_graph_ids = graph_group_member_ids - visited_member_graph_ids
+        to_add_member_dbr_ids = set(graph_to_dbr_ids[x] for x in to_add_member_graph_ids if x in graph_to_dbr_ids)
+        return sorted(to_delete_member_dbr_ids), sorted(to_add_member_dbr_ids)
+
+
+class _InternedDiff:
+
+    def __init__(self, principals):
+        self._member_ids = MemberIds()
+        for g, d in principals:
+            self._member_ids.set(g, d)
+
+    def diff(self, desired, actual):
+        member_ids = self._member_ids
+        to_remove, to_add = member_ids.diff(member_ids.desired(desired), member_ids.actual(actual))
+        return sorted(member_ids.dbr_ids.values(to_remove)), sorted(member_ids.dbr_ids.values(to_add))
+
+
+def test_member_diff_100_groups_50k_members():
+    # 200k principals, 100 groups of 50k members, 1% of members of each group changed
+    rnd = random.Random(42)
+    principals = [(str(uuid.UUID(int=rnd.getrandbits(128))), str(rnd.getrandbits(53))) for _ in range(200_000)]
+    dbr_ids = dict(principals)
+    groups = []
+    for _ in range(100):
+        desired = [g for g, _ in rnd.sample(principals, 50_000)]
+        actual = [dbr_ids[g] for g in desired[500:]] + [d for _, d in rnd.sample(principals, 500)]
+        # member ids of group are parsed from response
+        groups.append((desired, [str(int(x)) for x in actual]))
+
+    results = {}
+    timings = {}
+    shared = {}
+    per_group = {}
+    for mode, cls in [('legacy', _LegacyDiff), ('interned', _InternedDiff)]:
+        start = time.process_time()
+        engine = cls(principals)
+        results[mode] = [engine.diff(desired, actual) for desired, actual in groups]
+        timings[mode] = time.process_time() - start
+
+        # memory shared by all the groups, and working memory of each group, which is needed by each of the
+        # groups synced concurrently
+        tracemalloc.start()
+        engine = cls(principals)
+        shared[mode] = tracemalloc.get_traced_memory()[0] / 2**20
+        peaks = []
+        for desired, actual in groups[:10]:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            engine.diff(desired, actual)
+            peaks.append((tracemalloc.get_traced_memory()[1] - current) / 2**20)
+        per_group[mode] = max(peaks)
+        tracemalloc.stop()
+
+    logger.warning("diff of 100 groups of 50k members: " +
+                   ", ".join(f"{x}={timings[x]:.2f}s cpu, {shared[x]:.1f}MB shared, {per_group[x]:.1f}MB per group"
+                             for x in results))
+
+    assert results['legacy'] == results['interned']
+    assert timings['interned'] < timings['legacy']
+    assert per_group['interned'] < per_group['legacy']
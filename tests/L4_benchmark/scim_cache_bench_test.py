@@ -0,0 +1,24 @@
+import logging
+
+from tests.scim_stub import ScimDirectory, ScimStub, desired_principals, sync_groups, timed_sync_groups
+
+logger = logging.getLogger('sync')
+
+
+def test_cache_trust(scim_caches):
+    # warm sync of 2000 users in 20 groups, without changes, 10ms per request
+    users, groups, _ = desired_principals(user_count=2000, group_count=20)
+    with ScimStub(ScimDirectory(), latency=0.01) as stub:
+        sync_groups(stub, users, groups)
+
+        verified, verified_count, verified_time = timed_sync_groups(stub, users, groups)
+        trusted, trusted_count, trusted_time = timed_sync_groups(stub, users, groups, cache_trust_ttl=3600)
+
+    logger.warning(f"warm sync of 2000 users: verified={verified_count} ({verified_time:.2f}s), "
+                   f"trusted={trusted_count} ({trusted_time:.2f}s)")
+
+    assert verified.effecitve_change_count == 0 and trusted.effecitve_change_count == 0
+    # 5% of principals are still verified
+    assert verified_count == 2020
+    assert trusted_count < verified_count * 0.1
+    assert trusted_time < verified_time
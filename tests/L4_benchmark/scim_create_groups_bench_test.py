@@ -0,0 +1,27 @@
+import logging
+
+from azure_dbr_scim_sync import scim
+from tests.scim_stub import ScimDirectory, ScimStub, desired_principals, timed_sync_groups
+
+logger = logging.getLogger('sync')
+
+
+def test_create_groups_with_members(scim_caches, monkeypatch):
+    # onboarding of 500 new groups, of 20 (out of 1000 existing) users each, 5ms per request
+    users, groups, _ = desired_principals(user_count=1000, group_count=500)
+
+    # groups created empty, and patched with members afterwards, or created with members
+    modes = {'patched': 0, 'created': scim._CREATE_GROUP_MAX_MEMBERS}
+    counts = {}
+    timings = {}
+    for mode, max_members in modes.items():
+        monkeypatch.setattr(scim, '_CREATE_GROUP_MAX_MEMBERS', max_members)
+        scim_caches(f"_{mode}")
+        with ScimStub(ScimDirectory.generate(user_count=1000), latency=0.005) as stub:
+            _, counts[mode], timings[mode] = timed_sync_groups(stub, users, groups, prefetch_principals=True)
+
+    logger.warning("onboarding of 500 groups: " + ", ".join(f"{x}={counts[x]} ({timings[x]:.2f}s)" for x in modes))
+
+    # one request per group, instead of two
+    assert counts['patched'] - counts['created'] == 500
+    assert timings['created'] < timings['patched']
@@ -0,0 +1,30 @@
+import logging
+
+from tests.scim_stub import ScimDirectory, ScimStub, desired_principals, timed_sync_groups
+
+logger = logging.getLogger('sync')
+
+
+def test_prefetch_and_batched_lookups(scim_caches):
+    # first sync into account, where 5000 users already exist, 10ms per request
+    users, groups, _ = desired_principals(user_count=5000, group_count=10)
+
+    # one by one lookups, batched lookups, and prefetch of all principals
+    modes = {
+        'lookups': dict(batch_lookups=False),
+        'batched': dict(batch_lookups=True),
+        'prefetch': dict(prefetch_principals=True)
+    }
+    counts = {}
+    timings = {}
+    for mode, kwargs in modes.items():
+        scim_caches(f"_{mode}")
+        with ScimStub(ScimDirectory.generate(user_count=5000), latency=0.01) as stub:
+            _, counts[mode], timings[mode] = timed_sync_groups(stub, users, groups, **kwargs)
+
+    logger.warning("sync of 5000 existing users: " + ", ".join(f"{x}={counts[x]} ({timings[x]:.2f}s)" for x in modes))
+
+    assert counts['lookups'] / counts['prefetch'] > 50
+    assert counts['lookups'] / counts['batched'] > 20
+    assert timings['prefetch'] < timings['lookups']
+    assert timings['batched'] < timings['lookups']
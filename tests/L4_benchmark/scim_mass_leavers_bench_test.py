@@ -0,0 +1,41 @@
+import logging
+
+from databricks.sdk.service import iam
+
+from azure_dbr_scim_sync import scim
+from azure_dbr_scim_sync.patch_planner import PatchPlanner
+from tests.scim_stub import ScimDirectory, ScimStub, desired_principals, timed_sync_groups
+
+logger = logging.getLogger('sync')
+
+
+def test_sync_mass_leavers(scim_caches, monkeypatch):
+    # 1900 of 2000 members leave each of 20 groups, 5ms per request
+    users, groups, _ = desired_principals(user_count=2000, group_count=20)
+    for idx, g in enumerate(groups):
+        g.members = [iam.ComplexValue(value=f"u-{(idx * 100 + x) % 2000}") for x in range(100)]
+
+    # one removal per operation, 50 operations per request, or coalesced removals packed by bytes
+    modes = {'single': PatchPlanner('scim', max_filter_values=1), 'coalesced': PatchPlanner('scim')}
+    counts = {}
+    timings = {}
+    for mode, planner in modes.items():
+        scim_caches(f"_{mode}")
+        monkeypatch.setattr(scim, 'scim_patch_planner', planner)
+
+        directory = ScimDirectory.generate(user_count=2000)
+        user_ids = [x['id'] for x in directory.resources['Users'].values()]
+        for g in groups:
+            directory.add_group(g.display_name, user_ids, externalId=g.external_id)
+
+        with ScimStub(directory, latency=0.005) as stub:
+            _, _, timings[mode] = timed_sync_groups(stub, users, groups, prefetch_principals=True)
+            counts[mode] = len(stub.requests_of('PATCH'))
+
+        assert all(len(directory.member_ids(g['id'])) == 100 for g in directory.resources['Groups'].values())
+
+    logger.warning("sync of 1900 leavers of 20 groups: " +
+                   ", ".join(f"{x}={counts[x]} patches ({timings[x]:.2f}s)" for x in modes))
+
+    assert counts['single'] > 10 * counts['coalesced']
+    assert timings['coalesced'] < timings['single']
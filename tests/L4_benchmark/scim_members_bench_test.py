@@ -0,0 +1,39 @@
+import logging
+
+from databricks.sdk.service import iam
+
+from tests.scim_stub import ScimDirectory, ScimStub, desired_principals, sync_groups, timed_sync_groups
+
+logger = logging.getLogger('sync')
+
+
+def test_sync_members_concurrently(scim_caches):
+    # members of 200 existing groups, of 100 (out of 2000) users each, are synced, 10ms per request
+    users, groups, _ = desired_principals(user_count=2000, group_count=200)
+    for idx, g in enumerate(groups):
+        g.members = [iam.ComplexValue(value=f"u-{(idx * 10 + x) % 2000}") for x in range(100)]
+
+    timings = {}
+    for worker_threads in [1, 10]:
+        scim_caches(f"_{worker_threads}")
+
+        directory = ScimDirectory.generate(user_count=2000)
+        for idx in range(200):
+            directory.add_group(f"group-{idx}", externalId=f"g-{idx}")
+
+        with ScimStub(directory, latency=0.01) as stub:
+            result = sync_groups(stub, users, groups, prefetch_principals=True, dry_run_members=True)
+            # 100 members added by one operation
+            assert all(len(x.changes) == 1 for x in result.groups)
+
+            # principals are trusted, only groups are downloaded and patched
+            _, _, timings[worker_threads] = timed_sync_groups(stub,
+                                                              users,
+                                                              groups,
+                                                              worker_threads=worker_threads,
+                                                              cache_trust_ttl=3600,
+                                                              cache_trust_sample_rate=0)
+
+    logger.warning(f"sync of 200 groups members: 1 thread={timings[1]:.2f}s, 10 threads={timings[10]:.2f}s")
+
+    assert timings[1] / timings[10] > 1.8
@@ -0,0 +1,29 @@
+from typing import Callable
+
+import pytest
+
+from azure_dbr_scim_sync import scim
+from azure_dbr_scim_sync.patch_planner import PatchPlanner
+from azure_dbr_scim_sync.scim_cache import IdIndex, PrincipalCache
+
+
+@pytest.fixture()
+def scim_caches(monkeypatch, tmp_path) -> Callable[[str], None]:
+    """
+    empty principal caches, id index and new patch planner of `scim` module, in temp directory
+
+    :return: function replacing them with new ones, which cache files are named with given suffix,
+      i.e. to sync each benchmarked mode from scratch
+    """
+    monkeypatch.chdir(tmp_path)
+
+    def _reset(suffix: str = ''):
+        for kind, name in [('user', 'user_cache'), ('group', 'group_cache'), ('spn', 'spn_cache')]:
+            cache = PrincipalCache(f"cache_{kind}{suffix}.json")
+            monkeypatch.setattr(scim, name, cache)
+            monkeypatch.setitem(scim._generic_type_map[kind], 'cache', cache)
+        monkeypatch.setattr(scim, 'id_index', IdIndex(f"cache_ids{suffix}.json"))
+        monkeypatch.setattr(scim, 'scim_patch_planner', PatchPlanner('scim'))
+
+    _reset()
+    return _reset
@@ -0,0 +1,373 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from azure_dbr_scim_sync.graph import GraphAPIClient
+from azure_dbr_scim_sync.rate_limit import RateLimiter
+
+
+class GraphDirectory:
+    """In memory AAD/Entra directory served by `GraphStub`"""
+
+    def __init__(self):
+        self.users: Dict[str, dict] = {}
+        self.service_principals: Dict[str, dict] = {}
+        self.groups: Dict[str, dict] = {}
+        self.members: Dict[str, List[str]] = {}
+        # change feed: (group id, member id, removed), delta token is position in it,
+        # member id is None for changes of group attributes
+        self.changes: List[tuple] = []
+        # time of each change, used by `GraphStub` to delay its visibility on members endpoints
+        self.change_times: List[float] = []
+        self.user_changes: List[tuple] = []
+        self.expired_delta_token = -1
+
+    def add_user(self, id: str, **kwargs):
+        self.users[id] = {
+            '@odata.type': '#microsoft.graph.user',
+            'id': id,
+            'displayName': kwargs.get('displayName', f"user {id}"),
+            'userPrincipalName': kwargs.get('userPrincipalName', f"{id}@example.com"),
+            'mail': kwargs.get('mail', f"{id}@example.com"),
+            'accountEnabled': kwargs.get('accountEnabled', True),
+            'userType': kwargs.get('userType', 'Member')
+        }
+        return self.users[id]
+
+    def add_service_principal(self, id: str, **kwargs):
+        self.service_principals[id] = {
+            '@odata.type': '#microsoft.graph.servicePrincipal',
+            'id': id,
+            'displayName': kwargs.get('displayName', f"spn {id}"),
+            'appId': kwargs.get('appId', f"app-{id}"),
+            'accountEnabled': kwargs.get('accountEnabled', True)
+        }
+        return self.service_principals[id]
+
+    def add_group(self, id: str, display_name: str = None, members: List[str] = None, **kwargs):
+        self.groups[id] = {
+            '@odata.type': '#microsoft.graph.group',
+            'id': id,
+            'displayName': display_name or f"group {id}",
+            'securityEnabled': kwargs.get('securityEnabled', True),
+            'mailEnabled': kwargs.get('mailEnabled', False)
+        }
+        self.members[id] = list(members or [])
+        return self.groups[id]
+
+    def add_member(self, group_id: str, member_id: str):
+        self.members[group_id].append(member_id)
+        self.changes.append((group_id, member_id, False))
+        self.change_times.append(time.monotonic())
+
+    def remove_member(self, group_id: str, member_id: str):
+        self.members[group_id].remove(member_id)
+        self.changes.append((group_id, member_id, True))
+        self.change_times.append(time.monotonic())
+
+    def update_group(self, id: str, **kwargs):
+        self.groups[id].update(kwargs)
+        self.changes.append((id, None, False))
+        self.change_times.append(time.monotonic())
+
+    def update_user(self, id: str, **kwargs):
+        self.users[id].update(kwargs)
+        self.user_changes.append((id, kwargs))
+
+    def get_object(self, id: str) -> dict:
+        return self.users.get(id) or self.service_principals.get(id) or self.groups.get(id)
+
+    def transitive_members(self, group_id: str) -> List[str]:
+        ret = {}
+        stack = list(self.members[group_id])
+        while stack:
+            x = stack.pop()
+            if x not in ret:
+                ret[x] = True
+                stack.extend(self.members.get(x, []))
+        return list(ret)
+
+    @classmethod
+    def generate(cls, group_count: int, users_per_group: int, spns_per_group: int = 0, nested: bool = True):
+        """every group gets its own users and service principals, group N is a member of group N-1"""
+        d = cls()
+        for g in range(group_count):
+            members = []
+            for u in range(users_per_group):
+                members.append(d.add_user(f"u-{g}-{u}")['id'])
+            for s in range(spns_per_group):
+                members.append(d.add_service_principal(f"s-{g}-{s}")['id'])
+            if nested and g + 1 < group_count:
+                members.append(f"g-{g+1}")
+            d.add_group(f"g-{g}", f"group-{g}", members)
+        return d
+
+
+class GraphStub:
+    """Local stand-in of Graph API, serving `GraphDirectory` with configurable latency"""
+
+    def __init__(self,
+                 directory: GraphDirectory,
+                 latency: float = 0.0,
+                 page_size: int = 100,
+                 throttle_batch_requests: bool = False,
+                 requests_per_second: int = None,
+                 membership_lag: float = 0.0):
+        self.directory = directory
+        self.latency = latency
+        self.page_size = page_size
+        # first attempt of each batch sub-request gets 429
+        self.throttle_batch_requests = throttle_batch_requests
+        self._throttled = set()
+        # tenant throttling, once over the limit, all requests get 429 for a second,
+        # requests that do not honor Retry-After extend it, as in Graph API
+        self.requests_per_second = requests_per_second
+        self.throttled_count = 0
+        self._window = []
+        self._blocked_until = 0.0
+        # members changes are visible in change feed right away, but on members endpoint only after the lag
+        self.membership_lag = membership_lag
+        self.request_count = 0
+        self.requests: List[str] = []
+        # requests sent within batches
+        self.batch_requests: List[str] = []
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                stub._handle(self, 'GET', None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                stub._handle(self, 'POST', body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def client(self, monkeypatch, **kwargs) -> GraphAPIClient:
+        """`GraphAPIClient` pointing to the stub, with authentication disabled"""
+        monkeypatch.setattr(GraphAPIClient, '_authenticate', lambda _: None)
+        monkeypatch.setattr(GraphAPIClient, '_get_header', lambda _: {"Authorization": "Bearer stub"})
+        # throttling of one test should not slow down the others
+        kwargs.setdefault('rate_limiter', RateLimiter('graph_stub'))
+        return GraphAPIClient(base_url=self.base_url, **kwargs)
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str, body):
+        with self._lock:
+            self.request_count += 1
+            self.requests.append(f"{method} {unquote(handler.path)}")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        headers = {}
+        if self._is_over_limit():
+            status, payload = 429, {'error': {'code': 'TooManyRequests'}}
+            headers['Retry-After'] = '1'
+        else:
+            status, payload = self.route(method, handler.path, body)
+
+        data = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _is_over_limit(self) -> bool:
+        if not self.requests_per_second:
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            self._window = [x for x in self._window if x > now - 1]
+            self._window.append(now)
+            if now < self._blocked_until or len(self._window) > self.requests_per_second:
+                self._blocked_until = now + 1
+                self.throttled_count += 1
+                return True
+
+        return False
+
+    def route(self, method: str, path: str, body):
+        url = urlparse(path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = re.sub('/+', '/', url.path).rstrip('/')
+
+        m = re.match(r'^/(beta|v1\.0)/\$batch$', path)
+        if m and method == 'POST':
+            return 200, {'responses': [self._batch_response(m.group(1), r) for r in body['requests']]}
+
+        if path == '/v1.0/groups' and '$filter' in query:
+            name = re.match(r"displayName eq '(.*)'", query['$filter']).group(1).replace("''", "'")
+            value = [g for g in self.directory.groups.values() if g['displayName'] == name]
+            return 200, {'value': value}
+
+        m = re.match(r'^/(?:beta|v1\.0)/groups/([^/]+)/members/\$count$', path)
+        if m:
+            if m.group(1) not in self.directory.members:
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            return 200, len(self._visible_members(m.group(1)))
+
+        m = re.match(r'^/(?:beta|v1\.0)/groups/([^/]+)/members/(?!microsoft\.graph\.)([^/]+)$', path)
+        if m:
+            group_id, member_id = m.groups()
+            if group_id not in self.directory.members or member_id not in self._visible_members(group_id):
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            return 200, self.directory.get_object(member_id)
+
+        m = re.match(r'^/(?:beta|v1\.0)/groups/([^/]+)/(members|transitiveMembers)(?:/microsoft\.graph\.(\w+))?$',
+                     path)
+        if m:
+            group_id, relation, cast = m.groups()
+            if group_id not in self.directory.members:
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            if relation == 'members':
+                member_ids = self._visible_members(group_id)
+            else:
+                member_ids = self.directory.transitive_members(group_id)
+            value = [self.directory.get_object(x) for x in member_ids]
+            if cast:
+                value = [x for x in value if x['@odata.type'] == f"#microsoft.graph.{cast}"]
+            return 200, self._page(path, query, value)
+
+        m = re.match(r'^/(?:beta|v1\.0)/directoryObjects/([^/]+)$', path)
+        if m:
+            obj = self.directory.get_object(m.group(1))
+            if not obj:
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            return 200, obj
+
+        if path == '/v1.0/groups/delta':
+            return self._groups_delta(path, query)
+
+        if path == '/v1.0/users/delta':
+            return self._users_delta(path, query)
+
+        return 404, {'error': {'code': 'BadRequest', 'message': f"unsupported path: {path}"}}
+
+    def _visible_members(self, group_id: str) -> List[str]:
+        member_ids = list(self.directory.members[group_id])
+        if not self.membership_lag:
+            return member_ids
+
+        # recent changes are reverted, newest first
+        visible_since = time.monotonic() - self.membership_lag
+        for (changed_group_id, member_id, removed), t in reversed(
+                list(zip(self.directory.changes, self.directory.change_times))):
+            if t <= visible_since:
+                break
+            if changed_group_id == group_id and member_id is not None:
+                if removed:
+                    member_ids.append(member_id)
+                else:
+                    member_ids.remove(member_id)
+
+        return member_ids
+
+    def _groups_delta(self, path: str, query: dict):
+        # filter by ids is kept in delta link, same as in the Graph API
+        id_filter = query.get('$filter')
+        delta_link = self._delta_link(len(self.directory.changes))
+        group_ids = None
+        if id_filter:
+            group_ids = set(re.findall(r"id eq '([^']+)'", id_filter))
+            if len(group_ids) > 50:
+                return 400, {'error': {'code': 'BadRequest', 'message': 'too many ids in filter'}}
+            delta_link = f"{delta_link}&$filter={quote(id_filter)}"
+
+        token = query['$deltatoken']
+        if token == 'latest':
+            return 200, {'value': [], '@odata.deltaLink': delta_link}
+
+        token = int(token)
+        if token <= self.directory.expired_delta_token:
+            return 410, {'error': {'code': 'resyncRequired'}}
+
+        value = []
+        for group_id, member_id, removed in self.directory.changes[token:]:
+            if group_ids is not None and group_id not in group_ids:
+                continue
+            group = self.directory.groups[group_id]
+            entry = {k: group[k] for k in ['id', 'displayName', 'securityEnabled', 'mailEnabled']}
+            if member_id is not None:
+                member = {'@odata.type': self.directory.get_object(member_id)['@odata.type'], 'id': member_id}
+                if removed:
+                    member['@removed'] = {'reason': 'deleted'}
+                entry['members@delta'] = [member]
+            value.append(entry)
+
+        ret = self._page(path, query, value)
+        if '@odata.nextLink' not in ret:
+            ret['@odata.deltaLink'] = delta_link
+        return 200, ret
+
+    def _users_delta(self, path: str, query: dict):
+        # selected attributes are kept in delta link, same as in the Graph API
+        select = query.get('$select', '')
+        delta_link = f"{self._delta_link(len(self.directory.user_changes), 'users')}&$select={select}"
+
+        token = query['$deltatoken']
+        if token == 'latest':
+            return 200, {'value': [], '@odata.deltaLink': delta_link}
+
+        value = [{k: v
+                  for k, v in self.directory.users[id].items()
+                  if k in select.split(',')}
+                 for id, _ in self.directory.user_changes[int(token):]]
+        ret = self._page(path, query, value)
+        if '@odata.nextLink' not in ret:
+            ret['@odata.deltaLink'] = delta_link
+        return 200, ret
+
+    def _delta_link(self, token: int, resource: str = 'groups'):
+        return f"{self.base_url.rstrip('/')}/v1.0/{resource}/delta?$deltatoken={token}"
+
+    def _batch_response(self, version: str, request: dict):
+        with self._lock:
+            self.batch_requests.append(f"{request['method']} {unquote(request['url'])}")
+            throttle = self.throttle_batch_requests and request['url'] not in self._throttled
+            self._throttled.add(request['url'])
+
+        if throttle:
+            return {'id': request['id'], 'status': 429, 'headers': {'Retry-After': '0'}, 'body': {}}
+
+        status, body = self.route(request['method'], f"/{version}{request['url']}", None)
+        return {'id': request['id'], 'status': status, 'headers': {}, 'body': body}
+
+    def _page(self, path: str, query: dict, value: list):
+        page_size = min(int(query.get('$top') or self.page_size), self.page_size)
+        skip = int(query.get('$skiptoken') or 0)
+        ret = {'value': value[skip:skip + page_size]}
+        if query.get('$count') == 'true':
+            ret['@odata.count'] = len(value)
+        if skip + page_size < len(value):
+            q = '&'.join(f"{k}={quote(v)}" for k, v in query.items() if k != '$skiptoken')
+            ret['@odata.nextLink'] = f"{self.base_url.rstrip('/')}{path}?{q}&$skiptoken={skip + page_size}"
+        return ret
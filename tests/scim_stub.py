@@ -0,0 +1,307 @@
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple, Union
+from urllib.parse import parse_qs, unquote, urlparse
+
+from databricks.sdk import AccountClient
+from databricks.sdk.service import iam
+
+from azure_dbr_scim_sync import scim
+
+
+def sync_groups(stub: 'ScimStub', users, groups, spns=(), **kwargs) -> scim.ScimSyncObject:
+    """syncs principals into `stub`, and members of all the `groups`"""
+    return scim.sync(account_client=stub.client(),
+                     users=users,
+                     groups=groups,
+                     service_principals=spns,
+                     deep_sync_group_names=[g.display_name for g in groups],
+                     **kwargs)
+
+
+def timed_sync_groups(stub: 'ScimStub', users, groups, spns=(),
+                      **kwargs) -> Tuple[scim.ScimSyncObject, int, float]:
+    """:return: result of `sync_groups()`, number of its requests, and its duration in seconds"""
+    request_count = len(stub.requests)
+    start = time.time()
+    result = sync_groups(stub, users, groups, spns, **kwargs)
+    return result, len(stub.requests) - request_count, time.time() - start
+
+
+def desired_principals(user_count: int, group_count: int, spn_count: int = 0):
+    """
+    desired users, groups and service principals, users are spread across groups,
+    and every service principal is a member of every group
+
+    :return: users, groups, service principals
+    """
+    users = [
+        iam.User(user_name=f"user-{idx}@example.com",
+                 display_name=f"user {idx}",
+                 external_id=f"u-{idx}",
+                 active=True) for idx in range(user_count)
+    ]
+    spns = [
+        iam.ServicePrincipal(application_id=f"app-{idx}",
+                             display_name=f"app-{idx}",
+                             external_id=f"s-{idx}",
+                             active=True) for idx in range(spn_count)
+    ]
+    groups = [
+        iam.Group(display_name=f"group-{idx}",
+                  external_id=f"g-{idx}",
+                  members=[iam.ComplexValue(value=f"u-{x}") for x in range(idx, user_count, group_count)] +
+                  [iam.ComplexValue(value=f"s-{x}") for x in range(spn_count)]) for idx in range(group_count)
+    ]
+    return users, groups, spns
+
+
+class ScimDirectory:
+    """In memory Databricks account, users, groups and service principals, served by `ScimStub`"""
+
+    # attribute identifying principals of each resource, in addition to id
+    KEYS = {'Users': 'userName', 'Groups': 'displayName', 'ServicePrincipals': 'applicationId'}
+
+    def __init__(self):
+        self.resources: Dict[str, Dict[str, dict]] = {x: {} for x in self.KEYS}
+
+    def add(self, resource: str, **attrs) -> dict:
+        obj = {'id': attrs.pop('id', None) or uuid.uuid4().hex, **attrs}
+        self.resources[resource][obj['id']] = obj
+        return obj
+
+    def add_user(self, user_name: str, **kwargs) -> dict:
+        return self.add('Users', userName=user_name, **{'displayName': user_name, 'active': True, **kwargs})
+
+    def add_service_principal(self, application_id: str, **kwargs) -> dict:
+        return self.add('ServicePrincipals',
+                        applicationId=application_id,
+                        **{
+                            'displayName': application_id,
+                            'active': True,
+                            **kwargs
+                        })
+
+    def add_group(self, display_name: str, member_ids: List[str] = None, **kwargs) -> dict:
+        return self.add('Groups',
+                        displayName=display_name,
+                        members=[{
+                            'value': x
+                        } for x in member_ids or []],
+                        **kwargs)
+
+    def find(self, resource: str, key: str) -> dict:
+        attr = self.KEYS[resource]
+        return next((x for x in self.resources[resource].values() if x.get(attr) == key), None)
+
+    def member_ids(self, group_id: str) -> List[str]:
+        return [m['value'] for m in self.resources['Groups'][group_id].get('members') or []]
+
+    @classmethod
+    def generate(cls, user_count: int, group_count: int = 0, spn_count: int = 0, members_per_group: int = 0):
+        """users `user-N@example.com` (external id `u-N`), groups `group-N` with first users as members"""
+        d = cls()
+        users = [
+            d.add_user(f"user-{idx}@example.com", displayName=f"user {idx}", externalId=f"u-{idx}")['id']
+            for idx in range(user_count)
+        ]
+        for idx in range(spn_count):
+            d.add_service_principal(f"app-{idx}", externalId=f"s-{idx}")
+        for idx in range(group_count):
+            d.add_group(f"group-{idx}", users[:members_per_group], externalId=f"g-{idx}")
+        return d
+
+
+class ScimStub:
+    """Local stand-in of Databricks account SCIM API, serving `ScimDirectory` with configurable latency"""
+
+    def __init__(self, directory: ScimDirectory, latency: float = 0.0, max_page_size: int = 100):
+        self.directory = directory
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.account_id = 'stub'
+        self.requests: List[str] = []
+        # PATCH requests, (path, operations), in order of arrival
+        self.patches: List[tuple] = []
+        # "METHOD path" -> status code of injected error responses, or status codes of next responses
+        self.failures: Dict[str, Union[int, List[int]]] = {}
+        # PATCH requests with larger body are rejected with 413
+        self.max_patch_bytes: int = None
+        # if False, removals of members by filters with `or` are rejected with 400
+        self.coalesced_removals = True
+        # number of requests being handled, by method, when each request arrived
+        self.in_flight: List[Dict[str, int]] = []
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def do_GET(self):
+                stub._handle(self, 'GET', None)
+
+            def do_POST(self):
+                stub._handle(self, 'POST', self._body())
+
+            def do_PATCH(self):
+                stub._handle(self, 'PATCH', self._body())
+
+            def do_DELETE(self):
+                stub._handle(self, 'DELETE', None)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def client(self) -> AccountClient:
+        return scim.new_account_client(host=self.base_url, account_id=self.account_id, token='stub')
+
+    def requests_of(self, method: str, resource: str = '') -> List[str]:
+        with self._lock:
+            return [x for x in self.requests if x.startswith(f"{method} /scim/v2/{resource}")]
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str, body):
+        url = urlparse(handler.path)
+        prefix = f"/api/2.0/accounts/{self.account_id}"
+        path = url.path[len(prefix):] if url.path.startswith(prefix) else url.path
+        with self._lock:
+            self.requests.append(f"{method} {path}?{unquote(url.query)}" if url.query else f"{method} {path}")
+            if method == 'PATCH':
+                self.patches.append((path, body['Operations']))
+            self._in_flight[method] += 1
+            self.in_flight.append(dict(self._in_flight))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            failure = self.failures.get(f"{method} {path}")
+            if isinstance(failure, list):
+                failure = failure.pop(0) if failure else None
+            if failure:
+                status, payload = self._error(failure, "injected failure")
+            else:
+                status, payload = self.route(method, path, {k: v[0] for k, v in parse_qs(url.query).items()}, body)
+            self._in_flight[method] -= 1
+
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    @staticmethod
+    def _error(status: int, detail: str):
+        return status, {'schemas': ['urn:ietf:params:scim:api:messages:2.0:Error'], 'detail': detail,
+                        'status': str(status)}
+
+    def route(self, method: str, path: str, query: dict, body):
+        m = re.match(r'^/scim/v2/(Users|Groups|ServicePrincipals)(?:/([^/]+))?$', path)
+        if not m:
+            return self._error(404, f"unsupported path: {path}")
+
+        resource, id = m.groups()
+        objects = self.directory.resources[resource]
+
+        if id is None and method == 'GET':
+            return self._list(resource, query)
+
+        if id is None and method == 'POST':
+            key = ScimDirectory.KEYS[resource]
+            if self.directory.find(resource, body.get(key)):
+                return self._error(409, f"{key} already exists: {body.get(key)}")
+            attrs = {k: v for k, v in body.items() if k not in ['id', 'schemas']}
+            return 201, self.directory.add(resource, **attrs)
+
+        if id not in objects:
+            return self._error(404, f"{resource} {id} not found")
+
+        if method == 'GET':
+            return 200, objects[id]
+
+        if method == 'DELETE':
+            objects.pop(id)
+            return 204, None
+
+        if method == 'PATCH':
+            if self.max_patch_bytes and len(json.dumps(body)) > self.max_patch_bytes:
+                return self._error(413, f"request is too large: {len(json.dumps(body))} bytes")
+            return self._patch(objects[id], body['Operations'])
+
+        return self._error(405, f"unsupported method: {method}")
+
+    def _list(self, resource: str, query: dict):
+        values = list(self.directory.resources[resource].values())
+
+        if 'filter' in query:
+            conditions = re.findall(r'(\w+) eq "([^"]*)"', query['filter'])
+            values = [x for x in values if any(x.get(k) == v for k, v in conditions)]
+
+        if 'attributes' in query:
+            attributes = set(query['attributes'].split(',')) | {'id'}
+            values = [{k: v for k, v in x.items() if k in attributes} for x in values]
+
+        start_index = int(query.get('startIndex') or 1)
+        count = min(int(query.get('count') or self.max_page_size), self.max_page_size)
+        page = values[start_index - 1:start_index - 1 + count]
+
+        return 200, {
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:ListResponse'],
+            'totalResults': len(values),
+            'startIndex': start_index,
+            'itemsPerPage': len(page),
+            'Resources': page
+        }
+
+    def _exists(self, id: str) -> bool:
+        return any(id in objects for objects in self.directory.resources.values())
+
+    def _patch(self, obj: dict, operations: List[dict]):
+        if not self.coalesced_removals and any(' or ' in (op.get('path') or '') for op in operations):
+            return self._error(400, "invalid filter")
+
+        for op in operations:
+            m = re.match(r'^members\[(value eq "[^"]+"(?: or value eq "[^"]+")*)\]$', op.get('path') or '')
+            if op['op'] == 'remove' and m:
+                removed = set(re.findall(r'value eq "([^"]+)"', m.group(1)))
+                obj['members'] = [x for x in obj.get('members') or [] if x['value'] not in removed]
+            elif op['op'] == 'add' and not op.get('path'):
+                unknown = [x['value'] for x in op['value']['members'] if not self._exists(x['value'])]
+                if unknown:
+                    return self._error(400, f"members do not exist: {unknown}")
+                members = obj.setdefault('members', [])
+                known = {x['value'] for x in members}
+                members.extend({'value': x['value']} for x in op['value']['members'] if x['value'] not in known)
+            elif op['op'] == 'replace':
+                value = op['value']
+                obj[op['path']] = value == 'true' if value in ['true', 'false'] else value
+            else:
+                return self._error(400, f"unsupported operation: {op}")
+
+        return 204, None